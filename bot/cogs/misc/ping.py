@@ -17,7 +17,9 @@ class PingCommand(commands.Cog, name="Ping Command"):
         interaction : discord.Interaction
             The interaction object.
         """
-        await interaction.response.send_message(content=f"Pong! (`{round(self.bot.latency * 1000)}ms`)")
+        worst_loop_lag = self.bot.loop_lag_monitor.reset()
+        await interaction.response.send_message(content=f"Pong! (`{round(self.bot.latency * 1000)}ms`, "
+                                                        f"worst event loop block since last ping `{round(worst_loop_lag * 1000)}ms`)")
 
 
 setup = extension_setup(PingCommand)
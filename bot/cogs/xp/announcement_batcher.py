@@ -0,0 +1,111 @@
+from __future__ import annotations
+from typing import Optional
+from enum import Enum
+from io import BytesIO
+import asyncio
+import logging
+import math
+import discord
+from .card_painter import stack_cards
+
+
+class LevelUpAnnouncementMode(Enum):
+    Immediate = 0
+    Digest = 1
+    Composite = 2
+
+
+class AnnouncementBatcher:
+    """Outbound queue of level-up cards for the announcement channel, sent in as few messages as the mode allows.
+    Messages are sent one at a time and at least send_interval seconds apart, so that a burst of level-ups
+    waits here rather than running into the channel's rate limit. Every card waiting when a message is sent
+    goes out with it, up to maximum_attachments cards to a message.
+
+    In immediate mode a message is sent as soon as a card is queued, or as soon as the previous message allows.
+    In digest mode cards are held until flush() is called, which the level-up announcer does once the level-ups
+    of an XP flush have all been handled, so that they go out together however long their cards took to render.
+    Composite mode is digest mode with the cards of each message stacked into one image.
+
+    queued_cards counts the cards queued, and sent_messages the messages sent for them."""
+
+    __slots__ = (
+        "channel",
+        "mode",
+        "send_interval",
+        "queued_cards",
+        "sent_messages",
+        "_pending",
+        "_send_lock",
+        "_last_send",
+        "_tasks"
+    )
+
+    maximum_attachments = 10
+    composite_filename = "level-ups.png"
+
+    def __init__(self, send_interval: float = 1.0):
+        self.channel: Optional[discord.abc.Messageable] = None
+        self.mode = LevelUpAnnouncementMode.Immediate
+        self.send_interval = send_interval
+        self.queued_cards = 0
+        self.sent_messages = 0
+        self._pending: list[tuple[str, bytes]] = []
+        self._send_lock = asyncio.Lock()
+        self._last_send = -math.inf
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, filename: str, png_bytes: bytes) -> None:
+        """Queue a card to be announced."""
+        self.queued_cards += 1
+        self._pending.append((filename, png_bytes))
+
+        if self.mode == LevelUpAnnouncementMode.Immediate:
+            self.start_flush()
+
+    def start_flush(self) -> None:
+        """Send every queued card, in the background."""
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> None:
+        """Send every queued card."""
+        async with self._send_lock:
+            while self._pending:
+                cards = self._pending[:self.maximum_attachments]
+                del self._pending[:self.maximum_attachments]
+                await self._wait_for_send_interval()
+                await self._send(cards)
+
+    async def _wait_for_send_interval(self) -> None:
+        loop = asyncio.get_running_loop()
+        wait = self._last_send + self.send_interval - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_send = loop.time()
+
+    async def _send(self, cards: list[tuple[str, bytes]]) -> None:
+        if self.channel is None:
+            return
+
+        if self.mode == LevelUpAnnouncementMode.Composite and len(cards) > 1:
+            stacked_png = await asyncio.to_thread(stack_cards, [png_bytes for _, png_bytes in cards])
+            files = [discord.File(BytesIO(stacked_png), filename=self.composite_filename)]
+        else:
+            files = [discord.File(BytesIO(png_bytes), filename=filename) for filename, png_bytes in cards]
+
+        try:
+            await self.channel.send(files=files)
+        except discord.HTTPException as error:
+            logging.error(f"Failed to announce {len(cards)} level-ups: {error}")
+            return
+        self.sent_messages += 1
+        logging.debug(f"Announced {len(cards)} level-ups in one message; "
+                      f"{self.sent_messages} messages sent for {self.queued_cards} cards so far")
+
+    async def close(self) -> None:
+        """Send every queued card immediately, and wait for any already being sent."""
+        await asyncio.gather(self.flush(), *self._tasks)
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Iterable, Optional
+from bisect import bisect_right
+
+
+class AutoroleIndex:
+    """In-memory copy of the autorole rules, as piecewise-constant role sets over XP levels.
+    A rule (assign_at, remove_at) holds its role at every level L with assign_at <= L,
+    and L < remove_at unless remove_at <= 0, in which case the role is never removed.
+
+    Every assign_at and positive remove_at is a breakpoint; between two breakpoints the set of held
+    roles cannot change, so one set is stored per segment and found by binary search over the breakpoints.
+    Role diffs between two levels are memoised per pair of segments, so that mass level changes
+    share the work of computing them."""
+
+    __slots__ = (
+        "_rules",
+        "_breakpoints",
+        "_segment_role_ids",
+        "_all_role_ids",
+        "_diffs"
+    )
+
+    def __init__(self):
+        self._rules: dict[int, tuple[int, int]] = {}
+        self._breakpoints: list[int] = []
+        self._segment_role_ids: list[frozenset[int]] = [frozenset()]
+        self._all_role_ids: frozenset[int] = frozenset()
+        self._diffs: dict[tuple[int, int], tuple[frozenset[int], frozenset[int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def __contains__(self, role_id: int) -> bool:
+        return role_id in self._rules
+
+    @property
+    def role_ids(self) -> frozenset[int]:
+        """Every role managed by some autorole rule."""
+        return self._all_role_ids
+
+    @staticmethod
+    def _holds(rule: tuple[int, int], level: int) -> bool:
+        assign_at, remove_at = rule
+        return assign_at <= level and (remove_at > level or remove_at <= 0)
+
+    def _rebuild(self) -> None:
+        breakpoints = set()
+        for assign_at, remove_at in self._rules.values():
+            breakpoints.add(assign_at)
+            if remove_at > 0:
+                breakpoints.add(remove_at)
+        self._breakpoints = sorted(breakpoints)
+
+        # segment 0 lies below the first breakpoint, and segment i starts at breakpoint i - 1
+        segment_levels = [self._breakpoints[0] - 1] + self._breakpoints if self._breakpoints else [0]
+        self._segment_role_ids = [
+            frozenset(role_id for role_id, rule in self._rules.items() if self._holds(rule, level))
+            for level in segment_levels
+        ]
+        self._all_role_ids = frozenset(self._rules.keys())
+        self._diffs.clear()
+
+    def _segment(self, level: int) -> int:
+        return bisect_right(self._breakpoints, level)
+
+    def load(self, rules: Iterable[tuple[int, int, int]]) -> None:
+        """Replace every rule with (role ID, assign_at, remove_at) rows."""
+        self._rules = {role_id: (assign_at, remove_at) for role_id, assign_at, remove_at in rules}
+        self._rebuild()
+
+    def get_rule(self, role_id: int) -> Optional[tuple[int, int]]:
+        """Query a role's (assign_at, remove_at), or None if it has no rule."""
+        return self._rules.get(role_id)
+
+    def set_rule(self, role_id: int, assign_at: int, remove_at: int) -> None:
+        self._rules[role_id] = (assign_at, remove_at)
+        self._rebuild()
+
+    def remove_rule(self, role_id: int) -> None:
+        if self._rules.pop(role_id, None) is not None:
+            self._rebuild()
+
+    def role_ids_at(self, level: int) -> frozenset[int]:
+        """Query the role IDs that a member of some level should hold."""
+        return self._segment_role_ids[self._segment(level)]
+
+    def role_ids_not_at(self, level: int) -> frozenset[int]:
+        """Query the managed role IDs that a member of some level should not hold."""
+        return self._all_role_ids - self.role_ids_at(level)
+
+    def diff(self, old_level: int, new_level: int) -> tuple[frozenset[int], frozenset[int]]:
+        """Query the (role IDs to add, role IDs to remove) for a member moving from old_level to new_level."""
+        segments = self._segment(old_level), self._segment(new_level)
+        try:
+            return self._diffs[segments]
+        except KeyError:
+            pass
+
+        old_role_ids, new_role_ids = (self._segment_role_ids[segment] for segment in segments)
+        role_diff = new_role_ids - old_role_ids, old_role_ids - new_role_ids
+        self._diffs[segments] = role_diff
+        return role_diff
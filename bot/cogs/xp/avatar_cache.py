@@ -0,0 +1,78 @@
+from typing import Optional
+from pathlib import Path
+import asyncio
+import base64
+import logging
+import os
+import discord
+from .image_cache import ImageCache
+
+
+class AvatarCache:
+    """Avatars for cards, downloaded from the CDN once and then kept in memory and on disk by avatar hash and size.
+    An avatar hash changes whenever the image does, so a cached avatar never goes stale; prefetch() fetches
+    a member's new avatar as soon as they change it, so that their next card renders without waiting on the CDN.
+    Concurrent requests for an avatar being downloaded share the one download."""
+
+    __slots__ = (
+        "images",
+        "_downloads"
+    )
+
+    def __init__(self, directory: Path, memory_limit: int = 8 * 1024 * 1024, disk_limit: int = 64 * 1024 * 1024):
+        self.images = ImageCache(directory, memory_limit, disk_limit)
+        self._downloads: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def make_key(avatar: discord.Asset, size: int) -> str:
+        return f"{avatar.key}-{size}"
+
+    @staticmethod
+    def to_data_uri(avatar_png: bytes) -> str:
+        return f"data:image/png;base64,{base64.b64encode(avatar_png).decode()}"
+
+    async def get(self, avatar: discord.Asset, size: int) -> Optional[bytes]:
+        """Query an avatar as PNG bytes, downloading it if it is not cached, or None if the download fails."""
+        key = self.make_key(avatar, size)
+        avatar_png = await self.images.get(key)
+        if avatar_png is not None:
+            return avatar_png
+
+        download = self._downloads.get(key)
+        if download is None:
+            download = asyncio.get_running_loop().create_task(self._download(avatar, size, key))
+            self._downloads[key] = download
+            download.add_done_callback(lambda _: self._downloads.pop(key, None))
+        return await asyncio.shield(download)
+
+    async def _download(self, avatar: discord.Asset, size: int, key: str) -> Optional[bytes]:
+        try:
+            # animated avatars are drawn as their first frame, so every avatar is stored as PNG
+            avatar_png = await avatar.with_size(size).with_format("png").read()
+        except discord.DiscordException as error:
+            logging.warning(f"Failed to download avatar {key}: {error}")
+            return None
+
+        await self.images.put(key, avatar_png)
+        return avatar_png
+
+    async def prefetch(self, before: discord.Asset, after: discord.Asset, size: int) -> None:
+        """Download a changed avatar ahead of the next card that needs it."""
+        if before.key == after.key:
+            return
+        await self.get(after, size)
+
+
+avatar_cache_directory = Path("data/xp/avatar_cache/")
+_avatar_cache: Optional[AvatarCache] = None
+
+
+def get_avatar_cache() -> AvatarCache:
+    """The shared avatar cache. Its memory and disk limits, in MiB, are set by the XP_AVATAR_CACHE_MEMORY_MIB
+    and XP_AVATAR_CACHE_DISK_MIB environment variables."""
+    global _avatar_cache
+    if _avatar_cache is None:
+        memory_limit = int(os.getenv("XP_AVATAR_CACHE_MEMORY_MIB", 8)) * 1024 * 1024
+        disk_limit = int(os.getenv("XP_AVATAR_CACHE_DISK_MIB", 64)) * 1024 * 1024
+        _avatar_cache = AvatarCache(avatar_cache_directory, memory_limit, disk_limit)
+    return _avatar_cache
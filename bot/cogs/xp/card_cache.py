@@ -0,0 +1,19 @@
+from typing import Optional
+from pathlib import Path
+import os
+from .image_cache import ImageCache
+
+
+card_cache_directory = Path("data/xp/card_cache/")
+_card_render_cache: Optional[ImageCache] = None
+
+
+def get_card_render_cache() -> ImageCache:
+    """The shared render cache. Its memory and disk limits, in MiB, are set by the XP_CARD_CACHE_MEMORY_MIB
+    and XP_CARD_CACHE_DISK_MIB environment variables."""
+    global _card_render_cache
+    if _card_render_cache is None:
+        memory_limit = int(os.getenv("XP_CARD_CACHE_MEMORY_MIB", 16)) * 1024 * 1024
+        disk_limit = int(os.getenv("XP_CARD_CACHE_DISK_MIB", 128)) * 1024 * 1024
+        _card_render_cache = ImageCache(card_cache_directory, memory_limit, disk_limit)
+    return _card_render_cache
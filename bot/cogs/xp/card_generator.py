@@ -1,31 +1,36 @@
 from __future__ import annotations
 
 import logging
+import asyncio
+import heapq
+import itertools
 import json
+import math
+from collections import OrderedDict
+from functools import partial
+import discord
 from random import random, choice
-from os import getcwd
-from html2image import Html2Image
-from contextlib import closing as contextlib_closing
-from urllib.request import pathname2url
+from typing import Any, Optional
 from bot.cogs.xp.main import ExperienceMember, XPHandling
-from enum import Enum
+from bot.cogs.xp.card_renderer import get_card_renderer
+from bot.cogs.xp.image_cache import ImageCache
+from bot.cogs.xp.card_cache import get_card_render_cache
+from bot.cogs.xp.avatar_cache import AvatarCache, get_avatar_cache
+from bot.cogs.xp.card_template import CardTemplateCache, CompiledCardTemplate
+from enum import Enum, IntEnum
+from io import BytesIO
 from pathlib import Path
 
 
-html_renderer = Html2Image(size=(1024, 308))
-
-
 class UserDisplayCardType(Enum):
     DisplayProgress = "show_user.html"
     LevelUp = "level_up.html"
 
 
-class DeletingFile:
-    def __init__(self, file: Path):
-        self.file = file
-
-    def close(self):
-        self.file.unlink(missing_ok=True)
+class RenderPriority(IntEnum):
+    Interactive = 0
+    Background = 1
+    Idle = 2
 
 
 class ExtraCardFields:
@@ -78,9 +83,13 @@ class ExtraCardFields:
 
 
 class UserDisplayCard:
-    global html_renderer
-    temp_directory = Path("data/xp/temp_cards/")
+    card_size = (1024, 308)
+    avatar_size = 128
     card_directory = Path("data/xp/html_cards/")
+    templates = CardTemplateCache()
+    # cards whose fields are random are not cached, as a cached card would always show the same random choice
+    cached_card_types = {UserDisplayCardType.DisplayProgress}
+    random_fields = {"party1", "party2"}
     extra_fields_generator = ExtraCardFields()
     extra_fields = {UserDisplayCardType.DisplayProgress: {"previous_level_requirement": extra_fields_generator.previous_level_requirement,
                                                           "next_level_requirement": extra_fields_generator.next_level_requirement,
@@ -93,21 +102,37 @@ class UserDisplayCard:
         self.member = member
         self.card_type = card_type
         self._template_filepath = Path(self.card_directory, self.card_type.value)
-        unique_card_name = f"{self.card_type.name}{self.member.id}"
-        self._temporary_html_filepath = Path(self.temp_directory, f"{unique_card_name}.html")
-        self._temporary_png_filepath = Path(self.temp_directory, f"{unique_card_name}.png")
-
-        html_renderer.output_path = self.temp_directory
-
-    def _read_card_template(self) -> str:
-        with open(self._template_filepath) as template_html_file:
-            return template_html_file.read()
+        self.filename = f"{self.card_type.name}{self.member.id}.png"
+        self._card_fields: Optional[dict[str, Any]] = None
+        self.avatar_png: Optional[bytes] = None
+
+    def get_template(self) -> CompiledCardTemplate:
+        return self.templates.get(self._template_filepath)
+
+    def get_cache_key(self) -> str:
+        """Hash of everything that determines the card, other than its random fields."""
+        card_fields = {name: value for name, value in self.get_card_fields().items() if name not in self.random_fields}
+        return ImageCache.make_key(self.card_type.name, self.get_template().version, type(get_card_renderer()).__name__,
+                                   AvatarCache.make_key(self.member.display_avatar, self.avatar_size), card_fields)
+
+    async def load_avatar(self) -> None:
+        """Fetch the member's avatar through the avatar cache, ready for rendering."""
+        self.avatar_png = await get_avatar_cache().get(self.member.display_avatar, self.avatar_size)
+
+    def get_avatar_url(self) -> str:
+        """The loaded avatar as a data URI, so that browsers render offline, or its CDN URL if it could not be loaded."""
+        if self.avatar_png is None:
+            return str(self.member.display_avatar.with_size(self.avatar_size))
+        return AvatarCache.to_data_uri(self.avatar_png)
+
+    def get_card_fields(self) -> dict[str, Any]:
+        """The values filled into the card template, computed once per card so that every renderer agrees."""
+        if self._card_fields is not None:
+            return self._card_fields
 
-    def _format_card_template(self, template_html_string: str) -> str:
         data = {
             "username": self.member.display_name,
             "discriminator": self.member.discriminator,
-            "profile_url": self.member.display_avatar.with_size(128),
             "level": self.member.level,
             "rank": self.member.rank,
             "xp_quantity": XPHandling.format_xp_quantity(self.member.xp_quantity),
@@ -117,25 +142,304 @@ class UserDisplayCard:
         for field_name, field_factory in self.extra_fields[self.card_type].items():
             data[field_name] = field_factory(self)
 
-        return template_html_string.format(**data)
-
-    def _write_html_card(self, formatted_html_string: str) -> DeletingFile:
-        with open(self._temporary_html_filepath, "w") as temporary_html_file:
-            temporary_html_file.write(formatted_html_string)
-        return DeletingFile(self._temporary_html_filepath)
-
-    def _get_html_card_file_url(self):
-        return "file://" + pathname2url(str(Path(getcwd(), self._temporary_html_filepath)))
-
-    def _render_png_card(self) -> DeletingFile:
-        html_renderer.screenshot(url=self._get_html_card_file_url(), save_as=self._temporary_png_filepath.name)
-        return DeletingFile(self._temporary_png_filepath)
+        self._card_fields = data
+        return data
+
+    def get_html_card(self) -> str:
+        """The formatted HTML card, self-contained so that a browser can render it without reading any files."""
+        return self.get_template().format(profile_url=self.get_avatar_url(), **self.get_card_fields())
+
+    async def render_uncached(self) -> bytes:
+        """Render the card now, bypassing the render scheduler, and cache it if its type is cached."""
+        await self.load_avatar()
+        png_bytes = await get_card_renderer().render(self)
+        if self.card_type in self.cached_card_types:
+            await get_card_render_cache().put(self.get_cache_key(), png_bytes)
+        return png_bytes
+
+    async def get_png_card(self, priority: RenderPriority = RenderPriority.Interactive) -> bytes:
+        if self.card_type in self.cached_card_types:
+            png_bytes = await get_card_render_cache().get(self.get_cache_key())
+            if png_bytes is not None:
+                return png_bytes
+        return await get_render_scheduler().render(self, priority)
+
+    async def get_card_file(self, priority: RenderPriority = RenderPriority.Interactive) -> discord.File:
+        return discord.File(BytesIO(await self.get_png_card(priority)), filename=self.filename)
+
+
+class RenderJob:
+    __slots__ = (
+        "card",
+        "key",
+        "priority",
+        "future",
+        "started"
+    )
+
+    def __init__(self, card: UserDisplayCard, key: str, priority: RenderPriority):
+        self.card = card
+        self.key = key
+        self.priority = priority
+        self.future: asyncio.Future[bytes] = asyncio.get_running_loop().create_future()
+        self.started = False
+
+
+class CardRenderScheduler:
+    """Runs card renders in priority order, on as many workers as the card renderer renders at once.
+    Queued interactive renders always start before queued background ones. A request for a card identical to one
+    already queued or rendering shares that render instead of adding another, and an interactive request
+    promotes a queued background render that it shares.
+
+    Interactive latency is a moving average of the time from an interactive request to its card. While it is
+    above interactive_latency_target, and an interactive request was made in the last throttle_window seconds,
+    at most throttled_background_workers background renders run at once, leaving the other workers free.
+
+    Idle renders are speculative pre-renders of cards that may be requested soon. They start only when no other
+    render is queued, at most idle_workers at once, and never while background renders are throttled.
+    A finished pre-render is kept for up to prerender_ttl seconds, and a request for the same card takes it
+    instead of rendering; pre-renders that expire, are evicted, or are replaced by a newer pre-render of the same
+    member's card are counted as unused. Each member has at most one pre-render.
+
+    Workers are started as renders are queued, and stop once the queue is empty. A render whose worker is cancelled
+    fails, for every request that shares it."""
+
+    __slots__ = (
+        "interactive_latency_target",
+        "throttle_window",
+        "throttled_background_workers",
+        "latency_smoothing",
+        "interactive_latency",
+        "merged_requests",
+        "prerenders",
+        "prerender_hits",
+        "unused_prerenders",
+        "_queue",
+        "_sequence",
+        "_in_flight",
+        "_workers",
+        "_running",
+        "_last_interactive_request",
+        "_wakeup",
+        "_prerendered",
+        "_prerender_keys"
+    )
+
+    throttle_recheck_interval = 1.0
+    idle_workers = 1
+    prerender_ttl = 10 * 60.0
+    maximum_prerenders = 256
+
+    def __init__(self, interactive_latency_target: float = 1.0, throttle_window: float = 30.0,
+                 throttled_background_workers: int = 1, latency_smoothing: float = 0.3):
+        self.interactive_latency_target = interactive_latency_target
+        self.throttle_window = throttle_window
+        self.throttled_background_workers = throttled_background_workers
+        self.latency_smoothing = latency_smoothing
+        self.interactive_latency = 0.0
+        self.merged_requests = 0
+        self.prerenders = 0
+        self.prerender_hits = 0
+        self.unused_prerenders = 0
+        self._queue: list[tuple[int, int, RenderJob]] = []
+        self._sequence = itertools.count()
+        self._in_flight: dict[str, RenderJob] = {}
+        self._workers: set[asyncio.Task] = set()
+        self._running: dict[RenderPriority, int] = {priority: 0 for priority in RenderPriority}
+        self._last_interactive_request = -math.inf
+        self._wakeup = asyncio.Event()
+        # finished pre-renders by key, oldest first, as (PNG bytes, time finished)
+        self._prerendered: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        # the key of each member's queued, rendering or finished pre-render
+        self._prerender_keys: dict[int, str] = {}
+
+    @property
+    def throttled(self) -> bool:
+        recently_interactive = asyncio.get_running_loop().time() - self._last_interactive_request < self.throttle_window
+        return recently_interactive and self.interactive_latency > self.interactive_latency_target
+
+    def queued(self, priority: RenderPriority) -> int:
+        return sum(1 for job in self._in_flight.values() if not job.started and job.priority == priority)
+
+    async def render(self, card: UserDisplayCard, priority: RenderPriority) -> bytes:
+        loop = asyncio.get_running_loop()
+        request_time = loop.time()
+        if priority == RenderPriority.Interactive:
+            self._last_interactive_request = request_time
+
+        key = card.get_cache_key()
+        png_bytes = self._take_prerender(key)
+        if png_bytes is not None:
+            return png_bytes
+
+        job = self._in_flight.get(key)
+        if job is None:
+            job = RenderJob(card, key, priority)
+            self._in_flight[key] = job
+            self._enqueue(job)
+        else:
+            self.merged_requests += 1
+            if job.priority == RenderPriority.Idle and self._prerender_keys.get(card.member.id) == key:
+                # the pre-render is taken while still queued or rendering, so it will not be kept once finished
+                del self._prerender_keys[card.member.id]
+                self.prerender_hits += 1
+            if priority < job.priority and not job.started:
+                job.priority = priority
+                self._enqueue(job)
+
+        try:
+            # shielded, so that a cancelled request does not cancel a render that others may share
+            return await asyncio.shield(job.future)
+        finally:
+            if priority == RenderPriority.Interactive:
+                latency = loop.time() - request_time
+                self.interactive_latency += self.latency_smoothing * (latency - self.interactive_latency)
+
+    def prerender(self, card: UserDisplayCard) -> None:
+        """Queue an idle render of a card that may be requested soon, replacing any earlier pre-render for its member."""
+        self._expire_prerenders()
+        key = card.get_cache_key()
+        member_id = card.member.id
+        if self._prerender_keys.get(member_id) == key or key in self._in_flight:
+            return
+
+        self._discard_prerender(member_id)
+        self._prerender_keys[member_id] = key
+        self.prerenders += 1
+        job = RenderJob(card, key, RenderPriority.Idle)
+        job.future.add_done_callback(partial(self._keep_prerender, member_id, key))
+        self._in_flight[key] = job
+        self._enqueue(job)
+
+    def _keep_prerender(self, member_id: int, key: str, future: asyncio.Future[bytes]) -> None:
+        if future.cancelled() or future.exception() is not None:
+            if self._prerender_keys.get(member_id) == key:
+                del self._prerender_keys[member_id]
+            return
+        if self._prerender_keys.get(member_id) != key:
+            return
+
+        self._prerendered[key] = (future.result(), asyncio.get_running_loop().time())
+        while len(self._prerendered) > self.maximum_prerenders:
+            evicted_key, _ = self._prerendered.popitem(last=False)
+            self._forget_prerender_key(evicted_key)
+            self.unused_prerenders += 1
+
+    def _take_prerender(self, key: str) -> Optional[bytes]:
+        self._expire_prerenders()
+        prerendered = self._prerendered.pop(key, None)
+        if prerendered is None:
+            return None
+        self._forget_prerender_key(key)
+        self.prerender_hits += 1
+        return prerendered[0]
+
+    def _discard_prerender(self, member_id: int) -> None:
+        key = self._prerender_keys.pop(member_id, None)
+        if key is None:
+            return
+        self._prerendered.pop(key, None)
+        self.unused_prerenders += 1
+
+    def _forget_prerender_key(self, key: str) -> None:
+        for member_id, prerender_key in self._prerender_keys.items():
+            if prerender_key == key:
+                del self._prerender_keys[member_id]
+                return
 
-    def get_png_card(self) -> contextlib_closing[DeletingFile]:
-        template_string = self._read_card_template()
-        formatted_template_string = self._format_card_template(template_string)
-        with contextlib_closing(self._write_html_card(formatted_template_string)):
-            return contextlib_closing(self._render_png_card())
+    def _expire_prerenders(self) -> None:
+        expire_before = asyncio.get_running_loop().time() - self.prerender_ttl
+        while self._prerendered:
+            key, (_, finished_at) = next(iter(self._prerendered.items()))
+            if finished_at >= expire_before:
+                return
+            del self._prerendered[key]
+            self._forget_prerender_key(key)
+            self.unused_prerenders += 1
+
+    def _enqueue(self, job: RenderJob) -> None:
+        heapq.heappush(self._queue, (job.priority, next(self._sequence), job))
+        if len(self._workers) < get_card_renderer().worker_count:
+            worker = asyncio.get_running_loop().create_task(self._work())
+            self._workers.add(worker)
+        self._wakeup.set()
+
+    def _take_job(self) -> Optional[RenderJob]:
+        while self._queue:
+            priority, _, job = self._queue[0]
+            # a promoted job leaves its old entry behind, which is skipped
+            if job.started or priority != job.priority:
+                heapq.heappop(self._queue)
+                continue
+            if (priority == RenderPriority.Background
+                    and self._running[priority] >= self.throttled_background_workers and self.throttled):
+                return None
+            if priority == RenderPriority.Idle and (self._running[priority] >= self.idle_workers or self.throttled):
+                return None
+            heapq.heappop(self._queue)
+            return job
+        return None
+
+    async def _work(self) -> None:
+        try:
+            while self._queue:
+                job = self._take_job()
+                if job is None:
+                    # only throttled background renders, or idle renders, are queued
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.throttle_recheck_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+        finally:
+            # removed as the queue is found empty, not once the task's done callbacks run,
+            # so that a render queued in between starts a new worker rather than waiting on this one
+            self._workers.discard(asyncio.current_task())
+
+    async def _run(self, job: RenderJob) -> None:
+        job.started = True
+        priority = job.priority
+        self._running[priority] += 1
+        try:
+            job.future.set_result(await job.card.render_uncached())
+        except Exception as error:
+            job.future.set_exception(error)
+        finally:
+            if not job.future.done():
+                # the worker was cancelled mid-render; fail the render, rather than leave its requests waiting forever
+                job.future.set_exception(RuntimeError(f"Render of {job.card.card_type.name} card of user with id "
+                                                      f"{job.card.member.id} was cancelled"))
+            self._running[priority] -= 1
+            self._in_flight.pop(job.key, None)
+            self._wakeup.set()
+
+    def summary(self) -> str:
+        summary = (f"{self.queued(RenderPriority.Interactive)} interactive and "
+                   f"{self.queued(RenderPriority.Background)} background renders queued, "
+                   f"{self.merged_requests} requests merged, "
+                   f"{self.prerender_hits} of {self.prerenders} pre-renders used ({self.unused_prerenders} unused), "
+                   f"interactive latency {self.interactive_latency * 1000:.0f}ms")
+        if self.throttled:
+            summary += " (background renders throttled)"
+        return summary
+
+
+_render_scheduler: Optional[CardRenderScheduler] = None
+
+
+def get_render_scheduler() -> CardRenderScheduler:
+    global _render_scheduler
+    if _render_scheduler is None:
+        _render_scheduler = CardRenderScheduler()
+    return _render_scheduler
+
+
+async def render_card(member: ExperienceMember, card_type: UserDisplayCardType,
+                      priority: RenderPriority = RenderPriority.Interactive) -> discord.File:
+    """Render a member's card through the render scheduler, which keeps the work off the event loop."""
+    return await UserDisplayCard(member, card_type).get_card_file(priority)
 
 
 def setup(bot) -> None:
@@ -0,0 +1,237 @@
+from __future__ import annotations
+from typing import Any, Optional
+from io import BytesIO
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+
+class CardPainter:
+    """Draws the DisplayProgress and LevelUp cards with Pillow, from the same fields as their HTML templates.
+    The geometry mirrors html_cards/style.css: a circular avatar in the left column, and rows of centred text
+    in the right column sharing its height by their flex factors, above the progress bar if the card has one.
+
+    Text is set in the fonts bundled under data/xp/fonts, so that cards look the same wherever they are painted.
+    Emoji are drawn in colour from the bundled emoji font, which holds only the party emoji; see its README."""
+
+    size = (1024, 308)
+    background_colour = (54, 57, 63)
+    progress_track_colour = (51, 51, 51)
+    text_colour = (255, 255, 255)
+    regular_font_path = Path("data/xp/fonts/dejavu/DejaVuSans.ttf")
+    bold_font_path = Path("data/xp/fonts/dejavu/DejaVuSans-Bold.ttf")
+    emoji_font_path = Path("data/xp/fonts/openmoji/OpenMoji-party.ttf")
+    avatar_mask_supersampling = 4
+    png_compress_level = 1
+
+    # content margins, column widths and the right column's bottom margin, in pixels
+    content_left, content_right = 10, 1014
+    left_column_width = 239
+    left_column_margin = 5
+    right_column_bottom = 288
+    avatar_height_fraction = 0.75
+
+    progress_label_font_size = 24
+    progress_label_padding = 15
+    progress_bar_aspect_ratio = 30
+    progress_bar_radius = 15
+
+    # (text template, font size, bold, flex, in the user's colour) of each text row, top to bottom
+    text_rows = {
+        "DisplayProgress": [("{username}#{discriminator}", 56, True, 1.5, True),
+                            ("LEVEL {level}", 42, False, 1, False),
+                            ("RANK #{rank}", 42, False, 1, False),
+                            ("{xp_quantity} XP", 42, False, 1, False)],
+        "LevelUp": [("{username}#{discriminator}", 40, True, 1.3, True),
+                    ("{party1} Level Up! {party2}", 46, True, 1.4, False),
+                    ("LEVEL {level}", 42, False, 1, False),
+                    ("RANK #{rank}", 42, False, 1, False),
+                    ("{xp_quantity} XP", 42, False, 1, False)]
+    }
+    progress_bar_cards = {"DisplayProgress"}
+
+    def __init__(self):
+        self._fonts: dict[tuple[Path, int], ImageFont.FreeTypeFont] = {}
+        self._avatar_masks: dict[int, Image.Image] = {}
+
+    def _font(self, bold: bool, size: int) -> ImageFont.FreeTypeFont:
+        return self._font_at(self.bold_font_path if bold else self.regular_font_path, size)
+
+    def _emoji_font(self, size: int) -> ImageFont.FreeTypeFont:
+        return self._font_at(self.emoji_font_path, size)
+
+    def _font_at(self, path: Path, size: int) -> ImageFont.FreeTypeFont:
+        try:
+            return self._fonts[path, size]
+        except KeyError:
+            pass
+
+        font = ImageFont.truetype(str(path), size)
+        self._fonts[path, size] = font
+        return font
+
+    @staticmethod
+    def _is_emoji(character: str) -> bool:
+        codepoint = ord(character)
+        # pictographs and the older symbol and dingbat blocks, with the joiner and selector that combine emoji
+        return codepoint >= 0x1F000 or 0x2600 <= codepoint < 0x27C0 or character in "\u200d\ufe0f"
+
+    @classmethod
+    def _split_emoji(cls, text: str) -> list[tuple[str, bool]]:
+        """Split text into runs of (text, whether it is emoji), as no one font draws both."""
+        runs: list[tuple[str, bool]] = []
+        for character in text:
+            is_emoji = cls._is_emoji(character)
+            if runs and runs[-1][1] == is_emoji:
+                runs[-1] = (runs[-1][0] + character, is_emoji)
+            else:
+                runs.append((character, is_emoji))
+        return runs
+
+    def _run_fonts(self, runs: list[tuple[str, bool]], bold: bool, size: int) -> list[ImageFont.FreeTypeFont]:
+        return [self._emoji_font(size) if is_emoji else self._font(bold, size) for _, is_emoji in runs]
+
+    def _avatar_mask(self, diameter: int) -> Image.Image:
+        try:
+            return self._avatar_masks[diameter]
+        except KeyError:
+            pass
+
+        supersampled_diameter = diameter * self.avatar_mask_supersampling
+        mask = Image.new("L", (supersampled_diameter, supersampled_diameter), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, supersampled_diameter - 1, supersampled_diameter - 1), fill=255)
+        mask = mask.resize((diameter, diameter), Image.LANCZOS)
+        self._avatar_masks[diameter] = mask
+        return mask
+
+    @staticmethod
+    def _parse_colour(colour: str) -> tuple[int, ...]:
+        return tuple(int(component) for component in colour.split(","))
+
+    def _fit_fonts(self, runs: list[tuple[str, bool]], bold: bool, size: int,
+                   width: int) -> list[ImageFont.FreeTypeFont]:
+        """The font of each run at the given size, or shrunk so that the runs together fit within width."""
+        fonts = self._run_fonts(runs, bold, size)
+        text_width = sum(font.getlength(text) for (text, _), font in zip(runs, fonts))
+        if text_width <= width:
+            return fonts
+        return self._run_fonts(runs, bold, max(int(size * width / text_width), 1))
+
+    def _draw_centred_text(self, draw: ImageDraw.ImageDraw, centre: tuple[float, float], text: str, bold: bool,
+                           size: int, width: int, colour: tuple[int, ...]) -> None:
+        runs = self._split_emoji(text)
+        fonts = self._fit_fonts(runs, bold, size, width)
+        if len(runs) == 1:
+            draw.text(centre, text, font=fonts[0], fill=colour, anchor="mm", embedded_color=runs[0][1])
+            return
+
+        widths = [font.getlength(run_text) for (run_text, _), font in zip(runs, fonts)]
+        x, y = centre[0] - sum(widths) / 2, centre[1]
+        for (run_text, is_emoji), font, run_width in zip(runs, fonts, widths):
+            draw.text((x, y), run_text, font=font, fill=colour, anchor="lm", embedded_color=is_emoji)
+            x += run_width
+
+    def _paint_avatar(self, card: Image.Image, avatar_png: Optional[bytes]) -> None:
+        column_height = self.size[1] - 2 * self.left_column_margin
+        diameter = int(column_height * self.avatar_height_fraction)
+        left = self.content_left + (self.left_column_width - diameter) // 2
+        top = (self.size[1] - diameter) // 2
+
+        if avatar_png is None:
+            ImageDraw.Draw(card).ellipse((left, top, left + diameter - 1, top + diameter - 1),
+                                         fill=self.progress_track_colour)
+            return
+
+        with Image.open(BytesIO(avatar_png)) as avatar:
+            avatar = avatar.convert("RGBA").resize((diameter, diameter), Image.BILINEAR)
+        mask = self._avatar_mask(diameter)
+        if avatar.getextrema()[3][0] < 255:
+            mask = Image.composite(avatar.getchannel("A"), Image.new("L", mask.size, 0), mask)
+        card.paste(avatar, (left, top), mask)
+
+    def _paint_progress_bar(self, card: Image.Image, draw: ImageDraw.ImageDraw, fields: dict[str, Any],
+                            left: int, right: int, bottom: int, colour: tuple[int, ...]) -> int:
+        """Draw the progress row along the bottom of the right column, and return its top edge."""
+        font = self._font(False, self.progress_label_font_size)
+        previous_label = str(fields["previous_level_requirement"])
+        next_label = str(fields["next_level_requirement"])
+        previous_width = font.getlength(previous_label) + 2 * self.progress_label_padding
+        next_width = font.getlength(next_label) + 2 * self.progress_label_padding
+
+        bar_left = int(left + previous_width)
+        bar_right = int(right - next_width)
+        bar_height = max((bar_right - bar_left) // self.progress_bar_aspect_ratio, 1)
+        ascent, descent = font.getmetrics()
+        row_height = max(ascent + descent, bar_height)
+        row_top = bottom - row_height
+        row_middle = row_top + row_height // 2
+
+        draw.text((left + previous_width / 2, row_middle), previous_label, font=font, fill=self.text_colour, anchor="mm")
+        draw.text((right - next_width / 2, row_middle), next_label, font=font, fill=self.text_colour, anchor="mm")
+
+        bar_top = row_middle - bar_height // 2
+        bar_box = (bar_left, bar_top, bar_right - 1, bar_top + bar_height - 1)
+        radius = min(self.progress_bar_radius, bar_height // 2)
+        draw.rounded_rectangle(bar_box, radius=radius, fill=self.progress_track_colour)
+
+        fill_width = int((bar_right - bar_left) * min(max(float(fields["level_progress_percentage"]), 0), 100) / 100)
+        if fill_width > 0:
+            # the fill is clipped to the track's rounded outline, as by overflow: hidden
+            clip = Image.new("L", (bar_right - bar_left, bar_height), 0)
+            ImageDraw.Draw(clip).rounded_rectangle((0, 0, bar_right - bar_left - 1, bar_height - 1),
+                                                   radius=radius, fill=255)
+            clip.paste(0, (fill_width, 0, clip.width, clip.height))
+            card.paste(colour, (bar_left, bar_top, bar_right, bar_top + bar_height), clip)
+
+        return row_top
+
+    def paint(self, card_type_name: str, fields: dict[str, Any], avatar_png: Optional[bytes]) -> bytes:
+        """Draw a card of the named type from its template fields, and return it encoded as PNG."""
+        card = Image.new("RGB", self.size, self.background_colour)
+        draw = ImageDraw.Draw(card)
+        user_colour = self._parse_colour(fields["user_colour"])
+
+        self._paint_avatar(card, avatar_png)
+
+        left = self.content_left + self.left_column_width
+        right = self.content_right
+        rows_bottom = self.right_column_bottom
+        if card_type_name in self.progress_bar_cards:
+            rows_bottom = self._paint_progress_bar(card, draw, fields, left, right, rows_bottom, user_colour)
+
+        rows = self.text_rows[card_type_name]
+        total_flex = sum(flex for _, _, _, flex, _ in rows)
+        row_top = 0
+        for template, font_size, bold, flex, coloured in rows:
+            row_height = rows_bottom * flex / total_flex
+            self._draw_centred_text(draw, ((left + right) / 2, row_top + row_height / 2), template.format(**fields),
+                                    bold, font_size, right - left, user_colour if coloured else self.text_colour)
+            row_top += row_height
+
+        output = BytesIO()
+        card.save(output, "PNG", compress_level=self.png_compress_level)
+        return output.getvalue()
+
+
+_process_painter: Optional[CardPainter] = None
+
+
+def paint_card(card_type_name: str, fields: dict[str, Any], avatar_png: Optional[bytes]) -> bytes:
+    """Paint a card with this process's own CardPainter, so that cards can be painted in a process pool."""
+    global _process_painter
+    if _process_painter is None:
+        _process_painter = CardPainter()
+    return _process_painter.paint(card_type_name, fields, avatar_png)
+
+
+def stack_cards(card_pngs: list[bytes]) -> bytes:
+    """Stack rendered cards top to bottom into one PNG, so that several can be sent as a single image."""
+    cards = [Image.open(BytesIO(card_png)) for card_png in card_pngs]
+    stacked = Image.new("RGBA", (max(card.width for card in cards), sum(card.height for card in cards)), (0, 0, 0, 0))
+    top = 0
+    for card in cards:
+        stacked.paste(card.convert("RGBA"), (0, top))
+        top += card.height
+
+    output = BytesIO()
+    stacked.save(output, "PNG", compress_level=CardPainter.png_compress_level)
+    return output.getvalue()
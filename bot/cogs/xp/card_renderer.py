@@ -0,0 +1,416 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Optional
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import aiohttp
+import asyncio
+import base64
+import itertools
+import logging
+import multiprocessing
+import os
+from .card_painter import paint_card
+
+if TYPE_CHECKING:
+    from bot.cogs.xp.card_generator import UserDisplayCard
+
+
+@dataclass
+class CardRenderMetrics:
+    waiting: int = 0
+    peak_waiting: int = 0
+    renders: int = 0
+    failures: int = 0
+    total_render_time: float = 0.0
+    maximum_render_time: float = 0.0
+
+    @property
+    def mean_render_time(self) -> float:
+        if self.renders == 0:
+            return 0.0
+        return self.total_render_time / self.renders
+
+    def record_render(self, render_time: float) -> None:
+        self.renders += 1
+        self.total_render_time += render_time
+        self.maximum_render_time = max(self.maximum_render_time, render_time)
+
+    def summary(self) -> str:
+        return (f"{self.renders} cards rendered ({self.failures} failed), "
+                f"mean {self.mean_render_time * 1000:.0f}ms, worst {self.maximum_render_time * 1000:.0f}ms, "
+                f"{self.waiting} waiting (peak {self.peak_waiting})")
+
+
+class CardRenderer(ABC):
+    """Renders user display cards to PNG bytes, off the event loop, with at most worker_count renders in progress.
+    Further renders wait their turn; how many are waiting, and how long renders take, is kept in metrics."""
+
+    def __init__(self, worker_count: int = 2):
+        self.worker_count = worker_count
+        self.metrics = CardRenderMetrics()
+        self._render_slots = asyncio.Semaphore(worker_count)
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def render(self, card: UserDisplayCard) -> bytes:
+        self.metrics.waiting += 1
+        self.metrics.peak_waiting = max(self.metrics.peak_waiting, self.metrics.waiting)
+        try:
+            await self._render_slots.acquire()
+        finally:
+            self.metrics.waiting -= 1
+
+        loop = asyncio.get_running_loop()
+        render_start = loop.time()
+        try:
+            return await self._render(card)
+        except Exception:
+            self.metrics.failures += 1
+            raise
+        finally:
+            self._render_slots.release()
+            render_time = loop.time() - render_start
+            self.metrics.record_render(render_time)
+            logging.debug(f"Rendered {card.card_type.name} card of user with id {card.member.id} "
+                          f"in {render_time * 1000:.0f}ms, {self.metrics.waiting} renders waiting")
+
+    @abstractmethod
+    async def _render(self, card: UserDisplayCard) -> bytes:
+        ...
+
+
+class BrowserCardRenderer(CardRenderer):
+    """Renders a card's HTML template in a browser."""
+
+    async def _render(self, card: UserDisplayCard) -> bytes:
+        return await self.render_html(card.get_html_card(), card.card_size)
+
+    async def render_html(self, html: str, size: tuple[int, int]) -> bytes:
+        return await self.render_url(f"data:text/html;base64,{base64.b64encode(html.encode()).decode()}", size)
+
+    @abstractmethod
+    async def render_url(self, url: str, size: tuple[int, int]) -> bytes:
+        ...
+
+
+class Html2ImageRenderer(BrowserCardRenderer):
+    """Launches a new headless Chrome process through Html2Image for every render, each on a worker thread."""
+
+    def __init__(self, worker_count: int = 2):
+        super().__init__(worker_count)
+        # imported here, and by DevToolsRenderer, so that the Pillow backend runs without html2image installed
+        from html2image import Html2Image
+        self._executor = ThreadPoolExecutor(worker_count, thread_name_prefix="card-renderer")
+        self._output_directory = TemporaryDirectory(prefix="cards-")
+        self._html2image = Html2Image(output_path=self._output_directory.name)
+        self._output_names = itertools.count()
+
+    async def close(self) -> None:
+        self._executor.shutdown()
+        self._output_directory.cleanup()
+
+    def _screenshot(self, url: str, size: tuple[int, int]) -> bytes:
+        output_file = Path(self._output_directory.name, f"{next(self._output_names)}.png")
+        self._html2image.screenshot(url=url, save_as=output_file.name, size=size)
+        try:
+            return output_file.read_bytes()
+        finally:
+            output_file.unlink(missing_ok=True)
+
+    def _screenshot_html(self, html: str, size: tuple[int, int]) -> bytes:
+        # Chrome is passed the page on its command line, so it is written to a file of its own instead
+        html_file = Path(self._output_directory.name, f"{next(self._output_names)}.html")
+        html_file.write_text(html)
+        try:
+            return self._screenshot(html_file.as_uri(), size)
+        finally:
+            html_file.unlink(missing_ok=True)
+
+    async def render_html(self, html: str, size: tuple[int, int]) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._screenshot_html, html, size)
+
+    async def render_url(self, url: str, size: tuple[int, int]) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._screenshot, url, size)
+
+
+class DevToolsRenderer(BrowserCardRenderer):
+    """Keeps one headless Chrome process alive, and renders each card in a fresh page over the DevTools protocol.
+    Up to worker_count pages are rendered at once. If the browser dies or its connection drops,
+    it is relaunched by the next render. If a render takes longer than render_timeout, the browser is taken to be
+    hung: it is killed, and the render is retried once in a new browser."""
+
+    browser_flags = [
+        "--headless=new",
+        "--disable-gpu",
+        "--hide-scrollbars",
+        "--default-background-color=00000000",
+        "--no-first-run",
+        "--no-default-browser-check",
+        "--remote-debugging-port=0"
+    ]
+    launch_timeout = 15.0
+    launch_poll_interval = 0.05
+    render_timeout = 15.0
+    close_page_timeout = 2.0
+
+    def __init__(self, worker_count: int = 2, executable: Optional[str] = None):
+        super().__init__(worker_count)
+        self.executable = executable
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._profile_directory: Optional[TemporaryDirectory] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._message_ids = itertools.count(1)
+        self._responses: dict[int, asyncio.Future] = {}
+        self._page_loads: dict[str, asyncio.Future] = {}
+        self._start_lock = asyncio.Lock()
+        # counts the browsers launched, so that a render only restarts the browser that it found hung
+        self._generation = 0
+
+    @property
+    def running(self) -> bool:
+        return (self._process is not None and self._process.returncode is None
+                and self._websocket is not None and not self._websocket.closed)
+
+    async def start(self) -> None:
+        async with self._start_lock:
+            if self.running:
+                return
+            await self._stop()
+            await self._launch()
+
+    async def close(self) -> None:
+        async with self._start_lock:
+            await self._stop()
+
+    async def _stop_hung(self, generation: int) -> None:
+        """Stop the browser, unless another render has already restarted it since it hung."""
+        async with self._start_lock:
+            if self._generation == generation:
+                await self._stop()
+
+    async def _launch(self) -> None:
+        if self.executable is None:
+            from html2image.browsers.search_utils import find_chrome
+            self.executable = find_chrome()
+
+        flags = list(self.browser_flags)
+        # Chrome refuses to run as root with its sandbox enabled; there is no root to speak of on Windows
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            flags.append("--no-sandbox")
+        self._profile_directory = TemporaryDirectory(prefix="card-renderer-")
+        flags.append(f"--user-data-dir={self._profile_directory.name}")
+
+        # Chrome logs to its output streams for as long as it runs, so neither is piped, lest it fill and block Chrome
+        self._process = await asyncio.create_subprocess_exec(self.executable, *flags, "about:blank",
+                                                             stdout=asyncio.subprocess.DEVNULL,
+                                                             stderr=asyncio.subprocess.DEVNULL)
+        websocket_url = await asyncio.wait_for(self._read_websocket_url(), self.launch_timeout)
+
+        self._session = aiohttp.ClientSession()
+        self._websocket = await self._session.ws_connect(websocket_url, max_msg_size=0)
+        self._reader = asyncio.get_running_loop().create_task(self._read_messages())
+        self._generation += 1
+        logging.info(f"Started card renderer browser (pid {self._process.pid})")
+
+    async def _read_websocket_url(self) -> str:
+        """Wait for Chrome to write the port and path it is listening on to DevToolsActivePort in its profile."""
+        active_port_file = Path(self._profile_directory.name, "DevToolsActivePort")
+        while True:
+            if self._process.returncode is not None:
+                raise ConnectionError("The card renderer browser exited during startup.")
+            try:
+                port, path = active_port_file.read_text().split()[:2]
+                return f"ws://127.0.0.1:{port}{path}"
+            except (OSError, ValueError):
+                # not written yet, or only partly written
+                await asyncio.sleep(self.launch_poll_interval)
+
+    async def _stop(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._websocket is not None:
+            await self._websocket.close()
+            self._websocket = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._process is not None:
+            if self._process.returncode is None:
+                self._process.kill()
+            await self._process.wait()
+            self._process = None
+        if self._profile_directory is not None:
+            self._profile_directory.cleanup()
+            self._profile_directory = None
+        self._fail_pending(ConnectionError("The card renderer browser was stopped."))
+
+    def _fail_pending(self, error: Exception) -> None:
+        for future in itertools.chain(self._responses.values(), self._page_loads.values()):
+            if not future.done():
+                future.set_exception(error)
+        self._responses.clear()
+        self._page_loads.clear()
+
+    async def _read_messages(self) -> None:
+        try:
+            async for message in self._websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = message.json()
+
+                if "id" in data:
+                    future = self._responses.pop(data["id"], None)
+                    if future is None or future.done():
+                        continue
+                    if "error" in data:
+                        future.set_exception(RuntimeError(f"DevTools error: {data['error']}"))
+                    else:
+                        future.set_result(data.get("result", {}))
+                elif data.get("method") == "Page.loadEventFired":
+                    future = self._page_loads.pop(data.get("sessionId"), None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+        finally:
+            self._fail_pending(ConnectionError("Lost connection to the card renderer browser."))
+        logging.warning("Lost connection to the card renderer browser")
+
+    async def _send(self, method: str, params: Optional[dict[str, Any]] = None,
+                    session_id: Optional[str] = None) -> dict[str, Any]:
+        message_id = next(self._message_ids)
+        message = {"id": message_id, "method": method, "params": params or {}}
+        if session_id is not None:
+            message["sessionId"] = session_id
+
+        future = asyncio.get_running_loop().create_future()
+        self._responses[message_id] = future
+        try:
+            await self._websocket.send_json(message)
+            return await future
+        finally:
+            self._responses.pop(message_id, None)
+
+    async def _render_page(self, url: str, size: tuple[int, int]) -> bytes:
+        target_id = (await self._send("Target.createTarget", {"url": "about:blank"}))["targetId"]
+        try:
+            png_bytes = await self._capture_page(target_id, url, size)
+        except asyncio.CancelledError:
+            # the render timed out, and the browser may be hung; the page is closed with it when it is restarted
+            raise
+        except Exception:
+            await self._close_page(target_id)
+            raise
+        await self._close_page(target_id)
+        return png_bytes
+
+    async def _capture_page(self, target_id: str, url: str, size: tuple[int, int]) -> bytes:
+        session_id = (await self._send("Target.attachToTarget", {"targetId": target_id, "flatten": True}))["sessionId"]
+        width, height = size
+        await self._send("Emulation.setDeviceMetricsOverride",
+                         {"width": width, "height": height, "deviceScaleFactor": 1, "mobile": False}, session_id)
+        await self._send("Emulation.setDefaultBackgroundColorOverride",
+                         {"color": {"r": 0, "g": 0, "b": 0, "a": 0}}, session_id)
+        await self._send("Page.enable", session_id=session_id)
+
+        page_loaded = asyncio.get_running_loop().create_future()
+        self._page_loads[session_id] = page_loaded
+        try:
+            await self._send("Page.navigate", {"url": url}, session_id)
+            await page_loaded
+        finally:
+            self._page_loads.pop(session_id, None)
+
+        screenshot = await self._send("Page.captureScreenshot", {"format": "png"}, session_id)
+        return base64.b64decode(screenshot["data"])
+
+    async def _close_page(self, target_id: str) -> None:
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._send("Target.closeTarget", {"targetId": target_id}), self.close_page_timeout)
+        except (asyncio.TimeoutError, ConnectionError, RuntimeError) as error:
+            logging.warning(f"Failed to close a card renderer page: {error!r}")
+
+    async def render_url(self, url: str, size: tuple[int, int]) -> bytes:
+        for attempt in range(2):
+            await self.start()
+            generation = self._generation
+            try:
+                return await asyncio.wait_for(self._render_page(url, size), self.render_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Card renderer browser did not render a card within {self.render_timeout}s, "
+                                f"restarting it")
+                await self._stop_hung(generation)
+                if attempt == 1:
+                    raise
+            except ConnectionError:
+                if attempt == 1:
+                    raise
+                logging.warning("Card renderer browser went away mid-render, restarting it")
+
+
+class PillowCardRenderer(CardRenderer):
+    """Draws cards natively with Pillow from the card's template fields, with no browser involved.
+    Cards are painted in a pool of worker processes, so that painting holds neither the event loop nor the GIL."""
+
+    def __init__(self, worker_count: int = 2):
+        super().__init__(worker_count)
+        self._executor: Optional[Executor] = None
+
+    async def start(self) -> None:
+        if self._executor is None:
+            # spawned rather than forked, as forking would copy the bot's running event loop and threads
+            self._executor = ProcessPoolExecutor(self.worker_count, mp_context=multiprocessing.get_context("spawn"))
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def _render(self, card: UserDisplayCard) -> bytes:
+        await self.start()
+        # a card whose avatar could not be loaded is drawn with a placeholder
+        return await asyncio.get_running_loop().run_in_executor(self._executor, paint_card, card.card_type.name,
+                                                                card.get_card_fields(), card.avatar_png)
+
+
+card_renderer_backends = {"html2image": Html2ImageRenderer,
+                          "devtools": DevToolsRenderer,
+                          "pillow": PillowCardRenderer}
+default_card_render_workers = 2
+_card_renderer: Optional[CardRenderer] = None
+
+
+def get_card_renderer() -> CardRenderer:
+    """The shared card renderer, whose backend is chosen by the XP_CARD_RENDERER environment variable:
+    devtools (the default), html2image or pillow. XP_CARD_RENDER_WORKERS sets how many cards it renders at once."""
+    global _card_renderer
+    if _card_renderer is None:
+        backend_name = os.getenv("XP_CARD_RENDERER", "devtools")
+        worker_count = int(os.getenv("XP_CARD_RENDER_WORKERS", default_card_render_workers))
+        try:
+            backend = card_renderer_backends[backend_name]
+        except KeyError:
+            raise ValueError(f"Unknown card renderer {backend_name!r}, "
+                             f"expected one of {', '.join(card_renderer_backends.keys())}")
+        _card_renderer = backend(worker_count)
+    return _card_renderer
+
+
+async def close_card_renderer() -> None:
+    global _card_renderer
+    if _card_renderer is None:
+        return
+    await _card_renderer.close()
+    logging.info(f"Closed card renderer: {_card_renderer.metrics.summary()}")
+    _card_renderer = None
+
@@ -0,0 +1,91 @@
+from __future__ import annotations
+from typing import Any, Optional
+from pathlib import Path
+from string import Formatter
+import hashlib
+import logging
+import re
+
+
+class CompiledCardTemplate:
+    """A card template read and parsed once, as alternating literal text and field segments.
+    Stylesheets linked by the template are inlined into its literal text, so that a formatted card is
+    a self-contained page. The template and its stylesheets are its dependencies: if any of their
+    modification times change, the template is stale and should be compiled again.
+
+    version is a hash of the compiled template, which changes whenever its rendered output could."""
+
+    __slots__ = (
+        "path",
+        "segments",
+        "dependency_mtimes",
+        "version"
+    )
+
+    stylesheet_link_pattern = re.compile(r'<link rel="stylesheet" href="([^"]+)">')
+    conversions = {"r": repr, "s": str, "a": ascii}
+
+    def __init__(self, path: Path):
+        self.path = path
+        dependencies = [path]
+        # (literal text, field name, format spec, conversion) of each segment, with no field after the last literal
+        self.segments: list[tuple[str, Optional[str], Optional[str], Optional[str]]] = []
+
+        for literal, field_name, format_spec, conversion in Formatter().parse(path.read_text()):
+            if field_name is not None and not field_name.isidentifier():
+                raise ValueError(f"Card template {path} has an unsupported field {{{field_name}}}")
+            literal = self._inline_stylesheets(literal, dependencies)
+            self.segments.append((literal, field_name, format_spec, conversion))
+
+        self.dependency_mtimes = {dependency: dependency.stat().st_mtime_ns for dependency in dependencies}
+        self.version = hashlib.sha256(repr(self.segments).encode()).hexdigest()
+
+    def _inline_stylesheets(self, literal: str, dependencies: list[Path]) -> str:
+        def inline_stylesheet(link: re.Match) -> str:
+            stylesheet_path = Path(self.path.parent, link.group(1))
+            dependencies.append(stylesheet_path)
+            return f"<style>{stylesheet_path.read_text()}</style>"
+
+        return self.stylesheet_link_pattern.sub(inline_stylesheet, literal)
+
+    def is_stale(self) -> bool:
+        for dependency, mtime in self.dependency_mtimes.items():
+            try:
+                if dependency.stat().st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def format(self, **fields: Any) -> str:
+        parts = []
+        for literal, field_name, format_spec, conversion in self.segments:
+            parts.append(literal)
+            if field_name is None:
+                continue
+            value = fields[field_name]
+            if conversion:
+                value = self.conversions[conversion](value)
+            parts.append(format(value, format_spec))
+        return "".join(parts)
+
+
+class CardTemplateCache:
+    """Compiled card templates by path, each compiled again only when it has gone stale."""
+
+    __slots__ = (
+        "_templates",
+    )
+
+    def __init__(self):
+        self._templates: dict[Path, CompiledCardTemplate] = {}
+
+    def get(self, path: Path) -> CompiledCardTemplate:
+        template = self._templates.get(path)
+        if template is not None and not template.is_stale():
+            return template
+
+        template = CompiledCardTemplate(path)
+        self._templates[path] = template
+        logging.debug(f"Compiled card template {path} (version {template.version[:12]})")
+        return template
@@ -4,14 +4,18 @@ from discord import app_commands
 from bot.common import extension_setup
 from bot.exceptions import standard_error_handling
 from bot.cogs.xp.main import XPCommandCog, ExperienceMember
-from bot.cogs.xp.card_generator import UserDisplayCard, UserDisplayCardType
+from bot.cogs.xp.card_generator import RenderPriority, UserDisplayCard, UserDisplayCardType, get_render_scheduler
+from bot.cogs.xp.announcement_batcher import AnnouncementBatcher, LevelUpAnnouncementMode
 
 
 class AnnounceLevelUps(XPCommandCog):
+    announcement_send_interval = 1.0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.announce_command_group: Optional[app_commands.Group] = None
         self.level_up_channel: Optional[discord.abc.MessageableChannel] = None
+        self.announcements = AnnouncementBatcher(self.announcement_send_interval)
 
     async def cog_load(self) -> None:
         await super().cog_load()
@@ -19,7 +23,14 @@ class AnnounceLevelUps(XPCommandCog):
             self.level_up_channel = await self.bot.lookup_channel(self.handler.announce_level_up_channel_id)
         except TypeError:
             self.level_up_channel = None
+        self.announcements.channel = self.level_up_channel
+        self.announcements.mode = LevelUpAnnouncementMode(self.handler.announce_level_up_mode)
         self.handler.level_up_event.subscribe(self.level_up_announcement)
+        self.handler.level_ups_handled_event.subscribe(self.send_collected_announcements)
+        self.handler.level_up_approaching_event.subscribe(self.prerender_level_up_cards)
+
+    async def cog_unload(self) -> None:
+        await self.announcements.close()
 
     def create_groups(self) -> None:
         self.announce_command_group = app_commands.Group(name="announce",
@@ -47,7 +58,7 @@ class AnnounceLevelUps(XPCommandCog):
                 return
 
             previous_channel = self.level_up_channel
-            self.set_level_up_channel(channel)
+            await self.set_level_up_channel(channel)
 
             if previous_channel is None:
                 await interaction.response.send_message(f"Enabled level-up announcements, will post to {channel.mention}.")
@@ -70,25 +81,77 @@ class AnnounceLevelUps(XPCommandCog):
                 await interaction.response.send_message(f"Level-up announcements are already disabled.")
                 return
 
-            self.set_level_up_channel(None)
+            await self.set_level_up_channel(None)
 
             await interaction.response.send_message("Level-up announcements have been disabled.")
 
-    def set_level_up_channel(self, channel: Optional[discord.TextChannel]):
+        @self.announce_command_group.command(name="mode")
+        @app_commands.default_permissions(manage_guild=True)
+        @app_commands.choices(mode=[
+            app_commands.Choice(name="immediate", value=LevelUpAnnouncementMode.Immediate.value),
+            app_commands.Choice(name="digest", value=LevelUpAnnouncementMode.Digest.value),
+            app_commands.Choice(name="composite", value=LevelUpAnnouncementMode.Composite.value)
+        ])
+        @standard_error_handling
+        async def set_announcement_mode(interaction: discord.Interaction,
+                                        mode: app_commands.Choice[int]):
+            """Choose how level-up announcements are grouped into messages.
+
+            Parameters
+            ----------
+            interaction : discord.Interaction
+                The interaction object.
+            mode : app_commands.Choice[int]
+                Immediate sends each level-up as it happens; digest collects the level-ups of each XP flush into
+                messages of up to ten cards; composite is digest with each message's cards stacked into one image."""
+
+            await self.set_announcement_mode(LevelUpAnnouncementMode(mode.value))
+
+            await interaction.response.send_message(f"Level-up announcements will be sent in {mode.name} mode.")
+
+    async def set_level_up_channel(self, channel: Optional[discord.TextChannel]):
         self.level_up_channel = channel
+        self.announcements.channel = channel
         if channel:
             self.handler.announce_level_up_channel_id = channel.id
         else:
             self.handler.announce_level_up_channel_id = None
-        self.handler.save_all_guild_data()
-
-    async def level_up_announcement(self, member: ExperienceMember, leveled_to: int) -> None:
+        await self.handler.save_all_guild_data()
+
+    async def set_announcement_mode(self, mode: LevelUpAnnouncementMode):
+        self.announcements.mode = mode
+        if mode == LevelUpAnnouncementMode.Immediate:
+            await self.announcements.flush()
+        self.handler.announce_level_up_mode = mode.value
+        await self.handler.save_all_guild_data()
+
+    async def prerender_level_up_cards(self, members: list[ExperienceMember], gains: list[float]) -> None:
+        """Pre-render the card each member is predicted to be announced with on their next level-up.
+        A member is predicted to keep gaining what they just gained until they reach their next level, and to keep
+        their rank. A card is only used if its shown fields match the real level-up's exactly, so a member whose gains
+        vary (a scalar role, a voice reward) by more than the card's XP rounding, or whose rank changes as they level
+        up, is announced with a freshly rendered card instead."""
+        if not self.level_up_channel:
+            return
+        render_scheduler = get_render_scheduler()
+        for member, gain in zip(members, gains):
+            predicted_member = ExperienceMember.cast_from_member(member, self.handler)
+            predicted_member.level = member.level + 1
+            predicted_member.xp_quantity = member.predict_level_up_experience(gain)
+            predicted_member.rank = member.rank
+            render_scheduler.prerender(UserDisplayCard(predicted_member, UserDisplayCardType.LevelUp))
+
+    async def send_collected_announcements(self) -> None:
+        """Send the level-up cards collected in digest and composite modes. They are sent in the background,
+        so that a long backlog is not cut short by the event's subscriber timeout."""
+        self.announcements.start_flush()
+
+    async def level_up_announcement(self, member: ExperienceMember, leveled_to: int, leveled_from: int) -> None:
         if not self.level_up_channel:
             return
         member.level = leveled_to
         display_card = UserDisplayCard(member, UserDisplayCardType.LevelUp)
-        with display_card.get_png_card() as png_card:
-            await self.level_up_channel.send(file=discord.File(png_card.file))
+        self.announcements.add(display_card.filename, await display_card.get_png_card(RenderPriority.Background))
 
 
 setup = extension_setup(AnnounceLevelUps)
@@ -1,21 +1,65 @@
-from typing import Optional, Any
+from __future__ import annotations
+from typing import Optional
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import asyncio
+import json
 import logging
 import discord
 from discord import app_commands
 from bot.common import extension_setup
 from bot.exceptions import standard_error_handling
 from bot.cogs.xp.main import XPCommandCog, ExperienceMember
+from bot.cogs.xp.role_mutation_queue import RoleMutationQueue
+
+
+@dataclass
+class ReconciliationProgress:
+    last_member_id: int = 0
+    examined: int = 0
+    edited: int = 0
+    failed: int = 0
+    total: int = 0
+
+    def summary(self) -> str:
+        summary = f"examined `{self.examined}` of `{self.total}` members and edited `{self.edited}`"
+        if self.failed:
+            summary += f" (`{self.failed}` failed)"
+        return summary
 
 
 class AutoroleCommands(XPCommandCog):
+    reconciliation_checkpoint_filename = "autorole-reconciliation.json"
+    reconciliation_checkpoint_every = 25
+    reconciliation_edit_interval = 1.0
+    reconciliation_maximum_edit_interval = 30.0
+    role_mutation_window = 2.0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.autorole_command_group: Optional[app_commands.Group] = None
+        self.reconciliation_checkpoint_path: Optional[Path] = None
+        self.reconciliation_task: Optional[asyncio.Task] = None
+        self.reconciliation_progress: Optional[ReconciliationProgress] = None
+        self.reconciliation_report: Optional[discord.Interaction] = None
+        self.role_mutations = RoleMutationQueue(self.bot, self.role_mutation_window)
 
     async def cog_load(self, *args, **kwargs) -> None:
         await super().cog_load(*args, **kwargs)
         self.handler.level_up_event.subscribe(self.update_user_roles_on_level_up)
-        self.handler.level_changed_event.subscribe(self.refresh_experience_member_autoroles)
+        self.handler.level_changed_event.subscribe(self.refresh_autoroles_on_level_change)
+
+        self.reconciliation_checkpoint_path = Path(self.handler.data_directory,
+                                                   self.reconciliation_checkpoint_filename).resolve()
+        progress = self.load_reconciliation_checkpoint()
+        if progress is not None:
+            logging.info(f"Resuming autorole reconciliation after member {progress.last_member_id}")
+            self.start_reconciliation(progress)
+
+    async def cog_unload(self) -> None:
+        if self.reconciliation_task is not None:
+            self.reconciliation_task.cancel()
+        await self.role_mutations.close()
 
     def create_groups(self) -> None:
         self.autorole_command_group = app_commands.Group(
@@ -48,7 +92,7 @@ class AutoroleCommands(XPCommandCog):
             """
             if remove_at is None:
                 remove_at = 0
-            self.handler.create_autorole(role, assign_at, remove_at)
+            await self.handler.create_autorole(role, assign_at, remove_at)
             await interaction.response.send_message(f"Successfully created autorole rule for {role.mention}.")
 
         @self.autorole_command_group.command(name="modify")
@@ -71,7 +115,7 @@ class AutoroleCommands(XPCommandCog):
             remove_at : Optional[int]
                 The XP level that the role will be removed at.
             """
-            self.handler.modify_autorole(role, assign_at, remove_at)
+            await self.handler.modify_autorole(role, assign_at, remove_at)
             await interaction.response.send_message(f"Successfully updated {role.mention}'s autorole rule.")
 
         @self.autorole_command_group.command(name="remove")
@@ -88,7 +132,7 @@ class AutoroleCommands(XPCommandCog):
             role : discord.Role
                 The role to stop assigning.
             """
-            self.handler.remove_autorole(role)
+            await self.handler.remove_autorole(role)
             await interaction.response.send_message(f"Successfully removed {role.mention}'s autorole rule.")
 
         @self.autorole_command_group.command(name="summary")
@@ -135,64 +179,170 @@ class AutoroleCommands(XPCommandCog):
             await self.refresh_member_autoroles(member)
             await interaction.response.send_message(f"Successfully refreshed {member.mention}'s XP level autoroles.")
 
-    def map_role_ids_to_roles(self, role_ids: [int]) -> [discord.Role]:
-        return map(self.bot.guild.get_role, role_ids)
-
-    def get_auto_role_ids_by_condition(self, condition: str, fields: tuple[Any, ...]) -> [int]:
-        rows = self.handler.basic_database_query(self.handler.sql_commands.select_auto_roles_by_condition(("roleid",), condition), fields, -1)
-        return map(lambda x: x["roleid"], rows)
-
-    def get_comprehensive_role_ids_to_assign(self, at_level: int) -> [int]:
-        """Returns all role IDs that some arbitrary user of XP level at_level should be assigned."""
-        return self.get_auto_role_ids_by_condition("assign_at<=? AND (remove_at>? OR remove_at<=0)", (at_level, at_level))
+        @self.autorole_command_group.command(name="reconcile")
+        @app_commands.default_permissions(manage_guild=True)
+        @standard_error_handling
+        async def reconcile(interaction: discord.Interaction):
+            """Refresh every member's XP autoroles in the background, or show the progress of a refresh already running.
 
-    def get_comprehensive_role_ids_to_deassign(self, at_level: int) -> [int]:
-        """Returns all role IDs that some arbitrary user of XP level at_level should be deassigned."""
-        return self.get_auto_role_ids_by_condition("assign_at >? OR (remove_at<=? AND remove_at>0)", (at_level, at_level))
+            Parameters
+            ----------
+            interaction : discord.Interaction
+                The interaction object.
+            """
+            if self.reconciliation_running:
+                await interaction.response.send_message(
+                    f"Autorole reconciliation in progress: {self.reconciliation_progress.summary()}.")
+                return
 
-    def get_role_ids_to_assign(self, at_level: int) -> [int]:
-        """Returns role IDs that should be newly assigned at at_level."""
-        return self.get_auto_role_ids_by_condition("assign_at=?", (at_level,))
+            self.reconciliation_report = interaction
+            self.start_reconciliation()
+            await interaction.response.send_message("Started reconciling every member's XP autoroles.")
 
-    def get_role_ids_to_deassign(self, at_level: int) -> [int]:
-        return self.get_auto_role_ids_by_condition("remove_at=?", (at_level,))
+    def map_role_ids_to_roles(self, role_ids: [int]) -> [discord.Role]:
+        return [role for role in map(self.bot.guild.get_role, role_ids) if role is not None]
 
     def get_comprehensive_roles_to_assign(self, at_level: int) -> [discord.Role]:
-        ids = self.get_comprehensive_role_ids_to_assign(at_level)
-        return self.map_role_ids_to_roles(ids)
+        """Returns all roles that some arbitrary user of XP level at_level should be assigned."""
+        return self.map_role_ids_to_roles(self.handler.autorole_index.role_ids_at(at_level))
 
     def get_comprehensive_roles_to_deassign(self, at_level: int) -> [discord.Role]:
-        ids = self.get_comprehensive_role_ids_to_deassign(at_level)
-        return self.map_role_ids_to_roles(ids)
+        """Returns all roles that some arbitrary user of XP level at_level should be deassigned."""
+        return self.map_role_ids_to_roles(self.handler.autorole_index.role_ids_not_at(at_level))
 
-    def get_roles_to_assign(self, at_level: int) -> [discord.Role]:
-        ids = self.get_role_ids_to_assign(at_level)
-        return self.map_role_ids_to_roles(ids)
+    def queue_role_changes(self, member: discord.Member, to_assign: set[discord.Role],
+                           to_deassign: set[discord.Role], reason: str) -> None:
+        """Queue roles to add to and remove from a member. Changes queued for the same member in quick succession,
+        e.g. by a level-up followed by /xp set, are merged and applied as one role edit."""
+        self.role_mutations.add_roles(member, to_assign, reason=reason)
+        self.role_mutations.remove_roles(member, to_deassign, reason=reason)
 
-    def get_roles_to_deassign(self, at_level: int) -> [discord.Role]:
-        ids = self.get_role_ids_to_deassign(at_level)
-        return self.map_role_ids_to_roles(ids)
-
-    async def update_user_roles_on_level_up(self, member: ExperienceMember, new_level: int) -> None:
-        await member.add_roles(*self.get_roles_to_assign(new_level), reason="User leveled up")
-        await member.remove_roles(*self.get_roles_to_deassign(new_level), reason="User leveled up")
+    async def update_user_roles_on_level_up(self, member: ExperienceMember, new_level: int, old_level: int) -> None:
+        role_ids_to_assign, role_ids_to_deassign = self.handler.autorole_index.diff(old_level, new_level)
+        set_member_roles = set(member.roles)
+        self.queue_role_changes(member,
+                                set(self.map_role_ids_to_roles(role_ids_to_assign)).difference(set_member_roles),
+                                set(self.map_role_ids_to_roles(role_ids_to_deassign)).intersection(set_member_roles),
+                                "User leveled up")
 
     async def refresh_member_autoroles(self, member: discord.Member) -> None:
-        experience_member = self.handler.convert_to_experience_member(member)
+        experience_member = await self.handler.convert_to_experience_member(member)
         await self.refresh_experience_member_autoroles(experience_member)
+        await self.role_mutations.apply(member.id)
+
+    async def refresh_autoroles_on_level_change(self, member: ExperienceMember, new_level: int,
+                                                _old_level: int) -> None:
+        """An admin may set a member's XP whatever roles they hold, so their autoroles are refreshed at their new
+        level, rather than diffed from their old one as on a level-up."""
+        await self.refresh_experience_member_autoroles(member, new_level)
 
-    async def refresh_experience_member_autoroles(self, member: ExperienceMember, member_level: Optional[int] = None) -> None:
-        # iterate through all autorole rules, separate them into bins of "should" and "shouldn't" be assigned at x level
-        should_be_assigned = set(self.get_comprehensive_roles_to_assign(member.level))
-        should_not_be_assigned = set(self.get_comprehensive_roles_to_deassign(member.level))
-        # figure out which ones the member already has (remove them from the "should assign" bin)
+    async def refresh_experience_member_autoroles(self, member: ExperienceMember,
+                                                  new_level: Optional[int] = None) -> None:
+        if new_level is None:
+            new_level = member.level
+        # bin the managed roles into "should" and "shouldn't" be assigned at the member's level
+        should_be_assigned = set(self.get_comprehensive_roles_to_assign(new_level))
+        should_not_be_assigned = set(self.get_comprehensive_roles_to_deassign(new_level))
+        # only assign the ones the member lacks, and deassign the ones they have
         set_member_roles = set(member.roles)
         to_assign = should_be_assigned.difference(set_member_roles)
-        # figure out which of the "shouldn't" ones the member doesn't have (remove them from the "shouldn't be assigned" bin)
-        to_deassign = should_not_be_assigned.intersection(set(member.roles))
-        # do the assigning / deassigning of whatever is left
-        await member.add_roles(*to_assign, reason="Refreshed user's XP autoroles")
-        await member.remove_roles(*to_deassign, reason="Refreshed user's XP autoroles")
+        to_deassign = should_not_be_assigned.intersection(set_member_roles)
+        self.queue_role_changes(member, to_assign, to_deassign, "Refreshed user's XP autoroles")
+
+    def get_reconciled_roles(self, member: discord.Member) -> Optional[list[discord.Role]]:
+        """Query the full role list a member should have for their stored level, or None if theirs is already right.
+        Roles not managed by any autorole rule are kept as they are."""
+        autorole_index = self.handler.autorole_index
+        target_roles = self.map_role_ids_to_roles(autorole_index.role_ids_at(self.handler.get_cached_experience(member.id)[1]))
+        held_managed_roles = {role for role in member.roles if role.id in autorole_index.role_ids}
+        if held_managed_roles == set(target_roles):
+            return None
+
+        kept_roles = [role for role in member.roles if role.id not in autorole_index.role_ids and not role.is_default()]
+        return kept_roles + target_roles
+
+    @property
+    def reconciliation_running(self) -> bool:
+        return self.reconciliation_task is not None and not self.reconciliation_task.done()
+
+    def start_reconciliation(self, progress: Optional[ReconciliationProgress] = None) -> None:
+        self.reconciliation_progress = progress or ReconciliationProgress()
+        self.reconciliation_task = self.bot.loop.create_task(self.reconcile_autoroles(self.reconciliation_progress))
+
+    def load_reconciliation_checkpoint(self) -> Optional[ReconciliationProgress]:
+        try:
+            with open(self.reconciliation_checkpoint_path, "r") as readfile:
+                return ReconciliationProgress(**json.load(readfile))
+        except FileNotFoundError:
+            return None
+        except (json.decoder.JSONDecodeError, TypeError) as error:
+            logging.error(f"Discarding unreadable autorole reconciliation checkpoint: {error}")
+            return None
+
+    def dump_reconciliation_checkpoint(self, progress: ReconciliationProgress) -> None:
+        with open(self.reconciliation_checkpoint_path, "w") as writefile:
+            json.dump(asdict(progress), writefile, indent=2)
+
+    async def report_reconciliation_progress(self, progress: ReconciliationProgress, finished: bool = False) -> None:
+        if finished:
+            logging.info(f"Autorole reconciliation finished: {progress.summary()}")
+        if self.reconciliation_report is None:
+            return
+
+        state = "Finished reconciling" if finished else "Reconciling"
+        try:
+            await self.reconciliation_report.edit_original_response(
+                content=f"{state} every member's XP autoroles: {progress.summary()}.")
+        except discord.HTTPException:
+            # interaction tokens expire after 15 minutes, after which progress is only available on request
+            self.reconciliation_report = None
+
+    async def reconcile_autoroles(self, progress: ReconciliationProgress) -> None:
+        """Give every member exactly the autoroles of their stored level, one role edit per member that differs.
+        Members are visited in user ID order from the guild's member cache, and progress is checkpointed
+        so that a restart resumes where it left off.
+
+        Edits are spaced out by an interval that doubles whenever an edit is slow, which means the library
+        has waited out the member route's rate limit, and halves back towards its base when edits are quick."""
+        await self.bot.wait_until_ready()
+        guild = self.bot.cached_guild
+        members = sorted((member for member in guild.members if member.id > progress.last_member_id and not member.bot),
+                         key=lambda member: member.id)
+        progress.total = progress.examined + len(members)
+        edit_interval = self.reconciliation_edit_interval
+        loop = asyncio.get_running_loop()
+
+        try:
+            for member in members:
+                roles = self.get_reconciled_roles(member)
+                if roles is not None:
+                    edit_start = loop.time()
+                    try:
+                        await member.edit(roles=roles, reason="Reconciled user's XP autoroles")
+                        progress.edited += 1
+                    except discord.HTTPException as error:
+                        logging.error(f"Failed to reconcile autoroles of user with id {member.id}: {error}")
+                        progress.failed += 1
+                    edit_time = loop.time() - edit_start
+
+                    if edit_time > edit_interval:
+                        edit_interval = min(edit_interval * 2, self.reconciliation_maximum_edit_interval)
+                    else:
+                        edit_interval = max(edit_interval / 2, self.reconciliation_edit_interval)
+                    await asyncio.sleep(max(edit_interval - edit_time, 0))
+
+                progress.examined += 1
+                progress.last_member_id = member.id
+                if progress.examined % self.reconciliation_checkpoint_every == 0:
+                    self.dump_reconciliation_checkpoint(progress)
+                    await self.report_reconciliation_progress(progress)
+        except asyncio.CancelledError:
+            self.dump_reconciliation_checkpoint(progress)
+            raise
+
+        self.reconciliation_checkpoint_path.unlink(missing_ok=True)
+        await self.report_reconciliation_progress(progress, finished=True)
+        self.reconciliation_report = None
 
 
 setup = extension_setup(AutoroleCommands)
@@ -0,0 +1,30 @@
+import discord
+from bot.common import extension_setup
+from bot.cogs.xp.main import XPCommandCog
+from bot.cogs.xp.card_renderer import get_card_renderer
+from bot.cogs.xp.card_cache import get_card_render_cache
+from bot.cogs.xp.card_generator import get_render_scheduler
+
+
+class CardStatsCommand(XPCommandCog):
+    def register_commands(self):
+        @self.command_group_cog.admin_xp_commands.command(name="cards")
+        async def cards(interaction: discord.Interaction):
+            """Show card rendering and render cache statistics.
+
+            Parameters
+            ----------
+            interaction : discord.Interaction
+                The interaction object.
+            """
+
+            renderer = get_card_renderer()
+            await interaction.response.send_message(
+                f"Renderer `{type(renderer).__name__}` with `{renderer.worker_count}` workers: "
+                f"{renderer.metrics.summary()}\n"
+                f"Scheduler: {get_render_scheduler().summary()}\n"
+                f"Render cache: {get_card_render_cache().summary()}"
+            )
+
+
+setup = extension_setup(CardStatsCommand)
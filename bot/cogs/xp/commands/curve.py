@@ -15,7 +15,8 @@ class CurveCommand(XPCommandCog):
         async def curve(interaction: discord.Interaction,
                         scalar: Optional[float],
                         power: Optional[float],
-                        maintain: Optional[app_commands.Choice[int]] = 0):
+                        maintain: Optional[app_commands.Choice[int]] = 0,
+                        dry_run: bool = False):
             """Update the level XP requirement curve.
             Level XP Requirement = scalar * Level ** power
             Users' XP quantities or levels will be updated accordingly; this command is destructive.
@@ -30,15 +31,24 @@ class CurveCommand(XPCommandCog):
                 The power in the requirement curve expression.
             maintain : Optional[app_commands.Choice[int]]
                 Whether to maintain users' level progress or XP quantity.
+            dry_run : bool
+                Whether to only report how many members' levels would change, without changing the curve.
             """
 
             if type(maintain) is app_commands.Choice:
                 maintain = maintain.value
             maintain = bool(maintain)
 
-            self.handler.update_level_curve(scalar, power, maintain)
+            await interaction.response.defer()
 
-            await interaction.response.send_message(content=f"Successfully set new level requirement curve to `{self.handler.level_curve_scalar} * L^{self.handler.level_curve_power}`.")
+            summary = await self.handler.update_level_curve(scalar, power, maintain, dry_run)
+            level_changes = f"`{summary.levelled_up}` of `{summary.members}` members move up a level and `{summary.levelled_down}` move down."
+
+            if dry_run:
+                await interaction.followup.send(content=f"Dry run: with this curve, {level_changes}")
+                return
+
+            await interaction.followup.send(content=f"Successfully set new level requirement curve to `{self.handler.level_curve_scalar} * L^{self.handler.level_curve_power}`; {level_changes}")
 
 
 setup = extension_setup(CurveCommand)
@@ -1,10 +1,77 @@
+from __future__ import annotations
 from typing import Optional
-import sqlite3
 from math import ceil
 import discord
 from discord import app_commands
 from bot.common import extension_setup
 from bot.cogs.xp.main import XPCommandCog, ExperienceMember
+from bot.cogs.xp.leaderboard_snapshot import LeaderboardPage
+
+
+class LeaderboardView(discord.ui.View):
+    """Buttons stepping through the leaderboard a page at a time, for the member who asked for it.
+    Each page is read from the current leaderboard snapshot, continuing from the keys of the page on show,
+    so turning a page runs no queries."""
+
+    page_timeout = 300.0
+
+    def __init__(self, leaderboard_cog: LeaderboardCommands, owner_id: int, page: LeaderboardPage, page_size: int):
+        super().__init__(timeout=self.page_timeout)
+        self.leaderboard_cog = leaderboard_cog
+        self.owner_id = owner_id
+        self.page = page
+        self.page_size = page_size
+        self.message: Optional[discord.InteractionMessage] = None
+        self.update_buttons()
+
+    def update_buttons(self) -> None:
+        self.first_page.disabled = self.previous_page.disabled = not self.page.has_previous
+        self.next_page.disabled = self.last_page.disabled = not self.page.has_next
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id == self.owner_id:
+            return True
+        await interaction.response.send_message("Only the member who asked for this leaderboard can turn its pages.",
+                                                ephemeral=True)
+        return False
+
+    async def show_page(self, interaction: discord.Interaction, page: LeaderboardPage) -> None:
+        if not page.rows:
+            # everyone past the cursor has left the leaderboard since this page was shown
+            page = self.leaderboard_cog.handler.get_leaderboard_snapshot().last_page(self.page_size)
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=await self.leaderboard_cog.leaderboard_page_embed(page), view=self)
+
+    @discord.ui.button(emoji="\N{BLACK LEFT-POINTING DOUBLE TRIANGLE}", style=discord.ButtonStyle.secondary)
+    async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        snapshot = self.leaderboard_cog.handler.get_leaderboard_snapshot()
+        await self.show_page(interaction, snapshot.page_after(None, self.page_size))
+
+    @discord.ui.button(emoji="\N{BLACK LEFT-POINTING TRIANGLE}", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        snapshot = self.leaderboard_cog.handler.get_leaderboard_snapshot()
+        await self.show_page(interaction, snapshot.page_before(self.page.first_key, self.page_size))
+
+    @discord.ui.button(emoji="\N{BLACK RIGHT-POINTING TRIANGLE}", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        snapshot = self.leaderboard_cog.handler.get_leaderboard_snapshot()
+        await self.show_page(interaction, snapshot.page_after(self.page.last_key, self.page_size))
+
+    @discord.ui.button(emoji="\N{BLACK RIGHT-POINTING DOUBLE TRIANGLE}", style=discord.ButtonStyle.secondary)
+    async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        snapshot = self.leaderboard_cog.handler.get_leaderboard_snapshot()
+        await self.show_page(interaction, snapshot.last_page(self.page_size))
+
+    async def on_timeout(self) -> None:
+        if self.message is None:
+            return
+        for item in self.children:
+            item.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException:
+            pass
 
 
 class LeaderboardCommands(XPCommandCog):
@@ -31,7 +98,8 @@ class LeaderboardCommands(XPCommandCog):
             number : app_commands.Range[int, 3, 15]
                 The number of members to show.
             """
-            await interaction.response.send_message(embed=await self.leaderboard_range_embed(1, number))
+            page = self.handler.get_leaderboard_snapshot().page_after(None, number)
+            await self.send_leaderboard_page(interaction, page, number)
 
         @self.leaderboard_command_group.command(name="self")
         async def self_leaderboard(interaction: discord.Interaction,
@@ -45,28 +113,46 @@ class LeaderboardCommands(XPCommandCog):
             number : app_commands.Range[int, 3, 15]
                 The number of members to show.
             """
-            member = self.handler.convert_to_experience_member(interaction.user)
-            await interaction.response.send_message(embed=await self.leaderboard_embed_around_member(member, number))
-
-    def leaderboard_range_rows(self, from_rank: int, to_rank: int) -> [sqlite3.Row]:
-        return self.handler.basic_database_query(self.handler.sql_commands.select_many_members_by_condition(('userid', 'experience', 'experience_level', 'rank'), "rank>=? AND rank <=?"), (from_rank, to_rank), -1)
-
-    async def leaderboard_range_experience_members(self, from_rank: int, to_rank: int) -> [ExperienceMember]:
-        rows = self.leaderboard_range_rows(from_rank, to_rank)
-        members = [ExperienceMember.cast_from_member(await self.bot.lookup_member(row["userid"]), self.handler) for row in rows]
-        for member, row in zip(members, rows):
-            member.level = row["experience_level"]
-            member.xp_quantity = row["experience"]
-            member.rank = row["rank"]
-        # members.sort(key=lambda x: x.rank, reverse=True)
+            member = await self.handler.convert_to_experience_member(interaction.user)
+            page = self.leaderboard_page_around_member(member, number)
+            await self.send_leaderboard_page(interaction, page, number)
+
+    async def send_leaderboard_page(self, interaction: discord.Interaction, page: LeaderboardPage, page_size: int):
+        embed = await self.leaderboard_page_embed(page)
+        if not page.has_previous and not page.has_next:
+            await interaction.response.send_message(embed=embed)
+            return
+
+        view = LeaderboardView(self, interaction.user.id, page, page_size)
+        await interaction.response.send_message(embed=embed, view=view)
+        view.message = await interaction.original_response()
+
+    async def leaderboard_page_experience_members(self, page: LeaderboardPage) -> [ExperienceMember]:
+        lookup = await self.bot.lookup_members(user_id for _, user_id, _ in page.rows)
+        members = []
+        for rank, user_id, experience in page.rows:
+            discord_member = lookup.members.get(user_id)
+            if discord_member is None:
+                continue
+            member = ExperienceMember.cast_from_member(discord_member, self.handler)
+            member.level = self.handler.get_cached_experience(user_id)[1]
+            member.xp_quantity = experience
+            member.rank = rank
+            members.append(member)
         return members
 
-    async def leaderboard_range_embed(self, from_rank: int, to_rank: int) -> discord.Embed:
-        members = await self.leaderboard_range_experience_members(from_rank, to_rank)
+    async def leaderboard_page_embed(self, page: LeaderboardPage) -> discord.Embed:
+        members = await self.leaderboard_page_experience_members(page)
         embed = discord.Embed(title="**Server XP Leaderboard**")
         self.bot.embed_theme.apply_theme(embed)
+        if not members:
+            embed.description = "Nobody has earned any XP yet."
+            return embed
+        embed.set_footer(text=" · ".join(filter(None, [f"Ranks {page.rows[0][0]}-{page.rows[-1][0]} of {page.total}",
+                                                       embed.footer.text])),
+                         icon_url=embed.footer.icon_url)
         maximum_level_length = len(str(members[0].level))
-        maximum_rank_length = len(str(to_rank))
+        maximum_rank_length = len(str(members[-1].rank))
 
         def format_member(member: ExperienceMember) -> str:
             return f"``Rank #{member.rank:<{maximum_rank_length}} @ Level {member.level:<{maximum_level_length}}:`` {member.mention}"
@@ -75,11 +161,12 @@ class LeaderboardCommands(XPCommandCog):
 
         return embed
 
-    async def leaderboard_embed_around_member(self, member: ExperienceMember, quantity: int) -> discord.Embed:
-        midpoint = member.rank
-        lowpoint = max(midpoint-ceil(quantity/2), 1)
-        highpoint = lowpoint+quantity-1
-        return await self.leaderboard_range_embed(lowpoint, highpoint)
+    def leaderboard_page_around_member(self, member: ExperienceMember, quantity: int) -> LeaderboardPage:
+        snapshot = self.handler.get_leaderboard_snapshot()
+        if member.rank == "N/A":
+            return snapshot.page_after(None, quantity)
+        lowpoint = max(member.rank-ceil(quantity/2), 1)
+        return snapshot.page_at_rank(lowpoint, quantity)
 
 
 setup = extension_setup(LeaderboardCommands)
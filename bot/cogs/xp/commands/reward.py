@@ -29,7 +29,7 @@ class RewardCommands(XPCommandCog):
             reward: float
                 The amount of XP to be awarded following the action."""
 
-            self.handler.set_xp_reward_for_action(action.value, reward)
+            await self.handler.set_xp_reward_for_action(action.value, reward)
             await interaction.response.send_message(content=f"Successfully set XP reward for `{action.name}` to `{reward}`xp.")
 
         @self.command_group_cog.admin_xp_commands.command(name="cap")
@@ -46,7 +46,7 @@ class RewardCommands(XPCommandCog):
             cap: float
                 The maximum amount of XP that an arbitrary user can earn per minute."""
 
-            self.handler.set_xp_gain_cap(cap)
+            await self.handler.set_xp_gain_cap(cap)
             await interaction.response.send_message(content=f"Successfully set XP gain cap to `{cap}`xp per minute.")
 
 
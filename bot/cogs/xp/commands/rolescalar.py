@@ -39,7 +39,7 @@ class ScalarCommands(XPCommandCog):
             priority : int
                 The priority of the XP scalar. Higher priorities will be applied in place of lower priorities.
             """
-            self.handler.assign_role_scalar(role, power, priority)
+            await self.handler.assign_role_scalar(role, power, priority)
             await interaction.response.send_message(
                 f"Successfully assigned XP scalar `{power}` to {role.mention} with priority `{priority}`.")
 
@@ -62,7 +62,7 @@ class ScalarCommands(XPCommandCog):
             priority : int
                 The priority of the XP scalar. Higher priorities will be applied in place of lower priorities.
             """
-            self.handler.modify_role_scalar(role, power, priority)
+            await self.handler.modify_role_scalar(role, power, priority)
             await interaction.response.send_message(f"Successfully updated {role.mention}'s XP scalar.")
 
         @self.scalar_command_group.command(name="remove")
@@ -78,7 +78,7 @@ class ScalarCommands(XPCommandCog):
             role : discord.Role
                 The role whose XP scalar will be removed.
             """
-            self.handler.remove_role_scalar(role)
+            await self.handler.remove_role_scalar(role)
             await interaction.response.send_message(f"Successfully removed {role.mention}'s XP scalar.")
 
         @self.scalar_command_group.command(name="summary")
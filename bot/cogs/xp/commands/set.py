@@ -30,8 +30,11 @@ class SetExperienceCommand(XPCommandCog):
                 The positive coefficient that the user's XP will be set to.
             """
             set_type = ExperienceQuantityType(set_type.value)
-            self.handler.set_member_experience(member, coefficient, set_type)
-            await interaction.response.send_message(
+            # deferred, as the set waits for any level curve migration in progress,
+            # and for space in the level event queue
+            await interaction.response.defer()
+            await self.handler.set_member_experience(member, coefficient, set_type)
+            await interaction.followup.send(
                 f"Successfully set {member.mention}'s {set_type.name} to `{coefficient}`.")
 
         @self.command_group_cog.admin_xp_commands.command(name="add")
@@ -55,8 +58,11 @@ class SetExperienceCommand(XPCommandCog):
                 The coefficient to add to the user's XP level/quantity.
             """
             add_type = ExperienceQuantityType(add_type.value)
-            self.handler.add_member_experience(member, coefficient, add_type)
-            await interaction.response.send_message(
+            # deferred, as the addition waits for any level curve migration in progress,
+            # and for space in the level event queue
+            await interaction.response.defer()
+            await self.handler.add_member_experience(member, coefficient, add_type)
+            await interaction.followup.send(
                 f"Successfully added `{coefficient}` {add_type.name} to {member.mention}.")
 
 
@@ -2,7 +2,7 @@ import discord
 from discord import app_commands
 from bot.common import extension_setup
 from bot.cogs.xp.main import XPCommandCog
-from bot.cogs.xp.card_generator import UserDisplayCard, UserDisplayCardType
+from bot.cogs.xp.card_generator import UserDisplayCardType, render_card
 from bot.exceptions import standard_error_handling
 
 
@@ -22,13 +22,12 @@ class ShowCommand(XPCommandCog):
                 The member to query.
             """
 
-            experience_member = self.handler.convert_to_experience_member(member)
+            experience_member = await self.handler.convert_to_experience_member(member)
 
             await interaction.response.defer()
 
-            display_card = UserDisplayCard(experience_member, UserDisplayCardType.DisplayProgress)
-            with display_card.get_png_card() as png_card:
-                await interaction.followup.send(file=discord.File(png_card.file))
+            card_file = await render_card(experience_member, UserDisplayCardType.DisplayProgress)
+            await interaction.followup.send(file=card_file)
 
 
 setup = extension_setup(ShowCommand)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional, TypeVar
+from contextlib import closing as contextlib_closing
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+
+T = TypeVar("T")
+
+
+def SafeCursor(conn: sqlite3.Connection) -> contextlib_closing[sqlite3.Cursor]:
+    return contextlib_closing(conn.cursor())
+
+
+class ExperienceDatabase:
+    """Asynchronous facade over an SQLite database.
+    A single worker thread owns the connection and works through a queue of commands one at a time,
+    so no SQLite call ever runs on the event loop. Every command is awaitable and resolves with its result."""
+
+    __slots__ = (
+        "path",
+        "_commands",
+        "_thread"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._commands: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._work, name=f"ExperienceDatabase({self.path})", daemon=True)
+        self._thread.start()
+
+    async def close(self) -> None:
+        """Finish all queued commands, then close the connection and stop the worker thread."""
+        if self._thread is None:
+            return
+
+        self._commands.put(None)
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    def _work(self) -> None:
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+
+        try:
+            while True:
+                command = self._commands.get()
+                if command is None:
+                    break
+
+                function, future, loop = command
+                try:
+                    result = function(connection)
+                except Exception as error:
+                    loop.call_soon_threadsafe(self._resolve, future, None, error)
+                else:
+                    loop.call_soon_threadsafe(self._resolve, future, result, None)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any, error: Optional[BaseException]) -> None:
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+            return
+        future.set_result(result)
+
+    async def run(self, function: Callable[[sqlite3.Connection], T]) -> T:
+        """Run a function against the connection on the worker thread, and await its result."""
+        if self._thread is None:
+            raise RuntimeError("The database worker thread has not been started.")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._commands.put((function, future, loop))
+        return await future
+
+    async def transaction(self, function: Callable[[sqlite3.Cursor], T]) -> T:
+        """Run a function with a cursor inside a single transaction, which commits if the function returns."""
+        def in_transaction(connection: sqlite3.Connection) -> T:
+            with connection, SafeCursor(connection) as cursor:
+                return function(cursor)
+
+        return await self.run(in_transaction)
+
+    async def query(self, query: str, fields: tuple[Any, ...] = tuple(),
+                    quantity: int = 1) -> [sqlite3.Row] or sqlite3.Row or None:
+        def fetch(connection: sqlite3.Connection):
+            with SafeCursor(connection) as cursor:
+                cursor.execute(query, fields)
+                if quantity == 1:
+                    return cursor.fetchone()
+                if quantity == -1:
+                    return cursor.fetchall()
+                return cursor.fetchmany(quantity)
+
+        return await self.run(fetch)
+
+    async def execute(self, command: str, fields: tuple[Any, ...] = tuple()) -> None:
+        def execute(cursor: sqlite3.Cursor):
+            logging.debug(f"SQL EXECUTE {command}")
+            cursor.execute(command, fields)
+
+        await self.transaction(execute)
+
+    async def execute_many(self, command: str, fields_array: [tuple[Any, ...]]) -> None:
+        def execute_many(cursor: sqlite3.Cursor):
+            logging.debug(f"SQL EXECUTEMANY {command} ... {len(fields_array)} rows")
+            cursor.executemany(command, fields_array)
+
+        await self.transaction(execute_many)
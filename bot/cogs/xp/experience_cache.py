@@ -0,0 +1,88 @@
+from __future__ import annotations
+from typing import Iterable, Iterator, Optional
+from array import array
+
+
+class ExperienceCache:
+    """Resident copy of every member's (experience, level), written back to the database in batches.
+    Values live in parallel typed arrays indexed by a per-user slot; slots changed since the last
+    write-back are tracked so that only those rows are flushed."""
+
+    __slots__ = (
+        "_slots",
+        "_user_ids",
+        "_experience",
+        "_levels",
+        "_dirty"
+    )
+
+    def __init__(self):
+        self._slots: dict[int, int] = {}
+        self._user_ids = array("q")
+        self._experience = array("d")
+        self._levels = array("q")
+        self._dirty: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._slots
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    def load(self, rows: Iterable[tuple[int, float, int]]) -> None:
+        """Replace the cache contents with (user ID, experience, level) rows, all considered clean."""
+        self._slots.clear()
+        self._user_ids = array("q")
+        self._experience = array("d")
+        self._levels = array("q")
+        self._dirty.clear()
+
+        for user_id, experience, level in rows:
+            self._slots[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._experience.append(experience)
+            self._levels.append(level)
+
+    def get(self, user_id: int) -> Optional[tuple[float, int]]:
+        """Query a user's cached (experience, level), or None if they have no entry."""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return None
+        return self._experience[slot], self._levels[slot]
+
+    def set(self, user_id: int, experience: float, level: int) -> None:
+        """Store a user's (experience, level) and mark it for write-back."""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = len(self._user_ids)
+            self._slots[user_id] = slot
+            self._user_ids.append(user_id)
+            self._experience.append(experience)
+            self._levels.append(level)
+        else:
+            self._experience[slot] = experience
+            self._levels[slot] = level
+        self._dirty.add(slot)
+
+    def columns(self) -> tuple[array, array, array]:
+        """The (user ID, experience, level) columns in slot order, for bulk operations.
+        Any buffer views of them must be released before the cache next gains a user."""
+        return self._user_ids, self._experience, self._levels
+
+    def items(self) -> Iterator[tuple[int, float, int]]:
+        """Iterate (user ID, experience, level) for every cached user."""
+        return zip(self._user_ids, self._experience, self._levels)
+
+    def take_dirty(self) -> list[tuple[int, float, int]]:
+        """Collect the (user ID, experience, level) rows changed since the last write-back, and mark them clean."""
+        dirty_rows = [(self._user_ids[slot], self._experience[slot], self._levels[slot]) for slot in self._dirty]
+        self._dirty.clear()
+        return dirty_rows
+
+    def mark_dirty(self, user_ids: Iterable[int]) -> None:
+        """Re-queue users for write-back, e.g. after a failed flush."""
+        self._dirty.update(self._slots[user_id] for user_id in user_ids if user_id in self._slots)
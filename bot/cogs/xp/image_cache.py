@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import Any, Optional
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+
+class ImageCache:
+    """LRU cache of PNG images, such as rendered cards and avatars, under keys that identify their content.
+    The most recently used images are held in memory, up to memory_limit bytes. Every cached image is
+    also written to directory, which is trimmed to disk_limit bytes by deleting the least recently used files,
+    so that the cache survives a restart."""
+
+    __slots__ = (
+        "directory",
+        "memory_limit",
+        "disk_limit",
+        "memory_hits",
+        "disk_hits",
+        "misses",
+        "_memory",
+        "_memory_size",
+        "_disk",
+        "_disk_size"
+    )
+
+    def __init__(self, directory: Path, memory_limit: int = 16 * 1024 * 1024, disk_limit: int = 128 * 1024 * 1024):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_size = 0
+        self._load()
+
+    @property
+    def lookups(self) -> int:
+        return self.memory_hits + self.disk_hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        if self.lookups == 0:
+            return 0.0
+        return (self.memory_hits + self.disk_hits) / self.lookups
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Hash the parts that determine an image into a cache key."""
+        serialised_parts = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(serialised_parts.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return Path(self.directory, f"{key}.png")
+
+    def _load(self) -> None:
+        """Index the images already on disk, least recently used first."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        cached_files = []
+        for cached_file in self.directory.glob("*.png"):
+            stat = cached_file.stat()
+            cached_files.append((stat.st_mtime, cached_file.stem, stat.st_size))
+
+        for _, key, size in sorted(cached_files):
+            self._disk[key] = size
+            self._disk_size += size
+        logging.debug(f"Found {len(self._disk)} cached images ({self._disk_size} bytes) in {self.directory}")
+
+    def _remember(self, key: str, png_bytes: bytes) -> None:
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+        self._memory[key] = png_bytes
+        self._memory_size += len(png_bytes)
+
+        while self._memory_size > self.memory_limit and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _read_file(self, key: str) -> bytes:
+        path = self._path(key)
+        png_bytes = path.read_bytes()
+        os.utime(path)
+        return png_bytes
+
+    def _write_file(self, key: str, png_bytes: bytes, evicted_keys: list[str]) -> None:
+        path = self._path(key)
+        partial_path = path.with_suffix(".partial")
+        partial_path.write_bytes(png_bytes)
+        partial_path.replace(path)
+        for evicted_key in evicted_keys:
+            self._path(evicted_key).unlink(missing_ok=True)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Query a cached image, or None if it is not cached."""
+        png_bytes = self._memory.get(key)
+        if png_bytes is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return png_bytes
+
+        if key in self._disk:
+            try:
+                png_bytes = await asyncio.to_thread(self._read_file, key)
+            except OSError as error:
+                logging.warning(f"Failed to read cached image {key}: {error}")
+                self._disk_size -= self._disk.pop(key, 0)
+            else:
+                self._disk.move_to_end(key)
+                self._remember(key, png_bytes)
+                self.disk_hits += 1
+                return png_bytes
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, png_bytes: bytes) -> None:
+        """Cache an image, evicting the least recently used images to stay within the limits."""
+        self._remember(key, png_bytes)
+
+        self._disk_size -= self._disk.pop(key, 0)
+        self._disk[key] = len(png_bytes)
+        self._disk_size += len(png_bytes)
+        evicted_keys = []
+        while self._disk_size > self.disk_limit and len(self._disk) > 1:
+            evicted_key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            evicted_keys.append(evicted_key)
+
+        try:
+            await asyncio.to_thread(self._write_file, key, png_bytes, evicted_keys)
+        except OSError as error:
+            logging.warning(f"Failed to write cached image {key}: {error}")
+            self._disk_size -= self._disk.pop(key, 0)
+
+    def summary(self) -> str:
+        return (f"{self.hit_rate:.0%} hit rate over {self.lookups} lookups "
+                f"({self.memory_hits} from memory, {self.disk_hits} from disk, {self.misses} missed); "
+                f"{len(self._memory)} images ({self._memory_size / 1024 / 1024:.1f} of "
+                f"{self.memory_limit / 1024 / 1024:.0f} MiB) in memory, "
+                f"{len(self._disk)} images ({self._disk_size / 1024 / 1024:.1f} of "
+                f"{self.disk_limit / 1024 / 1024:.0f} MiB) on disk")
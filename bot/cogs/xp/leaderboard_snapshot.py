@@ -0,0 +1,86 @@
+from __future__ import annotations
+from typing import Optional
+from dataclasses import dataclass
+from bisect import bisect_right, bisect_left
+import time
+
+
+# (negated experience, user ID): the rank index's sort key, and the cursor a page is addressed by
+LeaderboardKey = tuple[float, int]
+
+
+@dataclass
+class LeaderboardPage:
+    """Dataclass holding one page of the leaderboard as (rank, user ID, experience) rows, best rank first."""
+    rows: list[tuple[int, int, float]]
+    total: int
+
+    @property
+    def first_key(self) -> Optional[LeaderboardKey]:
+        if not self.rows:
+            return None
+        _, user_id, experience = self.rows[0]
+        return -experience, user_id
+
+    @property
+    def last_key(self) -> Optional[LeaderboardKey]:
+        if not self.rows:
+            return None
+        _, user_id, experience = self.rows[-1]
+        return -experience, user_id
+
+    @property
+    def has_previous(self) -> bool:
+        return bool(self.rows) and self.rows[0][0] > 1
+
+    @property
+    def has_next(self) -> bool:
+        return bool(self.rows) and self.rows[-1][0] < self.total
+
+
+class LeaderboardSnapshot:
+    """An immutable copy of the leaderboard order, taken from the rank index as of one version of it.
+    Pages are addressed by keyset rather than by offset: a cursor is the key of the row a page continues from,
+    and is found by binary search, so a deep page costs the same as the first. A cursor taken from an older
+    snapshot still finds its place in a newer one, so a member paging through the leaderboard while it changes
+    neither skips nor repeats anyone who has kept their position relative to the cursor."""
+
+    __slots__ = (
+        "keys",
+        "version",
+        "taken_at"
+    )
+
+    def __init__(self, keys: list[LeaderboardKey], version: int):
+        self.keys = keys
+        self.version = version
+        self.taken_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _page(self, start: int, size: int) -> LeaderboardPage:
+        start = max(start, 0)
+        rows = [(rank, user_id, -negative_experience)
+                for rank, (negative_experience, user_id) in enumerate(self.keys[start:start + size], start=start + 1)]
+        return LeaderboardPage(rows, len(self.keys))
+
+    def page_at_rank(self, rank: int, size: int) -> LeaderboardPage:
+        """Query the page of size rows starting at a one-based rank."""
+        return self._page(rank - 1, size)
+
+    def page_after(self, cursor: Optional[LeaderboardKey], size: int) -> LeaderboardPage:
+        """Query the page of size rows following the cursor, or the first page if there is no cursor."""
+        if cursor is None:
+            return self._page(0, size)
+        return self._page(bisect_right(self.keys, cursor), size)
+
+    def page_before(self, cursor: LeaderboardKey, size: int) -> LeaderboardPage:
+        """Query the page of size rows preceding the cursor, or of only the rows preceding it if there are fewer."""
+        end = bisect_left(self.keys, cursor)
+        start = max(end - size, 0)
+        return self._page(start, end - start)
+
+    def last_page(self, size: int) -> LeaderboardPage:
+        """Query the page that paging forward from the first page ends on, of the rows left over after full pages."""
+        return self._page(max(len(self.keys) - 1, 0) // size * size, size)
@@ -2,6 +2,8 @@ import discord
 from discord.ext import commands
 from bot.common import extension_setup
 from bot.cogs.xp.main import XPCog
+from bot.cogs.xp.avatar_cache import get_avatar_cache
+from bot.cogs.xp.card_generator import UserDisplayCard
 import logging
 
 
@@ -43,5 +45,13 @@ class XPListeners(XPCog):
 
         self.award_reply_xp(message)
 
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        await get_avatar_cache().prefetch(before.display_avatar, after.display_avatar, UserDisplayCard.avatar_size)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        await get_avatar_cache().prefetch(before.display_avatar, after.display_avatar, UserDisplayCard.avatar_size)
+
 
 setup = extension_setup(XPListeners)
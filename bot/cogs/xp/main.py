@@ -1,22 +1,27 @@
 from __future__ import annotations
 from typing import Any, Optional, Callable
-from contextlib import closing as contextlib_closing
 from collections import defaultdict
+from dataclasses import dataclass
+from bisect import bisect_right
+import asyncio
 import discord
 import logging
+import math
+import numpy
+import time
 from discord import Member as DiscordMember
 from discord.ext import commands, tasks
 from bot.common import FeatureCog, GuildBot, extension_setup
 import bot.exceptions as exceptions
-from bot.subscribable import SubscribableEvent
+from bot.subscribable import SubscribableEvent, EventQueue
 from .group import XPCommandGroup as XPCommandGroupCog
+from .rank_index import ExperienceRankIndex
+from .leaderboard_snapshot import LeaderboardSnapshot
+from .autorole_index import AutoroleIndex
+from .experience_cache import ExperienceCache
+from .database import ExperienceDatabase
 import sqlite3
 from enum import Enum
-from math import exp, log, floor
-
-
-def SafeCursor(conn: sqlite3.Connection) -> contextlib_closing[sqlite3.Cursor]:
-    return contextlib_closing(conn.cursor())
 
 
 class ExperienceQuantityType(Enum):
@@ -24,6 +29,14 @@ class ExperienceQuantityType(Enum):
     xp = 2
 
 
+@dataclass
+class CurveMigrationSummary:
+    """Dataclass counting the members affected by a level curve change."""
+    members: int = 0
+    levelled_up: int = 0
+    levelled_down: int = 0
+
+
 class ExperienceMember(discord.Member):
     __slots__ = (
         "xp_handler",
@@ -69,7 +82,11 @@ class ExperienceMember(discord.Member):
 
     def get_next_level_requirement(self) -> float:
         """Query how much total XP the user will need to level up to their next level."""
-        return self.xp_handler.level_curve.get_level_experience_requirement(self.level + 1)
+        return self.xp_handler.level_curve.get_next_level_experience_requirement(self.xp_quantity)
+
+    def predict_level_up_experience(self, gain: float) -> float:
+        """Predict how much total XP the user will have on reaching their next level, gaining this much at a time."""
+        return self.xp_handler.level_curve.predict_level_up_experience(self.xp_quantity, gain)
 
     def get_level_progress(self) -> float:
         """Query the user's progress from their current to their next level."""
@@ -85,6 +102,7 @@ class XPHandling(FeatureCog):
                 "bot.cogs.xp.voice",
                 "bot.cogs.xp.commands.autorole",
                 "bot.cogs.xp.commands.announce",
+                "bot.cogs.xp.commands.cards",
                 "bot.cogs.xp.commands.curve",
                 "bot.cogs.xp.commands.leaderboard",
                 "bot.cogs.xp.commands.reward",
@@ -96,21 +114,32 @@ class XPHandling(FeatureCog):
     data_directory = "data/xp/"
     database_filename = "experience.sql"
 
+    level_curve_table_maximum_level = 1_000
+    curve_migration_chunk_size = 65_536
+    level_event_queue_size = 1_000
+    level_event_workers = 4
+    level_event_subscriber_timeout = 60.0
+    member_resolution_concurrency = 4
+    prune_departed_members_enabled = True
+    # members this close to their next level, as a fraction of the level, have their level-up card pre-rendered;
+    # None disables speculative pre-rendering
+    speculative_level_up_fraction: Optional[float] = None
+
     defaults = {"level_curve_scalar": 100,
                 "level_curve_power": 2,
                 "reward_xp_message": 50,
                 "reward_xp_reply": 50,
                 "reward_xp_react": 35,
                 "reward_xp_voice": 15,
-                "xp_gain_cap": 150}
+                "xp_gain_cap": 150,
+                "announce_level_up_mode": 0}
 
     class SQLMethods:
-        rank_field = "ROW_NUMBER() OVER(ORDER BY experience DESC) as rank"
-
         def __init__(self, guild_id: int):
             self.experience_schema: str = f"Guild{guild_id}"
             self.roles_schema: str = f"Roles{guild_id}"
             self.role_scalars_schema: str = f"Scalars{guild_id}"
+            self.departed_schema: str = f"Departed{guild_id}"
 
         @staticmethod
         def generic_delete(table, condition):
@@ -138,7 +167,19 @@ class XPHandling(FeatureCog):
                 reward_message REAL, 
                 reward_reply REAL, 
                 reward_react REAL, 
-                xp_gain_cap REAL);"""
+                xp_gain_cap REAL,
+                announce_level_up_mode INTEGER);"""
+
+        # columns added to GuildData since it was first created, which older databases must have added
+        guild_data_added_columns = {"announce_level_up_mode": "INTEGER"}
+
+        @staticmethod
+        def select_guild_data_columns():
+            return "PRAGMA table_info(GuildData)"
+
+        @staticmethod
+        def add_guild_data_column(column_name, column_type):
+            return f"ALTER TABLE GuildData ADD COLUMN {column_name} {column_type}"
 
         def create_experience_schema(self):
             return f"CREATE TABLE IF NOT EXISTS {self.experience_schema} (userid INTEGER PRIMARY KEY, experience REAL, experience_level INTEGER);"
@@ -149,24 +190,34 @@ class XPHandling(FeatureCog):
         def create_scalars_schema(self):
             return f"CREATE TABLE IF NOT EXISTS {self.role_scalars_schema} (roleid INTEGER PRIMARY KEY, scalar REAL, priority INTEGER);"
 
-        def experience_schema_with_rank_subquery(self):
-            return f"(SELECT userid, experience, experience_level, {self.rank_field} from {self.experience_schema})"
+        def create_departed_schema(self):
+            return f"CREATE TABLE IF NOT EXISTS {self.departed_schema} (userid INTEGER PRIMARY KEY, departed_at INTEGER);"
 
         def select_member_by_userid(self, field_names):
-            return self.generic_select(self.experience_schema_with_rank_subquery(), field_names, "userid=?")
+            return self.generic_select(self.experience_schema, field_names, "userid=?")
 
         def select_many_members_by_userid(self, field_names, number_of_user_ids):
-            return self.generic_select(self.experience_schema_with_rank_subquery(), field_names,
+            return self.generic_select(self.experience_schema, field_names,
                                        f"userid IN ({', '.join(['?'] * number_of_user_ids)})")
 
-        def select_many_members_by_condition(self, field_names, condition):
-            return self.generic_select(self.experience_schema_with_rank_subquery(), field_names, condition)
+        def select_all_members(self, field_names):
+            return f"SELECT {', '.join(field_names)} FROM {self.experience_schema}"
 
         def update_by_userid(self, field_names: [str]) -> str:
             return f"UPDATE {self.experience_schema} SET {', '.join([field_name + '=?' for field_name in field_names])} WHERE userid=? LIMIT 1"
 
-        def insert_userid(self):
-            return f"INSERT INTO {self.experience_schema} (userid, experience, experience_level) VALUES (?, 0, 0)"
+        def upsert_member(self):
+            return f"""INSERT INTO {self.experience_schema} (userid, experience, experience_level) VALUES (?, ?, ?)
+                ON CONFLICT(userid) DO UPDATE SET experience=excluded.experience, experience_level=excluded.experience_level"""
+
+        def select_departed_members(self):
+            return f"SELECT userid FROM {self.departed_schema}"
+
+        def insert_departed_member(self):
+            return f"INSERT OR IGNORE INTO {self.departed_schema} (userid, departed_at) VALUES (?, ?)"
+
+        def delete_departed_member(self):
+            return self.generic_delete(self.departed_schema, "userid=?")
 
         def insert_auto_role(self):
             return f"INSERT INTO {self.roles_schema} (roleid, assign_at, remove_at) VALUES (?, ?, ?)"
@@ -202,10 +253,16 @@ class XPHandling(FeatureCog):
             return f"{self.select_auto_roles(fields_to_select)} WHERE {condition}"
 
     class XPCurve:
+        """The level XP requirement curve, Level XP Requirement = scalar * Level ** power.
+        Every method has an array version, taking and returning NumPy arrays elementwise.
+        The scalar versions are computed through the array versions, so the two always agree exactly.
+
+        Floored levels up to maximum_level are found by binary search over a table of level thresholds,
+        which is exact at the thresholds themselves; above it they fall back to the root formula."""
 
         class Math:
             @staticmethod
-            def nth_root_of_x(n: float, x: float):
+            def nth_root_of_x(n: float, x: float or numpy.ndarray):
                 """Calculate the nth root of X using exponent and natural log.
                 exp(log(x) / n) = x^(1/n)
                 exp(1/n * log(x) ) = x^(1/n)
@@ -216,51 +273,107 @@ class XPHandling(FeatureCog):
                 ----------
                 n : float
                     The root index.
-                x : float
-                    The value being rooted.
+                x : float or numpy.ndarray
+                    The value(s) being rooted.
                 """
-                return exp(log(x) / n)
+                return numpy.exp(numpy.log(x) / n)
 
-        def __init__(self, scalar: float, power: float):
+        def __init__(self, scalar: float, power: float, maximum_level: int = 1_000):
             self.scalar = scalar
             self.power = power
+            self.maximum_level = maximum_level
+
+            self._level_threshold_array = self.get_level_experience_requirements(numpy.arange(maximum_level + 1))
+            self.level_thresholds: list[float] = self._level_threshold_array.tolist()
 
         def get_floored_level_from_experience(self, xp_quantity: float) -> int:
             """Query what experience level (rounded down) an arbitrary user would be based on an XP quantity."""
-            return floor(self.get_level_from_experience(xp_quantity))
+            level = bisect_right(self.level_thresholds, xp_quantity) - 1
+            if level < self.maximum_level:
+                return max(level, 0)
+            return int(self.get_floored_levels_from_experiences(xp_quantity))
+
+        def get_next_level_experience_requirement(self, xp_quantity: float) -> float:
+            """Query what total XP quantity is required for the level after the one an XP quantity reaches."""
+            next_level = self.get_floored_level_from_experience(xp_quantity) + 1
+            if next_level <= self.maximum_level:
+                return self.level_thresholds[next_level]
+            return self.get_level_experience_requirement(next_level)
+
+        def predict_level_up_experience(self, xp_quantity: float, gain: float) -> float:
+            """Predict the XP quantity at which a user will reach their next level, if every gain until then is
+            the same as the last. Users overshoot a level's requirement by up to one gain, and the overshoot shows
+            on their level-up card; with no gain to go by, they are predicted to reach the requirement exactly."""
+            requirement = self.get_next_level_experience_requirement(xp_quantity)
+            if gain <= 0:
+                return requirement
+            return xp_quantity + math.ceil((requirement - xp_quantity) / gain) * gain
 
         def get_level_experience_requirement(self, level: float) -> float:
             """Query what total XP quantity is required for an experience level."""
-            return self.scalar * level ** self.power
+            return float(self.get_level_experience_requirements(level))
 
         def get_experience_above_level(self, xp_quantity: float, level: int) -> float:
             """Query how much XP is 'overflow' above a certain level's requirement."""
-            return xp_quantity - self.get_level_experience_requirement(level)
+            return float(self.get_experiences_above_levels(xp_quantity, level))
 
         def get_relative_level_experience_requirement(self, level: int) -> float:
             """Query what XP quantity is required to level up from the previous level, to the level specified."""
-            return self.get_level_experience_requirement(level) - self.get_level_experience_requirement(level - 1)
+            return float(self.get_relative_level_experience_requirements(level))
 
         def get_level_progress_from_experience(self, xp_quantity: float) -> float:
             """Query progress from the previous to the next level based upon an XP quantity."""
-            from_level = self.get_floored_level_from_experience(xp_quantity)
-            return self.get_experience_above_level(xp_quantity,
-                                                   from_level) / self.get_relative_level_experience_requirement(
-                from_level + 1)
+            return float(self.get_level_progresses_from_experiences(xp_quantity))
 
         def get_level_from_experience(self, xp_quantity: float) -> float:
             """Query the exact experience level (as float) of an arbitrary user based on XP quantity."""
-            try:
-                return self.Math.nth_root_of_x(self.power, (xp_quantity / self.scalar))
-            except ValueError:
-                return 0
+            return float(self.get_levels_from_experiences(xp_quantity))
+
+        def get_floored_levels_from_experiences(self, xp_quantities: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_floored_level_from_experience."""
+            xp_quantities = numpy.asarray(xp_quantities, dtype=numpy.float64)
+            levels = numpy.searchsorted(self._level_threshold_array, xp_quantities, side="right") - 1
+            levels = numpy.maximum(levels, 0)
+
+            beyond_table = levels >= self.maximum_level
+            if numpy.any(beyond_table):
+                formula_levels = numpy.floor(self.get_levels_from_experiences(xp_quantities)).astype(numpy.int64)
+                levels = numpy.where(beyond_table, numpy.maximum(formula_levels, self.maximum_level), levels)
+            return levels
+
+        def get_level_experience_requirements(self, levels: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_level_experience_requirement."""
+            return self.scalar * numpy.power(numpy.asarray(levels, dtype=numpy.float64), self.power)
+
+        def get_experiences_above_levels(self, xp_quantities: numpy.ndarray, levels: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_experience_above_level."""
+            return numpy.asarray(xp_quantities, dtype=numpy.float64) - self.get_level_experience_requirements(levels)
+
+        def get_relative_level_experience_requirements(self, levels: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_relative_level_experience_requirement."""
+            levels = numpy.asarray(levels, dtype=numpy.float64)
+            return self.get_level_experience_requirements(levels) - self.get_level_experience_requirements(levels - 1)
+
+        def get_level_progresses_from_experiences(self, xp_quantities: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_level_progress_from_experience."""
+            from_levels = self.get_floored_levels_from_experiences(xp_quantities)
+            return self.get_experiences_above_levels(xp_quantities, from_levels) / \
+                self.get_relative_level_experience_requirements(from_levels + 1)
+
+        def get_levels_from_experiences(self, xp_quantities: numpy.ndarray) -> numpy.ndarray:
+            """Array version of get_level_from_experience.
+            Non-positive XP quantities have no logarithm, and are level 0."""
+            scaled_quantities = numpy.asarray(xp_quantities, dtype=numpy.float64) / self.scalar
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                levels = self.Math.nth_root_of_x(self.power, scaled_quantities)
+            return numpy.where(scaled_quantities > 0, levels, 0.0)
 
     def __init__(self, bot: GuildBot):
         self.bot = bot
 
         self.database_path = self.data_directory + self.database_filename
 
-        self.database_connection: Optional[sqlite3.Connection] = None
+        self.database = ExperienceDatabase(self.database_path)
         self.sql_commands = self.SQLMethods(self.bot.guild.id)
 
         self.level_curve_scalar: float = None
@@ -272,47 +385,85 @@ class XPHandling(FeatureCog):
         self.xp_gain_cap = None
 
         self.announce_level_up_channel_id: Optional[int] = None
+        self.announce_level_up_mode: int = None
 
         self.apply_defaults()
-        self.level_curve = self.XPCurve(self.level_curve_scalar, self.level_curve_power)
-
-        self.level_up_event = SubscribableEvent()
-        self.level_changed_event = SubscribableEvent()
+        self.level_curve = self.XPCurve(self.level_curve_scalar, self.level_curve_power,
+                                        self.level_curve_table_maximum_level)
+
+        self.level_up_event = SubscribableEvent(concurrent=True, subscriber_timeout=self.level_event_subscriber_timeout)
+        self.level_changed_event = SubscribableEvent(concurrent=True,
+                                                     subscriber_timeout=self.level_event_subscriber_timeout)
+        self.level_up_approaching_event = SubscribableEvent(concurrent=True,
+                                                            subscriber_timeout=self.level_event_subscriber_timeout)
+        self.level_ups_handled_event = SubscribableEvent(concurrent=True,
+                                                         subscriber_timeout=self.level_event_subscriber_timeout)
+        self.level_up_queue = EventQueue(self.on_level_up, self.level_event_queue_size, self.level_event_workers)
+        self.level_changed_queue = EventQueue(self.on_level_changed, self.level_event_queue_size,
+                                              self.level_event_workers)
+        self._level_ups_handled_waiters: set[asyncio.Task] = set()
         self._xp_additions = defaultdict(lambda: 0)
+        self.experience_lock = asyncio.Lock()
+        self.rank_index = ExperienceRankIndex()
+        self._leaderboard_snapshot: Optional[LeaderboardSnapshot] = None
+        self.experience_cache = ExperienceCache()
+        self.role_scalars: dict[int, tuple[float, int]] = {}
+        self.autorole_index = AutoroleIndex()
+        self._member_experience_scalars: dict[int, float] = {}
+        self.departed_user_ids: set[int] = set()
+        self._returned_user_ids: set[int] = set()
 
-    def cog_load(self) -> None:
-        self.database_connection = sqlite3.connect(self.database_path)
-        self.database_connection.row_factory = sqlite3.Row
+    async def cog_load(self) -> None:
+        self.database.start()
 
-        with self.database_connection, SafeCursor(self.database_connection) as cursor:
+        def create_schemas(cursor: sqlite3.Cursor):
             cursor.execute(self.sql_commands.create_guild_data_schema())
+            guild_data_columns = {row["name"] for row in cursor.execute(self.sql_commands.select_guild_data_columns())}
+            for column_name, column_type in self.sql_commands.guild_data_added_columns.items():
+                if column_name not in guild_data_columns:
+                    cursor.execute(self.sql_commands.add_guild_data_column(column_name, column_type))
             cursor.execute(f"INSERT OR IGNORE INTO GuildData (guildid) VALUES (?)", (self.bot.guild.id,))
             cursor.execute(self.sql_commands.create_experience_schema())
             cursor.execute(self.sql_commands.create_roles_schema())
             cursor.execute(self.sql_commands.create_scalars_schema())
+            cursor.execute(self.sql_commands.create_departed_schema())
 
-        self.load_all_guild_data()
+        await self.database.transaction(create_schemas)
 
+        await self.load_all_guild_data()
+        await self.load_experience_cache()
+        await self.load_role_scalars()
+        await self.load_autoroles()
+
+        self.level_up_queue.start()
+        self.level_changed_queue.start()
         self.do_experience_additions.start()
+        if self.prune_departed_members_enabled:
+            self.prune_departed_members.start()
 
     async def cog_unload(self) -> None:
-        self.save_all_guild_data()
+        await self.save_all_guild_data()
+        self.prune_departed_members.cancel()
         self.do_experience_additions.cancel()
         await self.do_experience_additions()
-        self.database_connection.close()
-
-    def save_all_guild_data(self):
-        with self.database_connection, SafeCursor(self.database_connection) as cursor:
-            cursor.execute(
-                f"UPDATE GuildData SET announce_level_up_channel_id=?, curve_scalar=?, curve_power=?, reward_voice=?, reward_message=?, reward_reply=?, reward_react=?, xp_gain_cap=? WHERE guildid=?",
-                (self.announce_level_up_channel_id, self.level_curve_scalar, self.level_curve_power,
-                 self.reward_xp_voice, self.reward_xp_message, self.reward_xp_reply, self.reward_xp_react,
-                 self.xp_gain_cap, self.bot.guild.id,))
-
-    def load_all_guild_data(self):
-        with SafeCursor(self.database_connection) as cursor:
-            cursor.execute(f"SELECT * FROM GuildData WHERE guildid=?", (self.bot.guild.id,))
-            guild_data: sqlite3.Row = cursor.fetchone()
+        await self.level_up_queue.stop()
+        await asyncio.gather(*self._level_ups_handled_waiters)
+        await self.level_changed_queue.stop()
+        # imported here, so that the XP handler does not need a card renderer backend to be importable to load
+        from .card_renderer import close_card_renderer
+        await close_card_renderer()
+        await self.database.close()
+
+    async def save_all_guild_data(self):
+        await self.database.execute(
+            f"UPDATE GuildData SET announce_level_up_channel_id=?, announce_level_up_mode=?, curve_scalar=?, curve_power=?, reward_voice=?, reward_message=?, reward_reply=?, reward_react=?, xp_gain_cap=? WHERE guildid=?",
+            (self.announce_level_up_channel_id, self.announce_level_up_mode, self.level_curve_scalar, self.level_curve_power,
+             self.reward_xp_voice, self.reward_xp_message, self.reward_xp_reply, self.reward_xp_react,
+             self.xp_gain_cap, self.bot.guild.id,))
+
+    async def load_all_guild_data(self):
+        guild_data: sqlite3.Row = await self.database.query(f"SELECT * FROM GuildData WHERE guildid=?",
+                                                            (self.bot.guild.id,))
 
         if guild_data is None:
             return
@@ -326,10 +477,70 @@ class XPHandling(FeatureCog):
         self.xp_gain_cap = guild_data["xp_gain_cap"]
 
         self.announce_level_up_channel_id = guild_data["announce_level_up_channel_id"]
+        self.announce_level_up_mode = guild_data["announce_level_up_mode"]
 
         self.apply_defaults_if_none()
 
-        self.level_curve = self.XPCurve(self.level_curve_scalar, self.level_curve_power)
+        self.level_curve = self.XPCurve(self.level_curve_scalar, self.level_curve_power,
+                                        self.level_curve_table_maximum_level)
+
+    async def load_experience_cache(self):
+        rows = await self.basic_database_query(
+            self.sql_commands.select_all_members(("userid", "experience", "experience_level")), quantity=-1)
+        self.experience_cache.load((row["userid"], row["experience"], row["experience_level"]) for row in rows)
+
+        departed_rows = await self.basic_database_query(self.sql_commands.select_departed_members(), quantity=-1)
+        self.departed_user_ids = {row["userid"] for row in departed_rows}
+        self._returned_user_ids.clear()
+        self.rebuild_rank_index()
+
+    def rebuild_rank_index(self):
+        """Rank every cached member, except those flagged as departed."""
+        self.rank_index.load((user_id, experience) for user_id, experience, _ in self.experience_cache.items()
+                             if user_id not in self.departed_user_ids)
+
+    async def flush_experience_cache(self):
+        """Upsert every cached experience entry changed since the last flush, and clear the departed flag
+        of every member who has returned since then, in one transaction."""
+        dirty_rows = self.experience_cache.take_dirty()
+        returned_user_ids = list(self._returned_user_ids)
+        self._returned_user_ids.clear()
+        if len(dirty_rows) == 0 and len(returned_user_ids) == 0:
+            return
+
+        def write_dirty_rows(cursor: sqlite3.Cursor):
+            logging.debug(f"Flushing {len(dirty_rows)} experience entries")
+            cursor.executemany(self.sql_commands.upsert_member(), dirty_rows)
+            cursor.executemany(self.sql_commands.delete_departed_member(),
+                               [(user_id,) for user_id in returned_user_ids])
+
+        try:
+            await self.database.transaction(write_dirty_rows)
+        except sqlite3.Error as error:
+            logging.exception(error)
+            self.experience_cache.mark_dirty([user_id for user_id, _, _ in dirty_rows])
+            self._returned_user_ids.update(returned_user_ids)
+
+    def _store_experience(self, user_id: int, experience: float, level: int):
+        self.experience_cache.set(user_id, experience, level)
+        if user_id in self.departed_user_ids:
+            self._restore_departed_user(user_id)
+        self.rank_index.update(user_id, experience)
+
+    def _restore_departed_user(self, user_id: int):
+        """Rank a departed member again; their departed flag is cleared by the next flush."""
+        self.departed_user_ids.discard(user_id)
+        self._returned_user_ids.add(user_id)
+        cached = self.experience_cache.get(user_id)
+        if cached is not None:
+            self.rank_index.update(user_id, cached[0])
+
+    def get_cached_experience(self, user_id: int) -> tuple[float, int]:
+        """Query a user's stored (experience, level), excluding any pending XP additions."""
+        cached = self.experience_cache.get(user_id)
+        if cached is None:
+            return 0, 0
+        return cached
 
     def apply_defaults(self, when: Optional[Callable[[str], bool]] = lambda attr_name: True):
         for attr_name, default_value in self.defaults.items():
@@ -340,16 +551,16 @@ class XPHandling(FeatureCog):
     def apply_defaults_if_none(self):
         self.apply_defaults(lambda attr_name: self.__getattribute__(attr_name) is None)
 
-    def set_xp_reward_for_action(self, action_name: str, reward: float):
+    async def set_xp_reward_for_action(self, action_name: str, reward: float):
         attribute_name = "reward_xp_" + action_name
         self.__setattr__(attribute_name, reward)
-        self.save_all_guild_data()
+        await self.save_all_guild_data()
 
-    def set_xp_gain_cap(self, cap: float):
+    async def set_xp_gain_cap(self, cap: float):
         self.xp_gain_cap = cap
-        self.save_all_guild_data()
+        await self.save_all_guild_data()
 
-    def basic_database_query(self, query: str, fields: Optional[tuple[Any, ...]] = tuple(),
+    async def basic_database_query(self, query: str, fields: Optional[tuple[Any, ...]] = tuple(),
                              quantity: Optional[int] = 1) -> [sqlite3.Row] or sqlite3.Row or None:
         """Basic experience database query.
         When Quantity is 1, returns a tuple representing a database entry.
@@ -370,17 +581,9 @@ class XPHandling(FeatureCog):
         if quantity < -1:
             raise ValueError("Quantity cannot be negative (except -1).")
 
-        with SafeCursor(self.database_connection) as cursor:
-            cursor.execute(query, fields)
-            if quantity == 1:
-                result = cursor.fetchone()
-            elif quantity == -1:
-                result = cursor.fetchall()
-            else:
-                result = cursor.fetchmany(quantity)
-            return result
+        return await self.database.query(query, fields, quantity)
 
-    def database_get_by_userid(self, user_id: int, field_names: [str]) -> Optional[sqlite3.Row]:
+    async def database_get_by_userid(self, user_id: int, field_names: [str]) -> Optional[sqlite3.Row]:
         """Query the experience database for a user's fields.
 
         Parameters
@@ -390,9 +593,9 @@ class XPHandling(FeatureCog):
         field_names : [str]
             Array of field names to query.
         """
-        return self.basic_database_query(self.sql_commands.select_member_by_userid(field_names), (user_id,), 1)
+        return await self.basic_database_query(self.sql_commands.select_member_by_userid(field_names), (user_id,), 1)
 
-    def database_get_many_by_userid(self, user_ids: [int], field_names: [str]) -> [sqlite3.Row]:
+    async def database_get_many_by_userid(self, user_ids: [int], field_names: [str]) -> [sqlite3.Row]:
         """Query the experience database for some users' fields.
 
         Parameters
@@ -402,135 +605,204 @@ class XPHandling(FeatureCog):
         field_names : [str]
             Array of field names to query.
         """
-        return self.basic_database_query(self.sql_commands.select_many_members_by_userid(field_names, len(user_ids)),
-                                         tuple(user_ids), -1)
+        return await self.basic_database_query(self.sql_commands.select_many_members_by_userid(field_names, len(user_ids)),
+                                               tuple(user_ids), -1)
 
-    def basic_database_execute(self, command: str, fields: tuple[Any, ...] = tuple()):
-        with self.database_connection, SafeCursor(self.database_connection) as cursor:
-            logging.debug(f"SQL EXECUTE {command}")
-            cursor.execute(command, fields)
+    async def basic_database_execute(self, command: str, fields: tuple[Any, ...] = tuple()):
+        await self.database.execute(command, fields)
 
-    def basic_database_execute_many(self, command: str, fields_array: [tuple[Any, ...]]):
+    async def basic_database_execute_many(self, command: str, fields_array: [tuple[Any, ...]]):
         if len(fields_array) == 0:
             return
 
-        with self.database_connection, SafeCursor(self.database_connection) as cursor:
-            logging.debug(f"SQL EXECUTEMANY {command} ... {fields_array}")
-            cursor.executemany(command, fields_array)
-
-    def database_update_by_userid(self, user_id: int, fields: dict[str, Any]):
-        self.basic_database_execute(self.sql_commands.update_by_userid(fields.keys()),
-                                    tuple(fields.values()) + (user_id,))
-
-    def database_update_many_by_userid(self, data: dict[int, tuple[Any, ...]], field_names: tuple[str, ...]):
-        self.basic_database_execute_many(self.sql_commands.update_by_userid(field_names),
-                                         tuple([values + (user_id,) for user_id, values in data.items()]))
+        await self.database.execute_many(command, fields_array)
 
-    def database_insert_userid(self, user_id: int):
-        self.basic_database_execute(self.sql_commands.insert_userid(), (user_id,))
+    async def database_insert_autorole(self, role_id: int, assign_at: int, remove_at: int):
+        await self.basic_database_execute(self.sql_commands.insert_auto_role(), (role_id, assign_at, remove_at))
 
-    def database_insert_many_userids(self, user_ids: [int]):
-        self.basic_database_execute_many(self.sql_commands.insert_userid(), tuple([(user_id,) for user_id in user_ids]))
-
-    def database_insert_autorole(self, role_id: int, assign_at: int, remove_at: int):
-        self.basic_database_execute(self.sql_commands.insert_auto_role(), (role_id, assign_at, remove_at))
-
-    def database_modify_autorole(self, role_id: int, assign_at: Optional[int], remove_at: Optional[int]):
+    async def database_modify_autorole(self, role_id: int, assign_at: Optional[int], remove_at: Optional[int]):
         fields = {}
         if assign_at is not None:
             fields["assign_at"] = assign_at
         if remove_at is not None:
             fields["remove_at"] = remove_at
-        self.basic_database_execute(self.sql_commands.update_auto_role(fields.keys()),
-                                    tuple(fields.values()) + (role_id,))
+        await self.basic_database_execute(self.sql_commands.update_auto_role(fields.keys()),
+                                          tuple(fields.values()) + (role_id,))
 
-    def database_delete_autorole(self, role_id: int):
-        self.basic_database_execute(self.sql_commands.delete_auto_role(), (role_id,))
+    async def database_delete_autorole(self, role_id: int):
+        await self.basic_database_execute(self.sql_commands.delete_auto_role(), (role_id,))
 
-    def database_autorole_exists(self, role_id: int):
-        database_entry = self.basic_database_query(self.sql_commands.select_auto_role_by_id(("roleid",)), (role_id,))
+    async def database_autorole_exists(self, role_id: int):
+        database_entry = await self.basic_database_query(self.sql_commands.select_auto_role_by_id(("roleid",)), (role_id,))
         return database_entry is not None
 
-    def create_autorole(self, role: discord.Role, assign_at: int, remove_at: int):
+    async def load_autoroles(self):
+        rows = await self.basic_database_query(self.sql_commands.select_auto_roles(("roleid", "assign_at", "remove_at")),
+                                               quantity=-1)
+        self.autorole_index.load((row["roleid"], row["assign_at"], row["remove_at"]) for row in rows)
+
+    async def create_autorole(self, role: discord.Role, assign_at: int, remove_at: int):
         try:
-            self.database_insert_autorole(role.id, assign_at, remove_at)
+            await self.database_insert_autorole(role.id, assign_at, remove_at)
         except sqlite3.IntegrityError:
             raise exceptions.ConflictError(f"{role.mention} is already a level-assigned role.")
+        self.autorole_index.set_rule(role.id, assign_at, remove_at)
 
-    def modify_autorole(self, role: discord.Role, assign_at: Optional[int], remove_at: Optional[int]):
-        if not self.database_autorole_exists(role.id):
+    async def modify_autorole(self, role: discord.Role, assign_at: Optional[int], remove_at: Optional[int]):
+        rule = self.autorole_index.get_rule(role.id)
+        if rule is None:
             raise exceptions.NotFoundError(f"{role.mention} is not a level-assigned role.")
-        self.database_modify_autorole(role.id, assign_at, remove_at)
+        await self.database_modify_autorole(role.id, assign_at, remove_at)
 
-    def remove_autorole(self, role: discord.Role):
-        if not self.database_autorole_exists(role.id):
+        old_assign_at, old_remove_at = rule
+        self.autorole_index.set_rule(role.id, old_assign_at if assign_at is None else assign_at,
+                                     old_remove_at if remove_at is None else remove_at)
+
+    async def remove_autorole(self, role: discord.Role):
+        if role.id not in self.autorole_index:
             raise exceptions.NotFoundError(f"{role.mention} is not a level-assigned role.")
-        self.database_delete_autorole(role.id)
+        await self.database_delete_autorole(role.id)
+        self.autorole_index.remove_rule(role.id)
 
-    def database_insert_role_scalar(self, role_id: int, scalar: float, priority: int):
-        self.basic_database_execute(self.sql_commands.insert_role_scalar(), (role_id, scalar, priority))
+    async def database_insert_role_scalar(self, role_id: int, scalar: float, priority: int):
+        await self.basic_database_execute(self.sql_commands.insert_role_scalar(), (role_id, scalar, priority))
 
-    def database_modify_role_scalar(self, role_id: int, scalar: Optional[float], priority: Optional[int]):
+    async def database_modify_role_scalar(self, role_id: int, scalar: Optional[float], priority: Optional[int]):
         fields = {}
         if scalar is not None:
             fields["scalar"] = scalar
         if priority is not None:
             fields["priority"] = priority
-        self.basic_database_execute(self.sql_commands.update_role_scalar(fields.keys()),
-                                    tuple(fields.values()) + (role_id,))
+        await self.basic_database_execute(self.sql_commands.update_role_scalar(fields.keys()),
+                                          tuple(fields.values()) + (role_id,))
 
-    def database_delete_role_scalar(self, role_id: int):
-        self.basic_database_execute(self.sql_commands.delete_role_scalar(), (role_id,))
+    async def database_delete_role_scalar(self, role_id: int):
+        await self.basic_database_execute(self.sql_commands.delete_role_scalar(), (role_id,))
 
-    def database_role_scalar_exists(self, role_id: int):
-        database_entry = self.basic_database_query(self.sql_commands.select_role_scalar_by_id(("roleid",)), (role_id,))
+    async def database_role_scalar_exists(self, role_id: int):
+        database_entry = await self.basic_database_query(self.sql_commands.select_role_scalar_by_id(("roleid",)), (role_id,))
         return database_entry is not None
 
-    def assign_role_scalar(self, role: discord.Role, scalar: float, priority: int):
+    async def load_role_scalars(self):
+        rows = await self.basic_database_query(self.sql_commands.select_role_scalars(("roleid", "scalar", "priority")),
+                                               quantity=-1)
+        self.role_scalars = {row["roleid"]: (row["scalar"], row["priority"]) for row in rows}
+        self._member_experience_scalars.clear()
+
+    async def assign_role_scalar(self, role: discord.Role, scalar: float, priority: int):
         try:
-            self.database_insert_role_scalar(role.id, scalar, priority)
+            await self.database_insert_role_scalar(role.id, scalar, priority)
         except sqlite3.IntegrityError:
             raise exceptions.ConflictError(f"{role.mention} is already assigned a scalar.")
+        self._set_role_scalar(role.id, (scalar, priority))
 
-    def modify_role_scalar(self, role: discord.Role, scalar: Optional[float], priority: Optional[int]):
-        if not self.database_role_scalar_exists(role.id):
+    async def modify_role_scalar(self, role: discord.Role, scalar: Optional[float], priority: Optional[int]):
+        if role.id not in self.role_scalars:
             raise exceptions.NotFoundError(f"{role.mention} does not have a role scalar assigned.")
-        self.database_modify_role_scalar(role.id, scalar, priority)
+        await self.database_modify_role_scalar(role.id, scalar, priority)
 
-    def remove_role_scalar(self, role: discord.Role):
-        if not self.database_role_scalar_exists(role.id):
-            raise exceptions.NotFoundError(f"{role.mention} does not have a role scalar assigned.")
-        self.database_delete_role_scalar(role.id)
-
-    def _adjust_xp_quantities_to_curve(self, curve: XPCurve):
-        with SafeCursor(self.database_connection) as cursor:
-            cursor.execute(f"SELECT userid, experience FROM {self.sql_commands.experience_schema}")
-            update_by_userid_command = self.sql_commands.update_by_userid(("experience",))
-            while True:
-                experience_data = cursor.fetchone()
-                if experience_data is None:
-                    break
-
-                level = self.level_curve.get_level_from_experience(experience_data["experience"])
-                new_experience = curve.get_level_experience_requirement(level)
+        old_scalar, old_priority = self.role_scalars[role.id]
+        self._set_role_scalar(role.id, (old_scalar if scalar is None else scalar,
+                                        old_priority if priority is None else priority))
 
-                self.basic_database_execute(update_by_userid_command, (new_experience, experience_data["userid"]))
+    async def remove_role_scalar(self, role: discord.Role):
+        if role.id not in self.role_scalars:
+            raise exceptions.NotFoundError(f"{role.mention} does not have a role scalar assigned.")
+        await self.database_delete_role_scalar(role.id)
+        self._set_role_scalar(role.id, None)
 
-    def _adjust_xp_levels_to_curve(self, curve: XPCurve):
-        with SafeCursor(self.database_connection) as cursor:
-            cursor.execute(f"SELECT userid, experience from {self.sql_commands.experience_schema}")
-            update_by_userid_command = self.sql_commands.update_by_userid(("experience_level",))
-            while True:
-                experience_data = cursor.fetchone()
-                if experience_data is None:
-                    break
+    def _set_role_scalar(self, role_id: int, scalar_data: Optional[tuple[float, int]]):
+        """Update the role scalar index, and forget the effective scalars that may depend upon it."""
+        if scalar_data is None:
+            self.role_scalars.pop(role_id, None)
+        else:
+            self.role_scalars[role_id] = scalar_data
+        self._member_experience_scalars.clear()
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            self._member_experience_scalars.pop(after.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self._member_experience_scalars.pop(member.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        if member.id in self.departed_user_ids:
+            self._restore_departed_user(member.id)
+
+    @tasks.loop(minutes=30.0)
+    async def prune_departed_members(self):
+        """Flag members known to have left the guild as departed, so they drop out of the rank index.
+        Their experience is kept, and they are ranked again if they return."""
+        departed_user_ids = [user_id for user_id in self.bot.departed_member_ids()
+                             if user_id in self.experience_cache and user_id not in self.departed_user_ids]
+        if len(departed_user_ids) == 0:
+            return
 
-                new_level = curve.get_floored_level_from_experience(experience_data["experience"])
+        departed_at = int(time.time())
+        await self.database.execute_many(self.sql_commands.insert_departed_member(),
+                                         [(user_id, departed_at) for user_id in departed_user_ids])
+        for user_id in departed_user_ids:
+            if self.bot.is_member_departed(user_id):
+                self.departed_user_ids.add(user_id)
+                self.rank_index.discard(user_id)
+            else:
+                self._returned_user_ids.add(user_id)
+        logging.debug(f"Flagged {len(departed_user_ids)} departed members in guild {self.bot.guild.id}")
 
-                self.basic_database_execute(update_by_userid_command, (new_level, experience_data["userid"]))
-                self.bot.loop.create_task(self.on_level_changed(experience_data["userid"], new_level))
+    @prune_departed_members.before_loop
+    async def before_prune_departed_members(self):
+        await self.bot.wait_until_ready()
 
-    def update_level_curve(self, scalar: Optional[float], power: Optional[float], maintain_level: bool):
+    async def _migrate_experience_to_curve(self, curve: XPCurve, maintain_level: bool,
+                                           dry_run: bool) -> tuple[CurveMigrationSummary, list[tuple[int, int, int]]]:
+        """Recompute every cached member's XP quantity or level for a new curve, a chunk at a time.
+        Changed entries are marked dirty in the experience cache, unless this is a dry run.
+        Returns the migration summary, and the (user ID, new level, old level) of every member whose level changed."""
+        summary = CurveMigrationSummary()
+        level_changes: list[tuple[int, int, int]] = []
+
+        chunk_start = 0
+        while chunk_start < len(self.experience_cache):
+            chunk_stop = min(chunk_start + self.curve_migration_chunk_size, len(self.experience_cache))
+            user_id_column, experience_column, level_column = self.experience_cache.columns()
+            user_ids = numpy.frombuffer(user_id_column, dtype=numpy.int64)[chunk_start:chunk_stop]
+            experiences = numpy.frombuffer(experience_column, dtype=numpy.float64)[chunk_start:chunk_stop]
+            levels = numpy.frombuffer(level_column, dtype=numpy.int64)[chunk_start:chunk_stop]
+
+            if maintain_level:
+                new_experiences = curve.get_level_experience_requirements(
+                    self.level_curve.get_levels_from_experiences(experiences))
+                new_levels = levels.copy()
+            else:
+                new_experiences = experiences.copy()
+                new_levels = curve.get_floored_levels_from_experiences(experiences)
+
+            level_changed = new_levels != levels
+            summary.members += chunk_stop - chunk_start
+            summary.levelled_up += int(numpy.count_nonzero(new_levels > levels))
+            summary.levelled_down += int(numpy.count_nonzero(new_levels < levels))
+
+            if not dry_run:
+                entry_changed = level_changed | (new_experiences != experiences)
+                level_changes.extend(zip(user_ids[level_changed].tolist(), new_levels[level_changed].tolist(),
+                                         levels[level_changed].tolist()))
+                self.experience_cache.mark_dirty(user_ids[entry_changed].tolist())
+                experiences[:] = new_experiences
+                levels[:] = new_levels
+
+            # the cache cannot gain users while views of its columns exist, so drop them before yielding
+            del user_ids, experiences, levels
+            chunk_start = chunk_stop
+            await asyncio.sleep(0)
+
+        return summary, level_changes
+
+    async def update_level_curve(self, scalar: Optional[float], power: Optional[float], maintain_level: bool,
+                                 dry_run: bool = False) -> CurveMigrationSummary:
         """Update the level XP requirement curve.
         Level XP Requirement = scalar * Level ** power
 
@@ -543,27 +815,35 @@ class XPHandling(FeatureCog):
         maintain_level : bool
             Whether to change users' XP quantities to keep their levels the same.
             If this is false, users' levels will be changed instead.
+        dry_run : bool
+            Whether to only count the members whose levels would change, without changing anything.
         """
         if scalar is None:
             scalar = self.level_curve_scalar
         if power is None:
             power = self.level_curve_power
         if scalar == self.level_curve_scalar and power == self.level_curve_power:
-            return
+            return CurveMigrationSummary(members=len(self.experience_cache))
 
-        new_curve = self.XPCurve(scalar, power)
+        new_curve = self.XPCurve(scalar, power, self.level_curve_table_maximum_level)
 
-        if maintain_level:
-            self._adjust_xp_quantities_to_curve(new_curve)
-        else:
-            self._adjust_xp_levels_to_curve(new_curve)
+        async with self.experience_lock:
+            summary, level_changes = await self._migrate_experience_to_curve(new_curve, maintain_level, dry_run)
+            if dry_run:
+                return summary
+
+            self.level_curve = new_curve
+            self.level_curve_scalar = scalar
+            self.level_curve_power = power
+            if maintain_level:
+                self.rebuild_rank_index()
+            await self.flush_experience_cache()
 
-        self.level_curve = new_curve
-        self.level_curve_scalar = scalar
-        self.level_curve_power = power
-        self.save_all_guild_data()
+        await self.save_all_guild_data()
+        self.bot.loop.create_task(self.on_levels_changed(level_changes))
+        return summary
 
-    def _execute_add_experience(self, user_id: int, xp_quantity: float):
+    async def _execute_add_experience(self, user_id: int, xp_quantity: float):
         """Add experience to a single user, check for level up, and handle accordingly.
 
         Parameters
@@ -573,155 +853,226 @@ class XPHandling(FeatureCog):
         xp_quantity : float
             The xp quantity to attribute.
         """
-        current_data = self.database_get_by_userid(user_id, ("experience", "experience_level"))
-
-        if current_data is None:
-            self.database_insert_userid(user_id)
-            old_experience, old_level = 0, 0
-        else:
-            old_experience, old_level = current_data["experience"], current_data["experience_level"]
-        new_experience = old_experience + min(xp_quantity, self.xp_gain_cap)
-        new_level = self.level_curve.get_floored_level_from_experience(new_experience)
+        async with self.experience_lock:
+            old_experience, old_level = self.get_cached_experience(user_id)
+            new_experience = old_experience + min(xp_quantity, self.xp_gain_cap)
+            new_level = self.level_curve.get_floored_level_from_experience(new_experience)
 
-        self.database_update_by_userid(user_id, {"experience": new_experience, "experience_level": new_level})
+            self._store_experience(user_id, new_experience, new_level)
 
         if new_level != old_level:
-            self.create_level_up_task(user_id, new_level)
+            await self.submit_level_ups([(user_id, new_level, old_level)])
 
     async def _execute_add_experience_to_many(self, xp_additions: dict[int, float]):
         """Add experience to a bunch of users, check for level ups, and handle accordingly.
+        Members are resolved first, concurrently and as a separate stage, so one uncached member cannot stall the rest.
+        New totals and levels are computed against the experience cache, whose levels mirror the database,
+        then all changed rows are upserted in one transaction before any level-ups are announced.
+        Only the computation and the write hold experience_lock; level-ups are queued after it is released,
+        so that a full level-up queue holds up this flush alone rather than every writer of experience.
 
         Parameters
         ----------
         xp_additions : dict[int, float]
             A dictionary of user_id to xp_quantity to add.
         """
-        current_data = self.database_get_many_by_userid(xp_additions.keys(),
-                                                        ("userid", "experience", "experience_level"))
-
-        to_write = {}
-        to_insert = []
-        with SafeCursor(self.database_connection) as cursor:
-            cursor.execute(f"SELECT * FROM {self.sql_commands.role_scalars_schema}")
-            scalar_roles_data = cursor.fetchall()
-            scalar_roles = {data["roleid"]: (data["scalar"], data["priority"]) for data in scalar_roles_data}
-            del scalar_roles_data
-
-        async def process_addition(user_id: int, old_experience: float, old_level):
-            to_add_experience = min(xp_additions[user_id], self.xp_gain_cap)
-            try:
-                member = await self.bot.lookup_member(user_id)
-            except discord.errors.NotFound:
-                logging.error(f"Failed to add some XP to user with id {user_id} in guild {self.bot.guild.id} as they could not be found.")
-                return
-            except Exception as error:
-                logging.error(f"Failed to add some XP to user with id {user_id} in guild {self.bot.guild.id} for reason: {error}")
-                return
-
-            this_member_scalars = {}
-            for role in member.roles:
-                try:
-                    this_role_scalar_data = scalar_roles[role.id]
-                    this_member_scalars[this_role_scalar_data[1]] = this_role_scalar_data[0]
-                except KeyError:
-                    pass
-
-            if this_member_scalars:
-                experience_scalar = this_member_scalars[max(this_member_scalars.keys())]
-            else:
-                experience_scalar = 1
-            del this_member_scalars
-            new_experience = old_experience + (experience_scalar * to_add_experience)
-            new_level = self.level_curve.get_floored_level_from_experience(new_experience)
+        resolve_start = time.perf_counter()
+        lookup = await self.bot.lookup_members(xp_additions.keys(), self.member_resolution_concurrency)
+        resolve_time = time.perf_counter() - resolve_start
+
+        if lookup.departed:
+            logging.debug(f"Dropped XP for {len(lookup.departed)} departed users in guild {self.bot.guild.id}")
+        for user_id, error in lookup.failed.items():
+            logging.error(f"Failed to add some XP to user with id {user_id} in guild {self.bot.guild.id} for reason: {error}")
+
+        async with self.experience_lock:
+            user_ids: list[int] = []
+            old_experiences: list[float] = []
+            old_levels: list[int] = []
+            scaled_additions: list[float] = []
+            for user_id, member in lookup.members.items():
+                old_experience, old_level = self.get_cached_experience(user_id)
+                user_ids.append(user_id)
+                old_experiences.append(old_experience)
+                old_levels.append(old_level)
+                scaled_additions.append(self.get_scaled_experience_addition(member, xp_additions[user_id]))
+
+            new_experiences = numpy.add(old_experiences, scaled_additions)
+            new_levels = self.level_curve.get_floored_levels_from_experiences(new_experiences)
+
+            level_ups: list[tuple[int, int, int]] = []
+            new_experience_list, new_level_list = new_experiences.tolist(), new_levels.tolist()
+            for user_id, new_experience, new_level, old_level in zip(user_ids, new_experience_list, new_level_list,
+                                                                     old_levels):
+                self._store_experience(user_id, new_experience, new_level)
+                if new_level != old_level:
+                    level_ups.append((user_id, new_level, old_level))
+
+            write_start = time.perf_counter()
+            await self.flush_experience_cache()
+            write_time = time.perf_counter() - write_start
+
+        logging.debug(f"XP flush for guild {self.bot.guild.id}: resolved {len(user_ids)} of {len(xp_additions)} members "
+                      f"in {round(resolve_time * 1000)}ms, wrote to the database in {round(write_time * 1000)}ms")
+
+        await self.submit_level_ups(level_ups)
+
+        if self.speculative_level_up_fraction is not None:
+            await self.fire_level_up_approaching(lookup.members, user_ids, new_experiences, new_level_list,
+                                                 scaled_additions)
+
+    async def fire_level_up_approaching(self, members: dict[int, DiscordMember], user_ids: list[int],
+                                        experiences: numpy.ndarray, levels: list[int], gains: list[float]) -> None:
+        """Fire level_up_approaching_event with those of the given members who are within
+        speculative_level_up_fraction of a level of their next level-up, and the XP each has just gained.
 
-            to_write[user_id] = (new_experience, new_level)
+        Parameters
+        ----------
+        members : dict[int, DiscordMember]
+            A dictionary of user_id to member, for every user in user_ids.
+        user_ids : list[int]
+            The users to check.
+        experiences : numpy.ndarray
+            Each user's XP quantity.
+        levels : list[int]
+            Each user's level.
+        gains : list[float]
+            The XP each user gained in this flush.
+        """
+        progresses = self.level_curve.get_level_progresses_from_experiences(experiences)
+        approaching_indices = numpy.flatnonzero(progresses >= 1 - self.speculative_level_up_fraction).tolist()
+        if not approaching_indices:
+            return
 
-            if new_level != old_level:
-                self.create_level_up_task(user_id, new_level)
+        approaching_members = []
+        approaching_gains = []
+        for index in approaching_indices:
+            user_id = user_ids[index]
+            experience_member = ExperienceMember.cast_from_member(members[user_id], self)
+            experience_member.level = levels[index]
+            experience_member.xp_quantity = float(experiences[index])
+            experience_member.rank = self.rank_index.rank_of(user_id) or "N/A"
+            approaching_members.append(experience_member)
+            approaching_gains.append(gains[index])
+        await self.level_up_approaching_event.fire(approaching_members, approaching_gains)
+
+    def get_member_experience_scalar(self, member: DiscordMember) -> float:
+        """Query the XP scalar of a member's highest-priority scalar role, or 1 if they have none.
+        The result is cached until the member's roles or any role scalar change."""
+        try:
+            return self._member_experience_scalars[member.id]
+        except KeyError:
+            pass
 
-        for row in current_data:
-            await process_addition(row["userid"], row["experience"], row["experience_level"])
-            del xp_additions[row["userid"]]
+        this_member_scalars = {}
+        for role in member.roles:
+            try:
+                this_role_scalar_data = self.role_scalars[role.id]
+                this_member_scalars[this_role_scalar_data[1]] = this_role_scalar_data[0]
+            except KeyError:
+                pass
 
-        for user_id, xp_to_add in xp_additions.items():
-            to_insert.append(user_id)
-            await process_addition(user_id, 0, 0)
+        if this_member_scalars:
+            experience_scalar = this_member_scalars[max(this_member_scalars.keys())]
+        else:
+            experience_scalar = 1
+        self._member_experience_scalars[member.id] = experience_scalar
+        return experience_scalar
 
-        self.database_insert_many_userids(to_insert)
-        self.database_update_many_by_userid(to_write, ("experience", "experience_level"))
-        del to_insert
-        del to_write
+    def get_scaled_experience_addition(self, member: DiscordMember, xp_quantity: float) -> float:
+        """Query how much XP a pending addition is worth to a member, after the gain cap and role scalars."""
+        return self.get_member_experience_scalar(member) * min(xp_quantity, self.xp_gain_cap)
 
     def add_experience_from_action(self, user_id: int, xp_quantity: float):
         self._xp_additions[user_id] += xp_quantity
 
-    def _set_experience(self, user_id: int, xp_quantity: float):
-        current_data = self.database_get_by_userid(user_id, ("experience", "experience_level"))
-
-        if current_data is None:
-            self.database_insert_userid(user_id)
-
+    def _set_experience(self, user_id: int, xp_quantity: float) -> tuple[int, int]:
+        """Store a user's new XP quantity, and return their (new level, old level).
+        Callers hold experience_lock, so that a curve migration cannot interleave with the write, and the level is
+        computed with the curve that the cache is in."""
+        old_level = self.get_cached_experience(user_id)[1]
         new_level = self.level_curve.get_floored_level_from_experience(xp_quantity)
-        self.database_update_by_userid(user_id, {"experience": xp_quantity, "experience_level": new_level})
-        self.bot.loop.create_task(self.on_level_changed(user_id, new_level))
+        self._store_experience(user_id, xp_quantity, new_level)
+        return new_level, old_level
 
-    def _set_experience_level(self, user_id: int, xp_level: float):
+    def _set_experience_level(self, user_id: int, xp_level: float) -> tuple[int, int]:
         new_xp_quantity = self.level_curve.get_level_experience_requirement(xp_level)
-        self._set_experience(user_id, new_xp_quantity)
+        return self._set_experience(user_id, new_xp_quantity)
 
-    def set_member_experience(self, member: discord.Member, coefficient: float, set_type: ExperienceQuantityType):
-        """Method used for setting a member's experience quantity via a command."""
+    async def set_member_experience(self, member: discord.Member, coefficient: float, set_type: ExperienceQuantityType):
+        """Method used for setting a member's experience quantity via a command.
+        Waits for any curve migration in progress to finish first."""
         if coefficient < 0:
             raise exceptions.ValueErrorWithMessage("Coefficient must be positive.")
         if coefficient == 0:
             set_type = ExperienceQuantityType.xp
 
-        if set_type.value == ExperienceQuantityType.xp.value:
-            self._set_experience(member.id, coefficient)
-        elif set_type.value == ExperienceQuantityType.level.value:
-            self._set_experience_level(member.id, coefficient)
-        else:
-            raise ValueError
+        async with self.experience_lock:
+            if set_type.value == ExperienceQuantityType.xp.value:
+                new_level, old_level = self._set_experience(member.id, coefficient)
+            elif set_type.value == ExperienceQuantityType.level.value:
+                new_level, old_level = self._set_experience_level(member.id, coefficient)
+            else:
+                raise ValueError
+        # waits for space in a full queue rather than dropping the change, so that an admin's set or add always
+        # reaches the member's autoroles; the command has deferred its interaction, so it can afford to wait
+        await self.level_changed_queue.submit(member.id, new_level, old_level)
 
-    def _add_experience(self, experience_member: ExperienceMember, xp_quantity: float):
-        new_xp_quantity = experience_member.xp_quantity + xp_quantity
-        self._set_experience(experience_member.id, new_xp_quantity)
+    def _add_experience(self, user_id: int, xp_quantity: float) -> tuple[int, int]:
+        new_xp_quantity = self.get_cached_experience(user_id)[0] + xp_quantity
+        return self._set_experience(user_id, new_xp_quantity)
 
-    def _add_experience_levels(self, experience_member: ExperienceMember, xp_levels: float):
-        new_xp_level = experience_member.get_level_float_from_xp_quantity() + xp_levels
+    def _add_experience_levels(self, user_id: int, xp_levels: float) -> tuple[int, int]:
+        new_xp_level = self.level_curve.get_level_from_experience(self.get_cached_experience(user_id)[0]) + xp_levels
         new_xp_quantity = int(self.level_curve.get_level_experience_requirement(new_xp_level)) + 1
-        self._set_experience(experience_member.id, new_xp_quantity)
+        return self._set_experience(user_id, new_xp_quantity)
 
-    def add_member_experience(self, member: discord.Member, coefficient: float, add_type: ExperienceQuantityType):
-        """Method used for adding experience to a member via a command."""
+    async def add_member_experience(self, member: discord.Member, coefficient: float, add_type: ExperienceQuantityType):
+        """Method used for adding experience to a member via a command.
+        Waits for any curve migration in progress to finish first."""
         if coefficient == 0:
             return
 
-        experience_member = self.convert_to_experience_member(member)
-
-        if add_type.value == ExperienceQuantityType.xp.value:
-            self._add_experience(experience_member, coefficient)
-        elif add_type.value == ExperienceQuantityType.level.value:
-            self._add_experience_levels(experience_member, coefficient)
-        else:
-            raise ValueError
-
-    def get_member_experience_info(self, user_id: int) -> sqlite3.Row or dict:
-        result = self.database_get_by_userid(user_id, ("experience", "experience_level", "rank"))
-
-        if result is None:
-            return {"experience": 0, "experience_level": 0, "rank": "N/A"}
-
-        return result
+        async with self.experience_lock:
+            if add_type.value == ExperienceQuantityType.xp.value:
+                new_level, old_level = self._add_experience(member.id, coefficient)
+            elif add_type.value == ExperienceQuantityType.level.value:
+                new_level, old_level = self._add_experience_levels(member.id, coefficient)
+            else:
+                raise ValueError
+        # waits for space in a full queue rather than dropping the change, so that an admin's set or add always
+        # reaches the member's autoroles; the command has deferred its interaction, so it can afford to wait
+        await self.level_changed_queue.submit(member.id, new_level, old_level)
+
+    async def get_member_experience_info(self, member: DiscordMember) -> dict:
+        """Query a member's experience, level and rank, including XP additions that have not been flushed yet."""
+        experience, level = self.get_cached_experience(member.id)
+
+        pending_xp = self._xp_additions.get(member.id, 0)
+        if pending_xp > 0:
+            experience += self.get_scaled_experience_addition(member, pending_xp)
+            level = self.level_curve.get_floored_level_from_experience(experience)
+
+        return {"experience": experience,
+                "experience_level": level,
+                "rank": self.rank_index.rank_of(member.id) or "N/A"}
+
+    def get_leaderboard_snapshot(self) -> LeaderboardSnapshot:
+        """Query the leaderboard as of the latest change to the rank index. The snapshot is copied from the index
+        when it is first asked for after a change, so an XP flush costs at most one copy however many
+        leaderboard pages are viewed before the next."""
+        if self._leaderboard_snapshot is None or self._leaderboard_snapshot.version != self.rank_index.version:
+            self._leaderboard_snapshot = LeaderboardSnapshot(self.rank_index.sorted_keys(), self.rank_index.version)
+        return self._leaderboard_snapshot
 
     async def get_experience_member(self, user_id: int):
         member = await self.bot.lookup_member(user_id)
         if member is None:
             return None
-        return self.convert_to_experience_member(member)
+        return await self.convert_to_experience_member(member)
 
-    def convert_to_experience_member(self, member: DiscordMember):
-        experience_info = self.get_member_experience_info(member.id)
+    async def convert_to_experience_member(self, member: DiscordMember):
+        experience_info = await self.get_member_experience_info(member)
 
         experience_member = ExperienceMember.cast_from_member(member, self)
         experience_member.level = experience_info["experience_level"]
@@ -740,21 +1091,43 @@ class XPHandling(FeatureCog):
             return f"{round(xp_quantity / 1_000, 1)}K"
         return f"{round(xp_quantity / 1_000_000, 1)}M"
 
-    def create_level_up_task(self, user_id: int, new_level: int):
-        self.bot.loop.create_task(self.on_level_up(user_id, new_level))
-
-    async def on_level_changed(self, user_id: int, new_level: int) -> None:
+    async def on_level_changed(self, user_id: int, new_level: int, old_level: int) -> None:
         member = await(self.get_experience_member(user_id))
-        await self.level_changed_event.fire(member, new_level)
+        if member is None:
+            return
+        await self.level_changed_event.fire(member, new_level, old_level)
+
+    async def submit_level_ups(self, level_ups: list[tuple[int, int, int]]) -> None:
+        """Queue level-up events for many users, waiting for space in the queue as it fills.
+        level_ups_handled_event is fired once the level-up queue has handled them all, and is next empty."""
+        if not level_ups:
+            return
+        for level_up in level_ups:
+            await self.level_up_queue.submit(*level_up)
 
-    async def on_level_up(self, user_id: int, new_level: int) -> None:
+        waiter = asyncio.get_running_loop().create_task(self.fire_level_ups_handled())
+        self._level_ups_handled_waiters.add(waiter)
+        waiter.add_done_callback(self._level_ups_handled_waiters.discard)
+
+    async def fire_level_ups_handled(self) -> None:
+        await self.level_up_queue.join()
+        await self.level_ups_handled_event.fire()
+
+    async def on_levels_changed(self, level_changes: list[tuple[int, int, int]]) -> None:
+        """Queue level-changed events for many users, waiting for space in the queue as it fills."""
+        for level_change in level_changes:
+            await self.level_changed_queue.submit(*level_change)
+
+    async def on_level_up(self, user_id: int, new_level: int, old_level: int) -> None:
         member = await self.get_experience_member(user_id)
-        await self.level_up_event.fire(member, new_level)
+        if member is None:
+            return
+        await self.level_up_event.fire(member, new_level, old_level)
 
     async def do_experience_additions_for_user_id(self, user_id: int):
         to_add = self._xp_additions.pop(user_id)
         if to_add > 0:
-            self._execute_add_experience(user_id, to_add)
+            await self._execute_add_experience(user_id, to_add)
 
     @tasks.loop(seconds=60.0)
     async def do_experience_additions(self):
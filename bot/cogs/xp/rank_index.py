@@ -0,0 +1,182 @@
+from __future__ import annotations
+from typing import Iterable, Iterator, Optional
+from bisect import bisect_left, insort
+from itertools import chain
+
+
+class ExperienceRankIndex:
+    """Order-statistic index over members' experience quantities.
+    Members are ranked by experience descending, with ties broken by ascending user ID.
+
+    Keys are held in sorted blocks, with a Fenwick tree over the block lengths, so that
+    rank-of-user, user-at-rank and the start of a rank-range are all O(log n) lookups.
+
+    version counts the changes made to the index, so that copies of it can tell when they are out of date."""
+
+    __slots__ = (
+        "_blocks",
+        "_maxes",
+        "_tree",
+        "_experience_by_user_id",
+        "version"
+    )
+
+    block_load = 512
+
+    def __init__(self):
+        self._blocks: list[list[tuple[float, int]]] = []
+        self._maxes: list[tuple[float, int]] = []
+        self._tree: list[int] = [0]
+        self._experience_by_user_id: dict[int, float] = {}
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._experience_by_user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._experience_by_user_id
+
+    @staticmethod
+    def _key(user_id: int, experience: float) -> tuple[float, int]:
+        return -experience, user_id
+
+    def _rebuild_tree(self) -> None:
+        tree = [0] * (len(self._blocks) + 1)
+        for block_index, block in enumerate(self._blocks, start=1):
+            tree[block_index] += len(block)
+            parent_index = block_index + (block_index & -block_index)
+            if parent_index < len(tree):
+                tree[parent_index] += tree[block_index]
+        self._tree = tree
+
+    def _tree_add(self, block_index: int, delta: int) -> None:
+        tree_index = block_index + 1
+        while tree_index < len(self._tree):
+            self._tree[tree_index] += delta
+            tree_index += tree_index & -tree_index
+
+    def _tree_prefix(self, block_index: int) -> int:
+        """Count the keys held in all blocks before block_index."""
+        total = 0
+        while block_index > 0:
+            total += self._tree[block_index]
+            block_index -= block_index & -block_index
+        return total
+
+    def _tree_locate(self, position: int) -> tuple[int, int]:
+        """Find the (block index, offset within block) of the key at a zero-based position."""
+        block_index = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            next_index = block_index + step
+            if next_index < len(self._tree) and self._tree[next_index] <= position:
+                block_index = next_index
+                position -= self._tree[next_index]
+            step >>= 1
+        return block_index, position
+
+    def _insert_key(self, key: tuple[float, int]) -> None:
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+
+        block_index = bisect_left(self._maxes, key)
+        if block_index == len(self._blocks):
+            block_index -= 1
+        block = self._blocks[block_index]
+        insort(block, key)
+        self._maxes[block_index] = block[-1]
+
+        if len(block) <= 2 * self.block_load:
+            self._tree_add(block_index, 1)
+            return
+
+        self._blocks.insert(block_index + 1, block[self.block_load:])
+        del block[self.block_load:]
+        self._maxes[block_index] = block[-1]
+        self._maxes.insert(block_index + 1, self._blocks[block_index + 1][-1])
+        self._rebuild_tree()
+
+    def _remove_key(self, key: tuple[float, int]) -> None:
+        block_index = bisect_left(self._maxes, key)
+        block = self._blocks[block_index]
+        del block[bisect_left(block, key)]
+
+        if block:
+            self._maxes[block_index] = block[-1]
+            self._tree_add(block_index, -1)
+            return
+
+        del self._blocks[block_index]
+        del self._maxes[block_index]
+        self._rebuild_tree()
+
+    def load(self, rows: Iterable[tuple[int, float]]) -> None:
+        """Replace the index contents with (user ID, experience) pairs."""
+        self._experience_by_user_id = {user_id: experience for user_id, experience in rows}
+        keys = sorted(self._key(user_id, experience) for user_id, experience in self._experience_by_user_id.items())
+        self._blocks = [keys[start:start + self.block_load] for start in range(0, len(keys), self.block_load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._rebuild_tree()
+        self.version += 1
+
+    def update(self, user_id: int, experience: float) -> None:
+        """Insert a user, or move them to the position for their new experience quantity."""
+        old_experience = self._experience_by_user_id.get(user_id)
+        if old_experience is not None:
+            if old_experience == experience:
+                return
+            self._remove_key(self._key(user_id, old_experience))
+
+        self._experience_by_user_id[user_id] = experience
+        self._insert_key(self._key(user_id, experience))
+        self.version += 1
+
+    def discard(self, user_id: int) -> None:
+        """Remove a user from the index, if they are present."""
+        experience = self._experience_by_user_id.pop(user_id, None)
+        if experience is None:
+            return
+        self._remove_key(self._key(user_id, experience))
+        self.version += 1
+
+    def sorted_keys(self) -> list[tuple[float, int]]:
+        """Copy every (negated experience, user ID) key, best rank first."""
+        return list(chain.from_iterable(self._blocks))
+
+    def rank_of(self, user_id: int) -> Optional[int]:
+        """Query a user's one-based rank, or None if they are not ranked."""
+        experience = self._experience_by_user_id.get(user_id)
+        if experience is None:
+            return None
+
+        key = self._key(user_id, experience)
+        block_index = bisect_left(self._maxes, key)
+        return self._tree_prefix(block_index) + bisect_left(self._blocks[block_index], key) + 1
+
+    def user_at_rank(self, rank: int) -> Optional[int]:
+        """Query the user ID at a one-based rank, or None if the rank is out of range."""
+        if rank < 1 or rank > len(self):
+            return None
+
+        block_index, offset = self._tree_locate(rank - 1)
+        return self._blocks[block_index][offset][1]
+
+    def rank_range(self, from_rank: int, to_rank: int) -> Iterator[tuple[int, int, float]]:
+        """Iterate (rank, user ID, experience) for every rank from from_rank to to_rank inclusive."""
+        from_rank = max(from_rank, 1)
+        to_rank = min(to_rank, len(self))
+        if from_rank > to_rank:
+            return
+
+        block_index, offset = self._tree_locate(from_rank - 1)
+        rank = from_rank
+        while rank <= to_rank:
+            block = self._blocks[block_index]
+            for negative_experience, user_id in block[offset:offset + to_rank - rank + 1]:
+                yield rank, user_id, -negative_experience
+                rank += 1
+            block_index += 1
+            offset = 0
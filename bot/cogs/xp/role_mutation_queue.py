@@ -0,0 +1,134 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterable, Optional
+import asyncio
+import logging
+import discord
+
+if TYPE_CHECKING:
+    from bot.common import GuildBot
+
+
+class PendingRoleMutation:
+    __slots__ = (
+        "member",
+        "to_add",
+        "to_remove",
+        "reasons",
+        "handle"
+    )
+
+    def __init__(self, member: discord.Member):
+        self.member = member
+        self.to_add: dict[int, discord.Role] = {}
+        self.to_remove: dict[int, discord.Role] = {}
+        self.reasons: list[str] = []
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+class RoleMutationQueue:
+    """Outbound queue of role additions and removals, coalesced per member.
+    The first change queued for a member opens a short window; every change queued for them before it closes
+    is merged into one net change, with later changes to the same role overriding earlier ones.
+    The net change is diffed against the member's roles as the gateway has them when the window closes, not as they
+    were when the change was queued, so that roles changed by anyone else in the meantime are left as they are.
+    A net change of one role is made on that role's own route; a larger one is made with a single role edit,
+    unless the member is not cached, in which case each role is added or removed on its own route instead.
+    A change that changes nothing makes no request at all.
+
+    requested_calls counts the add_roles / remove_roles calls that would have been made without the queue,
+    and made_calls the role edits actually made."""
+
+    __slots__ = (
+        "bot",
+        "window",
+        "requested_calls",
+        "made_calls",
+        "_pending",
+        "_tasks"
+    )
+
+    def __init__(self, bot: GuildBot, window: float = 2.0):
+        self.bot = bot
+        self.window = window
+        self.requested_calls = 0
+        self.made_calls = 0
+        self._pending: dict[int, PendingRoleMutation] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def avoided_calls(self) -> int:
+        return self.requested_calls - self.made_calls
+
+    def add_roles(self, member: discord.Member, roles: Iterable[discord.Role], reason: Optional[str] = None) -> None:
+        self._enqueue(member, tuple(roles), tuple(), reason)
+
+    def remove_roles(self, member: discord.Member, roles: Iterable[discord.Role], reason: Optional[str] = None) -> None:
+        self._enqueue(member, tuple(), tuple(roles), reason)
+
+    def _enqueue(self, member: discord.Member, to_add: tuple[discord.Role, ...], to_remove: tuple[discord.Role, ...],
+                 reason: Optional[str]) -> None:
+        if not to_add and not to_remove:
+            return
+        self.requested_calls += 1
+
+        pending = self._pending.get(member.id)
+        if pending is None:
+            pending = PendingRoleMutation(member)
+            pending.handle = asyncio.get_running_loop().call_later(self.window, self._start_apply, member.id)
+            self._pending[member.id] = pending
+
+        pending.member = member
+        for role in to_add:
+            pending.to_remove.pop(role.id, None)
+            pending.to_add[role.id] = role
+        for role in to_remove:
+            pending.to_add.pop(role.id, None)
+            pending.to_remove[role.id] = role
+        if reason is not None and reason not in pending.reasons:
+            pending.reasons.append(reason)
+
+    def _start_apply(self, member_id: int) -> None:
+        task = asyncio.get_running_loop().create_task(self.apply(member_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def apply(self, member_id: int) -> None:
+        """Apply a member's pending change now, rather than when its window closes."""
+        pending = self._pending.pop(member_id, None)
+        if pending is None:
+            return
+        pending.handle.cancel()
+
+        cached_member = self.bot.cached_guild.get_member(member_id)
+        member = cached_member or pending.member
+        held_role_ids = {role.id for role in member.roles if not role.is_default()}
+        to_add = [role for role_id, role in pending.to_add.items() if role_id not in held_role_ids]
+        to_remove = [role for role_id, role in pending.to_remove.items() if role_id in held_role_ids]
+        if not to_add and not to_remove:
+            return
+
+        reason = "; ".join(pending.reasons) or None
+        try:
+            if cached_member is not None and len(to_add) + len(to_remove) > 1:
+                self.made_calls += 1
+                roles = [role for role in member.roles if role.id not in pending.to_remove and not role.is_default()]
+                await member.edit(roles=roles + to_add, reason=reason)
+            else:
+                self.made_calls += len(to_add) + len(to_remove)
+                if to_add:
+                    await member.add_roles(*to_add, reason=reason)
+                if to_remove:
+                    await member.remove_roles(*to_remove, reason=reason)
+        except discord.HTTPException as error:
+            logging.error(f"Failed to edit roles of user with id {member_id}: {error}")
+            return
+        logging.debug(f"Edited roles of user with id {member_id}; "
+                      f"{self.avoided_calls} of {self.requested_calls} role calls avoided so far")
+
+    async def close(self) -> None:
+        """Apply every pending change immediately, and wait for any already being applied."""
+        await asyncio.gather(*[self.apply(member_id) for member_id in list(self._pending.keys())],
+                             *self._tasks)
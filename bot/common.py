@@ -1,9 +1,13 @@
 from __future__ import annotations
-from typing import Awaitable, Callable, Optional
+from typing import Awaitable, Callable, Iterable, Optional
+from dataclasses import dataclass, field
+import asyncio
 import logging
+import time
 import discord
 from discord.ext import commands
 from .theme import EmbedTheme
+from .loop_monitor import EventLoopLagMonitor
 
 
 class FeatureCog(commands.Cog):
@@ -34,7 +38,17 @@ class FeatureCog(commands.Cog):
             await bot.load_extension(dependency)
 
 
+@dataclass
+class MemberLookupResult:
+    members: dict[int, discord.Member] = field(default_factory=dict)
+    departed: set[int] = field(default_factory=set)
+    failed: dict[int, Exception] = field(default_factory=dict)
+
+
 class GuildBot(commands.Bot):
+    member_query_chunk_size = 100
+    departed_member_ttl = 6 * 60 * 60.0
+
     initial_extensions = ["bot.cogs.squad_voice",
                           "bot.cogs.misc.ping",
                           "bot.cogs.misc.restart",
@@ -48,18 +62,118 @@ class GuildBot(commands.Bot):
         self.guild: discord.Guild = guild
         self.embed_theme = EmbedTheme("Main", discord.Colour.from_rgb(0, 145, 255))
         self.loaded_extensions = set()
-
-    async def lookup_member(self, member_id: int):
+        self.loop_lag_monitor = EventLoopLagMonitor()
+        self._departed_member_expiry: dict[int, float] = {}
+
+    def mark_member_departed(self, member_id: int) -> None:
+        """Remember that a user is not in the guild, so lookups skip them until the TTL runs out."""
+        self._departed_member_expiry[member_id] = time.monotonic() + self.departed_member_ttl
+
+    def forget_member_departure(self, member_id: int) -> None:
+        self._departed_member_expiry.pop(member_id, None)
+
+    def is_member_departed(self, member_id: int) -> bool:
+        expiry = self._departed_member_expiry.get(member_id)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self._departed_member_expiry[member_id]
+            return False
+        return True
+
+    def departed_member_ids(self) -> set[int]:
+        """Query the users currently known not to be in the guild."""
+        now = time.monotonic()
+        self._departed_member_expiry = {member_id: expiry for member_id, expiry in self._departed_member_expiry.items()
+                                        if expiry >= now}
+        return set(self._departed_member_expiry.keys())
+
+    async def on_member_remove(self, member: discord.Member) -> None:
+        self.mark_member_departed(member.id)
+
+    async def on_member_join(self, member: discord.Member) -> None:
+        self.forget_member_departure(member.id)
+
+    @property
+    def cached_guild(self) -> discord.Guild:
+        """The gateway's copy of the guild, which holds its member cache. self.guild is fetched over HTTP,
+        so it has no members cached; it stands in until the gateway has delivered the guild."""
+        return self.get_guild(self.guild.id) or self.guild
+
+    async def lookup_member(self, member_id: int) -> Optional[discord.Member]:
+        """Find a member of the guild, or None if they are not in it."""
         if type(member_id) is not int:
             raise TypeError
 
-        member = self.guild.get_member(member_id)
+        member = self.cached_guild.get_member(member_id)
         if member:
             return member
 
-        member = await self.guild.fetch_member(member_id)
+        if self.is_member_departed(member_id):
+            return None
+
+        try:
+            member = await self.guild.fetch_member(member_id)
+        except discord.errors.NotFound:
+            self.mark_member_departed(member_id)
+            return None
         return member
 
+    async def lookup_members(self, member_ids: Iterable[int], concurrency: int = 4) -> MemberLookupResult:
+        """Resolve many members at once. Cache misses are requested from the gateway in chunks,
+        at most `concurrency` chunks at a time; a chunk whose request fails falls back to fetching
+        its members over HTTP, under the same limit. Users the gateway does not return are departed,
+        and users already known to have departed are not looked up at all."""
+        result = MemberLookupResult()
+        guild = self.cached_guild
+        missing_ids: list[int] = []
+        for member_id in member_ids:
+            member = guild.get_member(member_id)
+            if member:
+                result.members[member_id] = member
+            elif self.is_member_departed(member_id):
+                result.departed.add(member_id)
+            else:
+                missing_ids.append(member_id)
+
+        if not missing_ids:
+            return result
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_member(member_id: int) -> None:
+            async with semaphore:
+                try:
+                    result.members[member_id] = await guild.fetch_member(member_id)
+                except discord.errors.NotFound:
+                    self.mark_member_departed(member_id)
+                    result.departed.add(member_id)
+                except Exception as error:
+                    result.failed[member_id] = error
+
+        async def query_chunk(chunk: list[int]) -> None:
+            async with semaphore:
+                try:
+                    members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+                except Exception as error:
+                    logging.warning(f"Gateway member query failed ({error!r}), fetching {len(chunk)} members instead")
+                    members = None
+
+            if members is None:
+                await asyncio.gather(*[fetch_member(member_id) for member_id in chunk])
+                return
+
+            for member in members:
+                result.members[member.id] = member
+            for member_id in chunk:
+                if member_id not in result.members:
+                    self.mark_member_departed(member_id)
+                    result.departed.add(member_id)
+
+        await asyncio.gather(*[query_chunk(missing_ids[chunk_start:chunk_start + self.member_query_chunk_size])
+                               for chunk_start in range(0, len(missing_ids), self.member_query_chunk_size)])
+        return result
+
     async def lookup_channel(self, channel_id: int):
         if type(channel_id) is not int:
             raise TypeError
@@ -72,6 +186,7 @@ class GuildBot(commands.Bot):
         return channel
 
     async def setup_hook(self) -> None:
+        self.loop_lag_monitor.start()
         self.guild = await self.fetch_guild(self.guild.id)
 
         for extension_name in self.initial_extensions:
@@ -0,0 +1,49 @@
+from typing import Optional
+import asyncio
+import logging
+
+
+class EventLoopLagMonitor:
+    """Measures how long the event loop is blocked, by timing how late a periodic wake-up runs.
+    A wake-up that runs late means some callback held the loop for roughly that long."""
+
+    __slots__ = (
+        "interval",
+        "warn_threshold",
+        "worst_lag",
+        "_task"
+    )
+
+    def __init__(self, interval: float = 0.05, warn_threshold: float = 0.25):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.worst_lag: float = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._monitor())
+
+    def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+
+    def reset(self) -> float:
+        """Return the worst lag seen since the last reset, and start measuring afresh."""
+        worst_lag, self.worst_lag = self.worst_lag, 0
+        return worst_lag
+
+    async def _monitor(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected_wake_time = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - expected_wake_time
+
+            if lag > self.worst_lag:
+                self.worst_lag = lag
+            if lag > self.warn_threshold:
+                logging.warning(f"Event loop was blocked for {round(lag * 1000)}ms")
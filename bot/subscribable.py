@@ -1,15 +1,23 @@
-from typing import Callable, Awaitable, Any
+from typing import Callable, Awaitable, Any, Optional
 import asyncio
+import logging
 
 
 class SubscribableEvent:
+    """An event that awaits each of its subscribers whenever it is fired.
+    By default subscribers are awaited one after another. In concurrent mode they are awaited together,
+    each under its own timeout, and a subscriber that fails or times out is logged without affecting the others."""
 
     __slots__ = (
-        "_subscribers"
+        "_subscribers",
+        "concurrent",
+        "subscriber_timeout"
     )
 
-    def __init__(self):
+    def __init__(self, concurrent: bool = False, subscriber_timeout: Optional[float] = None):
         self._subscribers = set()
+        self.concurrent = concurrent
+        self.subscriber_timeout = subscriber_timeout
 
     def subscribe(self, subscriber: Callable[..., Awaitable]):
         self._subscribers.add(subscriber)
@@ -18,5 +26,71 @@ class SubscribableEvent:
         self._subscribers.remove(subscriber)
 
     async def fire(self, *args, **kwargs):
-        for subscriber in self._subscribers:
-            await subscriber(*args, **kwargs)
+        if not self.concurrent:
+            for subscriber in self._subscribers:
+                await subscriber(*args, **kwargs)
+            return
+
+        await asyncio.gather(*[self._notify(subscriber, args, kwargs) for subscriber in self._subscribers])
+
+    async def _notify(self, subscriber: Callable[..., Awaitable], args: tuple, kwargs: dict[str, Any]) -> None:
+        try:
+            await asyncio.wait_for(subscriber(*args, **kwargs), self.subscriber_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Event subscriber {subscriber.__qualname__} timed out after {self.subscriber_timeout}s")
+        except Exception as error:
+            logging.exception(f"Event subscriber {subscriber.__qualname__} failed", exc_info=error)
+
+
+class EventQueue:
+    """Bounded queue of event arguments, worked through by a fixed pool of workers that each await handler(*args).
+    submit() waits while the queue is full, so a burst of events holds up its producer
+    instead of piling up as one task per event."""
+
+    __slots__ = (
+        "handler",
+        "worker_count",
+        "_queue",
+        "_workers"
+    )
+
+    def __init__(self, handler: Callable[..., Awaitable], maximum_size: int = 1_000, worker_count: int = 4):
+        self.handler = handler
+        self.worker_count = worker_count
+        self._queue: asyncio.Queue = asyncio.Queue(maximum_size)
+        self._workers: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self) -> None:
+        """Wait for every queued event to be handled, then stop the workers."""
+        if self._workers:
+            await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    async def submit(self, *args) -> None:
+        """Queue an event, waiting for space if the queue is full."""
+        await self._queue.put(args)
+
+    async def join(self) -> None:
+        """Wait until every event queued so far has been handled."""
+        await self._queue.join()
+
+    async def _work(self) -> None:
+        while True:
+            args = await self._queue.get()
+            try:
+                await self.handler(*args)
+            except Exception as error:
+                logging.exception(f"Failed to handle queued event for {self.handler.__qualname__}", exc_info=error)
+            finally:
+                self._queue.task_done()
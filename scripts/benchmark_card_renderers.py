@@ -0,0 +1,109 @@
+"""Benchmark the card renderer backends against one another, run from the repository root:
+
+    python -m scripts.benchmark_card_renderers [--backends devtools html2image pillow] [--renders 50]
+
+Each backend renders the same display-progress card renders times, one at a time, then renders times more
+worker_count at a time. The first render is timed on its own, as it includes launching the backend:
+a browser for devtools, and a process pool for pillow. html2image launches a browser for every render,
+which is the cost the devtools backend is meant to avoid.
+
+The browser backends need Chrome; with none installed, they are reported as skipped."""
+from __future__ import annotations
+from io import BytesIO
+import argparse
+import asyncio
+import statistics
+import time
+import discord
+from PIL import Image
+from bot.cogs.xp.main import ExperienceMember, XPHandling
+from bot.cogs.xp.card_generator import UserDisplayCard, UserDisplayCardType
+from bot.cogs.xp.card_renderer import CardRenderer, card_renderer_backends
+
+
+class BenchmarkAvatar:
+    key = "benchmark"
+
+
+class BenchmarkMember:
+    """A member to card, with its experience methods borrowed from ExperienceMember."""
+
+    get_experience_above_level = ExperienceMember.get_experience_above_level
+    get_current_level_requirement = ExperienceMember.get_current_level_requirement
+    get_next_level_requirement = ExperienceMember.get_next_level_requirement
+    get_level_progress = ExperienceMember.get_level_progress
+
+    def __init__(self):
+        self.id = 1
+        self.display_name = "Lordfirespeed"
+        self.discriminator = "0"
+        self.display_avatar = BenchmarkAvatar()
+        self.colour = discord.Colour(0x3498db)
+        self.xp_handler = XPHandling.__new__(XPHandling)
+        self.xp_handler.level_curve = XPHandling.XPCurve(100, 2)
+        self.xp_quantity = 12_345.0
+        self.level = self.xp_handler.level_curve.get_floored_level_from_experience(self.xp_quantity)
+        self.rank = 3
+
+
+def make_card() -> UserDisplayCard:
+    card = UserDisplayCard(BenchmarkMember(), UserDisplayCardType.DisplayProgress)
+    avatar = Image.linear_gradient("L").resize((card.avatar_size, card.avatar_size)).convert("RGB")
+    avatar_png = BytesIO()
+    avatar.save(avatar_png, "PNG")
+    card.avatar_png = avatar_png.getvalue()
+    return card
+
+
+def describe(timings: list[float]) -> str:
+    return (f"median {statistics.median(timings) * 1000:.0f}ms, "
+            f"p95 {statistics.quantiles(timings, n=20)[-1] * 1000:.0f}ms, "
+            f"worst {max(timings) * 1000:.0f}ms")
+
+
+async def timed_render(renderer: CardRenderer, card: UserDisplayCard) -> float:
+    render_start = time.perf_counter()
+    await renderer.render(card)
+    return time.perf_counter() - render_start
+
+
+async def benchmark(backend_name: str, renders: int, worker_count: int) -> None:
+    card = make_card()
+    try:
+        renderer = card_renderer_backends[backend_name](worker_count)
+    except FileNotFoundError as error:
+        print(f"{backend_name:>10}: skipped, {error}")
+        return
+
+    try:
+        first_render = await timed_render(renderer, card)
+        sequential = [await timed_render(renderer, card) for _ in range(renders)]
+        concurrent_start = time.perf_counter()
+        concurrent = await asyncio.gather(*[timed_render(renderer, card) for _ in range(renders)])
+        concurrent_time = time.perf_counter() - concurrent_start
+    except (FileNotFoundError, ConnectionError) as error:
+        print(f"{backend_name:>10}: skipped, {error}")
+        return
+    finally:
+        await renderer.close()
+
+    print(f"{backend_name:>10}: first render {first_render * 1000:.0f}ms")
+    print(f"{'':>10}  one at a time: {describe(sequential)} over {renders} renders")
+    print(f"{'':>10}  {worker_count} at a time: {describe(concurrent)}, "
+          f"{renders / concurrent_time:.1f} cards/s")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the card renderer backends.")
+    parser.add_argument("--backends", nargs="+", choices=card_renderer_backends.keys(),
+                        default=list(card_renderer_backends.keys()))
+    parser.add_argument("--renders", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2)
+    arguments = parser.parse_args()
+
+    for backend_name in arguments.backends:
+        await benchmark(backend_name, arguments.renders, arguments.workers)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
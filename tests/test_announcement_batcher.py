@@ -0,0 +1,67 @@
+"""Tests for the level-up announcement batcher, and the signal that flushes it, run from the repository root:
+
+    python -m unittest tests.test_announcement_batcher"""
+from types import SimpleNamespace
+import asyncio
+import unittest
+from bot.subscribable import EventQueue, SubscribableEvent
+from bot.cogs.xp.main import XPHandling
+from bot.cogs.xp.announcement_batcher import AnnouncementBatcher, LevelUpAnnouncementMode
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages: list[list[str]] = []
+
+    async def send(self, files):
+        self.messages.append([file.filename for file in files])
+
+
+class AnnouncementBatcherTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.channel = FakeChannel()
+        self.announcements = AnnouncementBatcher(send_interval=0.0)
+        self.announcements.channel = self.channel
+
+    async def test_immediate_mode_sends_each_card(self):
+        for index in range(3):
+            self.announcements.add(f"{index}.png", b"")
+            await asyncio.sleep(0)
+        await self.announcements.close()
+
+        self.assertEqual(self.channel.messages, [["0.png"], ["1.png"], ["2.png"]])
+
+    async def test_digest_mode_holds_cards_until_flushed(self):
+        self.announcements.mode = LevelUpAnnouncementMode.Digest
+        for index in range(12):
+            self.announcements.add(f"{index}.png", b"")
+        await asyncio.sleep(0)
+        self.assertEqual(self.channel.messages, [])
+
+        await self.announcements.flush()
+        self.assertEqual([len(message) for message in self.channel.messages], [10, 2])
+
+    async def test_digest_mode_flushes_once_level_ups_are_handled(self):
+        self.announcements.mode = LevelUpAnnouncementMode.Digest
+
+        async def announce_level_up(user_id: int, new_level: int, old_level: int) -> None:
+            # level-up cards take a varying time to render, longer than the XP flush takes to submit them
+            await asyncio.sleep(0.01 * user_id)
+            self.announcements.add(f"{user_id}.png", b"")
+
+        handler = SimpleNamespace(level_up_queue=EventQueue(announce_level_up, worker_count=2),
+                                  level_ups_handled_event=SubscribableEvent(),
+                                  _level_ups_handled_waiters=set())
+        handler.fire_level_ups_handled = lambda: XPHandling.fire_level_ups_handled(handler)
+        handler.level_ups_handled_event.subscribe(self.announcements.flush)
+        handler.level_up_queue.start()
+        self.addAsyncCleanup(handler.level_up_queue.stop)
+
+        await XPHandling.submit_level_ups(handler, [(user_id, 2, 1) for user_id in range(1, 6)])
+        await asyncio.wait_for(asyncio.gather(*handler._level_ups_handled_waiters), 1.0)
+
+        self.assertEqual(self.channel.messages, [[f"{user_id}.png" for user_id in range(1, 6)]])
+
+
+if __name__ == "__main__":
+    unittest.main()
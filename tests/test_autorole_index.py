@@ -0,0 +1,94 @@
+"""Tests for the autorole index against the SQL conditions it replaced, run from the repository root:
+
+    python -m unittest tests.test_autorole_index"""
+import random
+import sqlite3
+import unittest
+from bot.cogs.xp.autorole_index import AutoroleIndex
+
+
+class AutoroleIndexTests(unittest.TestCase):
+    rule_set_count = 200
+    maximum_level = 30
+
+    def setUp(self) -> None:
+        self.random = random.Random(0)
+        self.connection = sqlite3.connect(":memory:")
+        self.addCleanup(self.connection.close)
+        self.connection.execute("CREATE TABLE auto_roles (roleid INTEGER PRIMARY KEY, assign_at INTEGER, remove_at INTEGER)")
+
+    def load_rules(self, rules: list[tuple[int, int, int]]) -> AutoroleIndex:
+        self.connection.execute("DELETE FROM auto_roles")
+        self.connection.executemany("INSERT INTO auto_roles VALUES (?, ?, ?)", rules)
+        index = AutoroleIndex()
+        index.load(rules)
+        return index
+
+    def select_role_ids(self, condition: str, fields: tuple[int, ...]) -> frozenset[int]:
+        rows = self.connection.execute(f"SELECT roleid FROM auto_roles WHERE {condition}", fields)
+        return frozenset(role_id for role_id, in rows)
+
+    def assign_role_ids(self, level: int) -> frozenset[int]:
+        return self.select_role_ids("assign_at<=? AND (remove_at>? OR remove_at<=0)", (level, level))
+
+    def deassign_role_ids(self, level: int) -> frozenset[int]:
+        return self.select_role_ids("assign_at >? OR (remove_at<=? AND remove_at>0)", (level, level))
+
+    def random_rules(self) -> list[tuple[int, int, int]]:
+        rules = []
+        for role_id in range(self.random.randrange(8)):
+            assign_at = self.random.randrange(self.maximum_level)
+            # a remove_at of zero or below never removes the role, and one at or below assign_at never assigns it
+            remove_at = self.random.choice([0, -1, self.random.randrange(self.maximum_level)])
+            rules.append((role_id, assign_at, remove_at))
+        return rules
+
+    def test_roles_at_level_match_sql(self):
+        for _ in range(self.rule_set_count):
+            index = self.load_rules(self.random_rules())
+            for level in range(-1, self.maximum_level + 2):
+                self.assertEqual(index.role_ids_at(level), self.assign_role_ids(level))
+                self.assertEqual(index.role_ids_not_at(level), self.deassign_role_ids(level))
+
+    def test_diff_matches_sql(self):
+        for _ in range(self.rule_set_count):
+            index = self.load_rules(self.random_rules())
+            for _ in range(20):
+                old_level, new_level = (self.random.randrange(self.maximum_level) for _ in range(2))
+                old_role_ids, new_role_ids = self.assign_role_ids(old_level), self.assign_role_ids(new_level)
+                expected_diff = new_role_ids - old_role_ids, old_role_ids - new_role_ids
+                self.assertEqual(index.diff(old_level, new_level), expected_diff)
+                # a second lookup is served from the memo
+                self.assertEqual(index.diff(old_level, new_level), expected_diff)
+
+    def test_rule_changes_match_sql(self):
+        rules = {role_id: (assign_at, remove_at) for role_id, assign_at, remove_at in self.random_rules()}
+        index = self.load_rules([(role_id, *rule) for role_id, rule in rules.items()])
+        for _ in range(100):
+            role_id = self.random.randrange(10)
+            if self.random.random() < 0.3:
+                index.remove_rule(role_id)
+                rules.pop(role_id, None)
+            else:
+                index.diff(0, self.maximum_level)
+                rule = self.random.randrange(self.maximum_level), self.random.randrange(-1, self.maximum_level)
+                index.set_rule(role_id, *rule)
+                rules[role_id] = rule
+            self.connection.execute("DELETE FROM auto_roles")
+            self.connection.executemany("INSERT INTO auto_roles VALUES (?, ?, ?)",
+                                        [(role_id, *rule) for role_id, rule in rules.items()])
+
+            self.assertEqual(index.role_ids, frozenset(rules.keys()))
+            for level in range(self.maximum_level + 1):
+                self.assertEqual(index.role_ids_at(level), self.assign_role_ids(level))
+            old_role_ids, new_role_ids = self.assign_role_ids(0), self.assign_role_ids(self.maximum_level)
+            self.assertEqual(index.diff(0, self.maximum_level), (new_role_ids - old_role_ids, old_role_ids - new_role_ids))
+
+    def test_empty_index(self):
+        index = AutoroleIndex()
+        self.assertEqual(index.role_ids_at(5), frozenset())
+        self.assertEqual(index.diff(0, 5), (frozenset(), frozenset()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Visual regression tests for the Pillow card painter, run from the repository root:
+
+    python -m unittest tests.test_card_painter
+
+Each case paints a card from fixed fields and compares it with its reference PNG in tests/reference_cards.
+After an intended change to how cards look, regenerate the references with UPDATE_REFERENCE_CARDS=1 set,
+and look over the new images before committing them."""
+from typing import Any, Optional
+from io import BytesIO
+from pathlib import Path
+import json
+import os
+import unittest
+from PIL import Image, ImageChops
+from bot.cogs.xp.card_painter import CardPainter
+
+
+reference_directory = Path(__file__).parent / "reference_cards"
+update_references = os.getenv("UPDATE_REFERENCE_CARDS") == "1"
+
+
+def make_avatar() -> bytes:
+    """A deterministic stand-in avatar: a diagonal colour gradient."""
+    gradient = Image.linear_gradient("L").resize((128, 128))
+    avatar = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+    output = BytesIO()
+    avatar.save(output, "PNG")
+    return output.getvalue()
+
+
+def make_fields(**overrides: Any) -> dict[str, Any]:
+    fields = {"username": "Lordfirespeed",
+              "discriminator": "0",
+              "level": 12,
+              "rank": 3,
+              "xp_quantity": "1.2K",
+              "user_colour": "52,152,219",
+              "previous_level_requirement": 1000,
+              "next_level_requirement": 1500,
+              "level_progress_percentage": 40,
+              "party1": "🥳",
+              "party2": "🎉"}
+    fields.update(overrides)
+    return fields
+
+
+class CardPainterVisualRegressionTests(unittest.TestCase):
+    # how far a channel may stray from the reference before its pixel counts as changed, and how many may change,
+    # so that anti-aliasing differences between FreeType versions do not fail the comparison
+    channel_tolerance = 16
+    changed_pixel_fraction_tolerance = 0.002
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.painter = CardPainter()
+        cls.avatar_png = make_avatar()
+
+    def assert_matches_reference(self, name: str, card_type_name: str, fields: dict[str, Any],
+                                 avatar_png: Optional[bytes]) -> None:
+        card_png = self.painter.paint(card_type_name, fields, avatar_png)
+        reference_path = reference_directory / f"{name}.png"
+        if update_references:
+            reference_directory.mkdir(exist_ok=True)
+            reference_path.write_bytes(card_png)
+            return
+
+        with Image.open(BytesIO(card_png)) as card, Image.open(reference_path) as reference:
+            self.assertEqual(card.size, reference.size)
+            difference = ImageChops.difference(card.convert("RGB"), reference.convert("RGB"))
+        changed = difference.point(lambda value: 255 if value > self.channel_tolerance else 0).convert("L")
+        changed_fraction = changed.histogram()[255] / (changed.width * changed.height)
+        self.assertLessEqual(changed_fraction, self.changed_pixel_fraction_tolerance,
+                             f"{name} differs from its reference in {changed_fraction:.2%} of its pixels")
+
+    def test_display_progress(self):
+        self.assert_matches_reference("display_progress", "DisplayProgress", make_fields(), self.avatar_png)
+
+    def test_display_progress_without_avatar(self):
+        self.assert_matches_reference("display_progress_without_avatar", "DisplayProgress",
+                                      make_fields(level_progress_percentage=0), None)
+
+    def test_display_progress_full_bar(self):
+        self.assert_matches_reference("display_progress_full_bar", "DisplayProgress",
+                                      make_fields(level_progress_percentage=100), self.avatar_png)
+
+    def test_level_up(self):
+        self.assert_matches_reference("level_up", "LevelUp", make_fields(), self.avatar_png)
+
+    def test_level_up_long_name(self):
+        self.assert_matches_reference("level_up_long_name", "LevelUp",
+                                      make_fields(username="AnExceedinglyLongDisplayNameForACard", party1="🌌"),
+                                      self.avatar_png)
+
+
+class CardPainterEmojiTests(unittest.TestCase):
+    def test_every_party_emoji_has_a_glyph(self):
+        with open("data/xp/party_emojis.json") as party_emoji_file:
+            party_emoji_data = json.load(party_emoji_file)
+        emoji_font = CardPainter()._emoji_font(46)
+        for emoji in party_emoji_data["main"] + list(party_emoji_data["rare"].keys()):
+            with self.subTest(emoji=emoji):
+                self.assertIsNotNone(emoji_font.getmask(emoji, mode="RGBA").getbbox())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Tests for the card render scheduler's workers, run from the repository root:
+
+    python -m unittest tests.test_card_render_scheduler"""
+from types import SimpleNamespace
+from unittest import mock
+import asyncio
+import unittest
+from bot.cogs.xp import card_renderer
+from bot.cogs.xp.card_generator import CardRenderScheduler, RenderPriority
+
+
+class FakeCard:
+    """Just enough of a UserDisplayCard to be scheduled, rendered when its render event is set."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.member = SimpleNamespace(id=1)
+        self.card_type = SimpleNamespace(name="LevelUp")
+        self.render_event = asyncio.Event()
+        self.render_event.set()
+
+    def get_cache_key(self) -> str:
+        return self.key
+
+    async def render_uncached(self) -> bytes:
+        await self.render_event.wait()
+        return self.key.encode()
+
+
+class CardRenderSchedulerWorkerTests(unittest.IsolatedAsyncioTestCase):
+    render_timeout = 1.0
+
+    async def asyncSetUp(self) -> None:
+        patch = mock.patch.object(card_renderer, "_card_renderer", SimpleNamespace(worker_count=1))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.scheduler = CardRenderScheduler()
+
+    async def test_cancelled_worker_fails_shared_render(self):
+        card = FakeCard("card")
+        card.render_event.clear()
+        requests = [asyncio.create_task(self.scheduler.render(card, RenderPriority.Background)) for _ in range(2)]
+        while not self.scheduler._running[RenderPriority.Background]:
+            await asyncio.sleep(0)
+        self.assertEqual(self.scheduler.merged_requests, 1)
+
+        for worker in list(self.scheduler._workers):
+            worker.cancel()
+        for request in requests:
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(request, self.render_timeout)
+        self.assertFalse(self.scheduler._in_flight)
+        self.assertFalse(self.scheduler._workers)
+
+    async def test_render_queued_as_worker_stops_is_rendered(self):
+        self.scheduler.prerender(FakeCard("prerendered"))
+        worker, = self.scheduler._workers
+        # the worker has found the queue empty and stopped, but its task's done callbacks have not run yet
+        while not worker.done():
+            await asyncio.sleep(0)
+
+        png_bytes = await asyncio.wait_for(self.scheduler.render(FakeCard("card"), RenderPriority.Background),
+                                           self.render_timeout)
+        self.assertEqual(png_bytes, b"card")
+
+
+if __name__ == "__main__":
+    unittest.main()
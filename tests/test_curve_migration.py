@@ -0,0 +1,102 @@
+"""Tests for migrating members' experience to a new level curve, run from the repository root:
+
+    python -m unittest tests.test_curve_migration"""
+from types import SimpleNamespace
+import asyncio
+import unittest
+from bot.subscribable import EventQueue
+from bot.cogs.xp.main import XPHandling, ExperienceQuantityType
+from bot.cogs.xp.experience_cache import ExperienceCache
+from bot.cogs.xp.rank_index import ExperienceRankIndex
+
+
+class StandInHandler:
+    """Just enough of an XPHandling to migrate and set experience, with its methods borrowed from XPHandling."""
+
+    XPCurve = XPHandling.XPCurve
+    curve_migration_chunk_size = 2
+    level_curve_table_maximum_level = 1_000
+
+    _migrate_experience_to_curve = XPHandling._migrate_experience_to_curve
+    update_level_curve = XPHandling.update_level_curve
+    set_member_experience = XPHandling.set_member_experience
+    add_member_experience = XPHandling.add_member_experience
+    _set_experience = XPHandling._set_experience
+    _set_experience_level = XPHandling._set_experience_level
+    _add_experience = XPHandling._add_experience
+    _add_experience_levels = XPHandling._add_experience_levels
+    _store_experience = XPHandling._store_experience
+    get_cached_experience = XPHandling.get_cached_experience
+    rebuild_rank_index = XPHandling.rebuild_rank_index
+    on_levels_changed = XPHandling.on_levels_changed
+
+    def __init__(self, member_count: int):
+        self.level_curve_scalar = 100
+        self.level_curve_power = 2
+        self.level_curve = self.XPCurve(self.level_curve_scalar, self.level_curve_power,
+                                        self.level_curve_table_maximum_level)
+        self.experience_cache = ExperienceCache()
+        self.experience_cache.load((user_id, 900.0, 3) for user_id in range(member_count))
+        self.rank_index = ExperienceRankIndex()
+        self.departed_user_ids: set[int] = set()
+        self.experience_lock = asyncio.Lock()
+        self.level_changed_queue = EventQueue(self.ignore_level_change)
+        self.bot = SimpleNamespace(loop=asyncio.get_running_loop())
+
+    async def ignore_level_change(self, *args) -> None:
+        pass
+
+    async def flush_experience_cache(self) -> None:
+        self.experience_cache.take_dirty()
+
+    async def save_all_guild_data(self) -> None:
+        pass
+
+
+class CurveMigrationTests(unittest.IsolatedAsyncioTestCase):
+    member_count = 20
+
+    async def migrate_while(self, handler: StandInHandler, maintain_level: bool, command) -> None:
+        """Run a command once the migration has rewritten the first chunk, but not the rest."""
+        migration = asyncio.create_task(handler.update_level_curve(200, 2, maintain_level))
+        await asyncio.sleep(0)
+        self.assertFalse(migration.done())
+        await asyncio.gather(migration, command())
+
+    def assert_consistent(self, handler: StandInHandler) -> None:
+        for user_id, experience, level in handler.experience_cache.items():
+            self.assertEqual(level, handler.level_curve.get_floored_level_from_experience(experience), user_id)
+
+    async def test_set_during_migration_uses_new_curve(self):
+        handler = StandInHandler(self.member_count)
+        member = SimpleNamespace(id=0)
+        await self.migrate_while(handler, False,
+                                 lambda: handler.set_member_experience(member, 900, ExperienceQuantityType.xp))
+
+        self.assertEqual(handler.get_cached_experience(0), (900.0, 2))
+        self.assert_consistent(handler)
+
+    async def test_set_level_during_migration_keeping_levels_uses_new_curve(self):
+        handler = StandInHandler(self.member_count)
+        member = SimpleNamespace(id=0)
+        await self.migrate_while(handler, True,
+                                 lambda: handler.set_member_experience(member, 2, ExperienceQuantityType.level))
+
+        self.assertEqual(handler.get_cached_experience(0), (800.0, 2))
+        self.assert_consistent(handler)
+        self.assertEqual(handler.rank_index.user_at_rank(self.member_count), 0)
+
+    async def test_add_during_migration_adds_to_migrated_experience(self):
+        handler = StandInHandler(self.member_count)
+        member = SimpleNamespace(id=0)
+        await self.migrate_while(handler, True,
+                                 lambda: handler.add_member_experience(member, 100, ExperienceQuantityType.xp))
+
+        experience, level = handler.get_cached_experience(0)
+        self.assertAlmostEqual(experience, 1_900.0)
+        self.assertEqual(level, 3)
+        self.assert_consistent(handler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Tests for the DevTools card renderer's recovery from a hung browser, run from the repository root:
+
+    python -m unittest tests.test_devtools_renderer
+
+The browser is faked, so that the tests run without Chrome."""
+from typing import Any, Optional
+import asyncio
+import base64
+import unittest
+from bot.cogs.xp.card_renderer import DevToolsRenderer
+
+
+class FakeProcess:
+    pid = 0
+
+    def __init__(self):
+        self.returncode: Optional[int] = None
+
+    def kill(self) -> None:
+        self.returncode = -9
+
+    async def wait(self) -> int:
+        return self.returncode
+
+
+class FakeWebsocket:
+    closed = False
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class FakeBrowserRenderer(DevToolsRenderer):
+    """A DevTools renderer whose browser answers every command at once, except that the browsers in hung_generations
+    never answer the commands in hung_methods."""
+
+    render_timeout = 0.05
+
+    def __init__(self, hung_generations: set[int], hung_methods: set[str]):
+        super().__init__(worker_count=1, executable="chrome")
+        self.hung_generations = hung_generations
+        self.hung_methods = hung_methods
+        self.processes: list[FakeProcess] = []
+
+    async def _launch(self) -> None:
+        self._process = FakeProcess()
+        self._websocket = FakeWebsocket()
+        self._generation += 1
+        self.processes.append(self._process)
+
+    async def _send(self, method: str, params: Optional[dict[str, Any]] = None,
+                    session_id: Optional[str] = None) -> dict[str, Any]:
+        if self._generation in self.hung_generations and method in self.hung_methods:
+            await asyncio.get_running_loop().create_future()
+        if method == "Target.createTarget":
+            return {"targetId": "target"}
+        if method == "Target.attachToTarget":
+            return {"sessionId": "session"}
+        if method == "Page.navigate":
+            self._page_loads[session_id].set_result(None)
+        if method == "Page.captureScreenshot":
+            return {"data": base64.b64encode(b"card").decode()}
+        return {}
+
+
+class DevToolsRendererRecoveryTests(unittest.IsolatedAsyncioTestCase):
+    test_timeout = 1.0
+
+    async def test_hung_browser_is_restarted(self):
+        renderer = FakeBrowserRenderer({1}, {"Page.captureScreenshot"})
+        with self.assertLogs(level="WARNING"):
+            png_bytes = await asyncio.wait_for(renderer.render_url("about:blank", (1, 1)), self.test_timeout)
+
+        self.assertEqual(png_bytes, b"card")
+        self.assertEqual(len(renderer.processes), 2)
+        self.assertIsNotNone(renderer.processes[0].returncode)
+        self.assertIsNone(renderer.processes[1].returncode)
+
+    async def test_hung_page_close_does_not_hold_render(self):
+        renderer = FakeBrowserRenderer({1}, {"Page.captureScreenshot", "Target.closeTarget"})
+        with self.assertLogs(level="WARNING"):
+            png_bytes = await asyncio.wait_for(renderer.render_url("about:blank", (1, 1)), self.test_timeout)
+
+        self.assertEqual(png_bytes, b"card")
+        self.assertEqual(len(renderer.processes), 2)
+
+    async def test_browser_hung_twice_fails_render(self):
+        renderer = FakeBrowserRenderer({1, 2}, {"Page.captureScreenshot"})
+        with self.assertLogs(level="WARNING"), self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(renderer.render_url("about:blank", (1, 1)), self.test_timeout)
+        self.assertFalse(renderer.running)
+
+    async def test_hung_browser_is_restarted_once_for_concurrent_renders(self):
+        renderer = FakeBrowserRenderer({1}, {"Page.captureScreenshot"})
+        renderer.worker_count = 2
+        await renderer.start()
+        renders = [renderer.render_url("about:blank", (1, 1)) for _ in range(2)]
+        with self.assertLogs(level="WARNING"):
+            png_bytes = await asyncio.wait_for(asyncio.gather(*renders), self.test_timeout)
+
+        self.assertEqual(png_bytes, [b"card", b"card"])
+        self.assertEqual(len(renderer.processes), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
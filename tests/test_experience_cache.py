@@ -0,0 +1,64 @@
+"""Tests for the experience cache's write-back tracking, run from the repository root:
+
+    python -m unittest tests.test_experience_cache"""
+import unittest
+from bot.cogs.xp.experience_cache import ExperienceCache
+
+
+class ExperienceCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = ExperienceCache()
+        self.cache.load([(10, 100.0, 1), (20, 400.0, 2), (30, 900.0, 3)])
+
+    def test_loaded_rows_are_clean(self):
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.dirty_count, 0)
+        self.assertEqual(self.cache.take_dirty(), [])
+        self.assertEqual(self.cache.get(20), (400.0, 2))
+        self.assertIsNone(self.cache.get(40))
+
+    def test_set_marks_row_dirty_once(self):
+        self.cache.set(20, 450.0, 2)
+        self.cache.set(20, 500.0, 2)
+        self.assertEqual(self.cache.dirty_count, 1)
+        self.assertEqual(self.cache.take_dirty(), [(20, 500.0, 2)])
+        self.assertEqual(self.cache.get(20), (500.0, 2))
+
+    def test_take_dirty_marks_rows_clean(self):
+        self.cache.set(10, 150.0, 1)
+        self.cache.take_dirty()
+        self.assertEqual(self.cache.dirty_count, 0)
+        self.assertEqual(self.cache.take_dirty(), [])
+
+    def test_set_new_user_adds_dirty_row(self):
+        self.cache.set(40, 0.0, 0)
+        self.assertIn(40, self.cache)
+        self.assertEqual(len(self.cache), 4)
+        self.assertEqual(self.cache.take_dirty(), [(40, 0.0, 0)])
+        self.assertEqual(list(self.cache.items())[-1], (40, 0.0, 0))
+
+    def test_mark_dirty_requeues_failed_rows(self):
+        self.cache.set(10, 150.0, 1)
+        self.cache.set(30, 1_000.0, 3)
+        failed_rows = self.cache.take_dirty()
+
+        self.cache.mark_dirty([user_id for user_id, _, _ in failed_rows] + [40])
+        self.assertEqual(sorted(self.cache.take_dirty()), [(10, 150.0, 1), (30, 1_000.0, 3)])
+
+    def test_requeued_rows_are_written_with_their_latest_values(self):
+        self.cache.set(10, 150.0, 1)
+        self.cache.take_dirty()
+        self.cache.set(10, 200.0, 1)
+        self.cache.mark_dirty([10])
+        self.assertEqual(self.cache.take_dirty(), [(10, 200.0, 1)])
+
+    def test_load_discards_dirty_rows(self):
+        self.cache.set(10, 150.0, 1)
+        self.cache.load([(50, 0.0, 0)])
+        self.assertEqual(self.cache.dirty_count, 0)
+        self.assertNotIn(10, self.cache)
+        self.assertEqual(list(self.cache.items()), [(50, 0.0, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Tests for paging through a leaderboard snapshot, run from the repository root:
+
+    python -m unittest tests.test_leaderboard_snapshot"""
+import unittest
+from bot.cogs.xp.leaderboard_snapshot import LeaderboardPage, LeaderboardSnapshot
+
+
+class LeaderboardSnapshotPagingTests(unittest.TestCase):
+    row_count = 1_000
+    page_size = 7
+
+    def setUp(self) -> None:
+        # ties on experience are broken by user ID, as the rank index orders them
+        self.keys = sorted((-float(user_id // 3), user_id) for user_id in range(self.row_count))
+        self.snapshot = LeaderboardSnapshot(self.keys, version=1)
+
+    def walk_forward(self, page: LeaderboardPage) -> list[LeaderboardPage]:
+        pages = [page]
+        while pages[-1].has_next:
+            pages.append(self.snapshot.page_after(pages[-1].last_key, self.page_size))
+        return pages
+
+    def walk_backward(self, page: LeaderboardPage) -> list[LeaderboardPage]:
+        pages = [page]
+        while pages[-1].has_previous:
+            pages.append(self.snapshot.page_before(pages[-1].first_key, self.page_size))
+        return pages[::-1]
+
+    def assert_every_row_once(self, pages: list[LeaderboardPage]) -> None:
+        rows = [row for page in pages for row in page.rows]
+        self.assertEqual([rank for rank, _, _ in rows], list(range(1, self.row_count + 1)))
+        self.assertEqual([(-experience, user_id) for _, user_id, experience in rows], self.keys)
+
+    def test_walk_forward_from_first_page(self):
+        pages = self.walk_forward(self.snapshot.page_after(None, self.page_size))
+        self.assert_every_row_once(pages)
+
+    def test_walk_backward_from_last_page(self):
+        pages = self.walk_backward(self.snapshot.last_page(self.page_size))
+        self.assert_every_row_once(pages)
+        self.assertTrue(all(len(page.rows) == self.page_size for page in pages[:-1]))
+
+    def test_walk_backward_then_forward_from_last_page(self):
+        last_page = self.snapshot.last_page(self.page_size)
+        backward = self.walk_backward(last_page)
+        forward = self.walk_forward(backward[0])
+        self.assert_every_row_once(forward)
+        self.assertEqual(forward[-1], last_page)
+
+    def test_walk_backward_from_unaligned_page(self):
+        pages = self.walk_backward(self.snapshot.page_at_rank(998, self.page_size))
+        self.assertEqual(len(pages[0].rows), (998 - 1) % self.page_size)
+        self.assert_every_row_once(pages)
+
+    def test_last_page_of_exact_pages_is_full(self):
+        snapshot = LeaderboardSnapshot(self.keys[:994], version=1)
+        self.assertEqual(snapshot.last_page(self.page_size).rows[0][0], 988)
+
+    def test_empty_snapshot(self):
+        snapshot = LeaderboardSnapshot([], version=1)
+        for page in snapshot.page_after(None, self.page_size), snapshot.last_page(self.page_size):
+            self.assertEqual(page.rows, [])
+            self.assertFalse(page.has_previous or page.has_next)
+
+
+if __name__ == "__main__":
+    unittest.main()
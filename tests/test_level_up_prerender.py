@@ -0,0 +1,153 @@
+"""Tests that speculative pre-renders of level-up cards match the cards members are actually announced with,
+run from the repository root:
+
+    python -m unittest tests.test_level_up_prerender"""
+from types import SimpleNamespace
+from pathlib import Path
+from unittest import mock
+import asyncio
+import copy
+import json
+import tempfile
+import unittest
+import discord
+from bot.subscribable import SubscribableEvent
+from bot.cogs.xp import avatar_cache, card_generator, card_renderer
+from bot.cogs.xp.main import ExperienceMember, XPHandling
+from bot.cogs.xp.card_generator import RenderPriority, UserDisplayCard, UserDisplayCardType
+from bot.cogs.xp.commands.announce import AnnounceLevelUps
+
+
+class FieldsRenderer(card_renderer.CardRenderer):
+    """Renders a card as its non-random fields, so that a card can be told apart from another by its bytes alone."""
+
+    async def _render(self, card: UserDisplayCard) -> bytes:
+        fields = {name: value for name, value in card.get_card_fields().items() if name not in card.random_fields}
+        return json.dumps(fields, sort_keys=True).encode()
+
+
+class FakeAvatar:
+    key = "avatar"
+
+    def with_size(self, size: int) -> "FakeAvatar":
+        return self
+
+    def with_format(self, image_format: str) -> "FakeAvatar":
+        return self
+
+    async def read(self) -> bytes:
+        return b"avatar"
+
+
+class StandInMember:
+    """Just enough of an ExperienceMember to be carded, with its experience methods borrowed from ExperienceMember."""
+
+    get_experience_above_level = ExperienceMember.get_experience_above_level
+    get_current_level_requirement = ExperienceMember.get_current_level_requirement
+    get_next_level_requirement = ExperienceMember.get_next_level_requirement
+    predict_level_up_experience = ExperienceMember.predict_level_up_experience
+    get_level_progress = ExperienceMember.get_level_progress
+
+    def __init__(self, handler: SimpleNamespace):
+        self.id = 1
+        self.display_name = "Lordfirespeed"
+        self.discriminator = "0"
+        self.display_avatar = FakeAvatar()
+        self.colour = discord.Colour(0x3498db)
+        self.xp_handler = handler
+        self.level = 0
+        self.xp_quantity = 0.0
+        self.rank = 3
+
+
+class LevelUpPrerenderTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        avatar_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(avatar_directory.cleanup)
+        patches = [mock.patch.object(card_renderer, "_card_renderer", FieldsRenderer(1)),
+                   mock.patch.object(card_generator, "_render_scheduler", card_generator.CardRenderScheduler()),
+                   mock.patch.object(avatar_cache, "_avatar_cache", avatar_cache.AvatarCache(Path(avatar_directory.name))),
+                   # level_up_approaching_event hands on copies of members, as the handler would cast them
+                   mock.patch.object(ExperienceMember, "cast_from_member",
+                                     classmethod(lambda cls, member, handler: copy.copy(member)))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.level_curve = XPHandling.XPCurve(100, 2)
+        self.handler = SimpleNamespace(level_curve=self.level_curve,
+                                       speculative_level_up_fraction=0.5,
+                                       rank_index=SimpleNamespace(rank_of=lambda user_id: 3),
+                                       level_up_approaching_event=SubscribableEvent())
+        self.announcer = SimpleNamespace(level_up_channel=object(), handler=self.handler)
+        self.handler.level_up_approaching_event.subscribe(
+            lambda members, gains: AnnounceLevelUps.prerender_level_up_cards(self.announcer, members, gains))
+        self.scheduler = card_generator.get_render_scheduler()
+
+    async def gain_experience(self, member: StandInMember, gain: float) -> bool:
+        """Add one flush's XP gain to a member as the handler does, and announce them if they level up."""
+        member.xp_quantity += gain
+        new_level = self.level_curve.get_floored_level_from_experience(member.xp_quantity)
+        levelled_up = new_level != member.level
+        member.level = new_level
+        await XPHandling.fire_level_up_approaching(self.handler, {member.id: member}, [member.id],
+                                                   [member.xp_quantity], [new_level], [gain])
+        # let the idle pre-renders finish, and be kept by their done callbacks, before the member can level up
+        while self.scheduler._workers:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+        if levelled_up:
+            announced_card = UserDisplayCard(member, UserDisplayCardType.LevelUp)
+            png_bytes = await announced_card.get_png_card(RenderPriority.Background)
+            self.assertEqual(json.loads(png_bytes)["xp_quantity"], XPHandling.format_xp_quantity(member.xp_quantity))
+        return levelled_up
+
+    async def test_level_ups_below_a_thousand_xp_hit_their_prerenders(self):
+        member = StandInMember(self.handler)
+        # 70 XP at a time overshoots every level requirement of the default curve below 1000 XP, which the cards show
+        level_ups = 0
+        while member.level < 3:
+            level_ups += await self.gain_experience(member, 70)
+
+        self.assertEqual(level_ups, 3)
+        self.assertEqual(self.scheduler.prerender_hits, 3)
+        self.assertEqual(self.scheduler.unused_prerenders, 0)
+
+    async def test_level_ups_hit_their_prerenders(self):
+        member = StandInMember(self.handler)
+        member.xp_quantity = 3_000.0
+        member.level = self.level_curve.get_floored_level_from_experience(member.xp_quantity)
+        level_ups = 0
+        while member.level < 8:
+            level_ups += await self.gain_experience(member, 135)
+
+        self.assertEqual(level_ups, 3)
+        self.assertEqual(self.scheduler.prerender_hits, 3)
+
+    async def test_changed_gain_misses_its_prerender(self):
+        member = StandInMember(self.handler)
+        while member.xp_quantity < 300:
+            await self.gain_experience(member, 70)
+        await self.gain_experience(member, 140)
+
+        self.assertEqual(member.level, 2)
+        self.assertEqual(self.scheduler.prerender_hits, 1)
+
+
+class PredictLevelUpExperienceTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.level_curve = XPHandling.XPCurve(100, 2)
+
+    def test_overshoots_requirement_by_remaining_gains(self):
+        self.assertEqual(self.level_curve.predict_level_up_experience(350, 70), 420)
+
+    def test_reaches_requirement_exactly_with_a_dividing_gain(self):
+        self.assertEqual(self.level_curve.predict_level_up_experience(300, 50), 400)
+
+    def test_without_gain_is_requirement(self):
+        self.assertEqual(self.level_curve.predict_level_up_experience(350, 0), 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for the experience rank index against a brute-force sort, run from the repository root:
+
+    python -m unittest tests.test_rank_index"""
+import random
+import unittest
+from bot.cogs.xp.rank_index import ExperienceRankIndex
+
+
+class SmallBlockRankIndex(ExperienceRankIndex):
+    """A rank index with small blocks, so that a few hundred users split and empty blocks many times over."""
+
+    __slots__ = ()
+
+    block_load = 4
+
+
+class ExperienceRankIndexTests(unittest.TestCase):
+    user_id_count = 300
+    operation_count = 3_000
+
+    def setUp(self) -> None:
+        self.random = random.Random(0)
+        self.index = SmallBlockRankIndex()
+        self.experience_by_user_id: dict[int, float] = {}
+
+    def random_experience(self) -> float:
+        # few distinct quantities, so that many users tie and are ordered by user ID
+        return float(self.random.randrange(50) * 10)
+
+    def assert_matches_sort(self) -> None:
+        ranked = sorted(self.experience_by_user_id.items(), key=lambda item: (-item[1], item[0]))
+        self.assertEqual(len(self.index), len(ranked))
+        self.assertEqual(self.index.sorted_keys(), [(-experience, user_id) for user_id, experience in ranked])
+        for rank, (user_id, experience) in enumerate(ranked, start=1):
+            self.assertEqual(self.index.rank_of(user_id), rank)
+            self.assertEqual(self.index.user_at_rank(rank), user_id)
+
+        from_rank = self.random.randint(0, len(ranked) + 1)
+        to_rank = self.random.randint(from_rank - 1, len(ranked) + 2)
+        expected_range = [(rank, user_id, experience) for rank, (user_id, experience) in enumerate(ranked, start=1)
+                          if from_rank <= rank <= to_rank]
+        self.assertEqual(list(self.index.rank_range(from_rank, to_rank)), expected_range)
+
+    def test_random_updates_and_discards_match_sort(self):
+        for operation in range(self.operation_count):
+            user_id = self.random.randrange(self.user_id_count)
+            if self.random.random() < 0.3:
+                self.index.discard(user_id)
+                self.experience_by_user_id.pop(user_id, None)
+            else:
+                experience = self.random_experience()
+                self.index.update(user_id, experience)
+                self.experience_by_user_id[user_id] = experience
+            if operation % 50 == 0:
+                self.assert_matches_sort()
+        self.assert_matches_sort()
+
+    def test_load_then_updates_match_sort(self):
+        self.experience_by_user_id = {user_id: self.random_experience() for user_id in range(self.user_id_count)}
+        self.index.load(self.experience_by_user_id.items())
+        self.assert_matches_sort()
+
+        for user_id in self.random.sample(range(self.user_id_count), 100):
+            experience = self.random_experience()
+            self.index.update(user_id, experience)
+            self.experience_by_user_id[user_id] = experience
+        self.assert_matches_sort()
+
+    def test_discard_every_user(self):
+        self.experience_by_user_id = {user_id: self.random_experience() for user_id in range(self.user_id_count)}
+        self.index.load(self.experience_by_user_id.items())
+        for user_id in self.random.sample(range(self.user_id_count), self.user_id_count):
+            self.index.discard(user_id)
+            del self.experience_by_user_id[user_id]
+        self.assert_matches_sort()
+        self.assertIsNone(self.index.user_at_rank(1))
+
+    def test_unranked_user(self):
+        self.index.update(1, 100.0)
+        self.assertNotIn(2, self.index)
+        self.assertIsNone(self.index.rank_of(2))
+        self.assertIsNone(self.index.user_at_rank(0))
+        self.assertIsNone(self.index.user_at_rank(2))
+
+    def test_version_counts_changes_only(self):
+        self.index.update(1, 100.0)
+        version = self.index.version
+        self.index.update(1, 100.0)
+        self.index.discard(2)
+        self.assertEqual(self.index.version, version)
+
+        self.index.update(1, 200.0)
+        self.index.discard(1)
+        self.assertEqual(self.index.version, version + 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Tests for the coalescing of queued role changes, run from the repository root:
+
+    python -m unittest tests.test_role_mutation_queue"""
+from types import SimpleNamespace
+from typing import Optional
+import asyncio
+import unittest
+from bot.cogs.xp.role_mutation_queue import RoleMutationQueue
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+
+    def is_default(self) -> bool:
+        return self.id == 0
+
+    def __repr__(self) -> str:
+        return f"FakeRole({self.id})"
+
+
+class FakeMember:
+    """A member whose role edits are recorded as (route, role IDs, reason) calls, and applied to its roles."""
+
+    def __init__(self, member_id: int, roles: list[FakeRole]):
+        self.id = member_id
+        self.roles = [FakeRole(0)] + roles
+        self.calls: list[tuple[str, list[int], Optional[str]]] = []
+
+    def role_ids(self) -> set[int]:
+        return {role.id for role in self.roles if not role.is_default()}
+
+    async def add_roles(self, *roles: FakeRole, reason: Optional[str] = None) -> None:
+        self.calls.append(("add_roles", [role.id for role in roles], reason))
+        self.roles += roles
+
+    async def remove_roles(self, *roles: FakeRole, reason: Optional[str] = None) -> None:
+        self.calls.append(("remove_roles", [role.id for role in roles], reason))
+        removed_role_ids = {role.id for role in roles}
+        self.roles = [role for role in self.roles if role.id not in removed_role_ids]
+
+    async def edit(self, roles: list[FakeRole], reason: Optional[str] = None) -> None:
+        self.calls.append(("edit", sorted(role.id for role in roles), reason))
+        self.roles = [FakeRole(0)] + roles
+
+
+class RoleMutationQueueTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.roles = {role_id: FakeRole(role_id) for role_id in range(1, 6)}
+        self.member = FakeMember(1, [self.roles[1], self.roles[2]])
+        self.cached_members = {self.member.id: self.member}
+        bot = SimpleNamespace(cached_guild=SimpleNamespace(get_member=self.cached_members.get))
+        self.queue = RoleMutationQueue(bot, window=60.0)
+        self.addAsyncCleanup(self.queue.close)
+
+    def get_roles(self, *role_ids: int) -> list[FakeRole]:
+        return [self.roles[role_id] for role_id in role_ids]
+
+    async def test_changes_within_window_make_one_edit(self):
+        self.queue.add_roles(self.member, self.get_roles(3), reason="User leveled up")
+        self.queue.add_roles(self.member, self.get_roles(4), reason="User leveled up")
+        self.queue.remove_roles(self.member, self.get_roles(1), reason="Refreshed user's XP autoroles")
+        self.assertEqual(len(self.queue), 1)
+        await self.queue.apply(self.member.id)
+
+        self.assertEqual(self.member.calls, [("edit", [2, 3, 4], "User leveled up; Refreshed user's XP autoroles")])
+        self.assertEqual(self.member.role_ids(), {2, 3, 4})
+        self.assertEqual((self.queue.requested_calls, self.queue.made_calls, self.queue.avoided_calls), (3, 1, 2))
+
+    async def test_later_change_to_role_overrides_earlier(self):
+        self.queue.add_roles(self.member, self.get_roles(3))
+        self.queue.remove_roles(self.member, self.get_roles(3))
+        self.queue.remove_roles(self.member, self.get_roles(2))
+        self.queue.add_roles(self.member, self.get_roles(2))
+        await self.queue.apply(self.member.id)
+
+        self.assertEqual(self.member.calls, [])
+        self.assertEqual(self.queue.made_calls, 0)
+
+    async def test_single_role_change_uses_its_own_route(self):
+        self.queue.add_roles(self.member, self.get_roles(3))
+        self.queue.add_roles(self.member, self.get_roles(1))
+        await self.queue.apply(self.member.id)
+
+        self.assertEqual(self.member.calls, [("add_roles", [3], None)])
+
+    async def test_change_is_diffed_against_roles_when_applied(self):
+        self.queue.add_roles(self.member, self.get_roles(3, 4))
+        self.queue.remove_roles(self.member, self.get_roles(1, 2))
+        # another bot gives the member roles 3 and 5, and takes role 1 away, while the window is open
+        self.member.roles = [FakeRole(0), self.roles[2], self.roles[3], self.roles[5]]
+        await self.queue.apply(self.member.id)
+
+        self.assertEqual(self.member.calls, [("edit", [3, 4, 5], None)])
+
+    async def test_uncached_member_changes_each_role_on_its_own_route(self):
+        member = FakeMember(2, [self.roles[1]])
+        self.queue.add_roles(member, self.get_roles(3, 4))
+        self.queue.remove_roles(member, self.get_roles(1))
+        await self.queue.apply(member.id)
+
+        self.assertEqual(member.calls, [("add_roles", [3, 4], None), ("remove_roles", [1], None)])
+        self.assertEqual(self.queue.made_calls, 3)
+
+    async def test_window_applies_change(self):
+        self.queue.window = 0.01
+        self.queue.add_roles(self.member, self.get_roles(3))
+        self.queue.add_roles(self.member, self.get_roles(4))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*self.queue._tasks)
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.member.calls, [("edit", [1, 2, 3, 4], None)])
+
+    async def test_close_applies_every_pending_change(self):
+        member = FakeMember(2, [])
+        self.cached_members[member.id] = member
+        self.queue.add_roles(self.member, self.get_roles(3))
+        self.queue.add_roles(member, self.get_roles(3))
+        await self.queue.close()
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.member.role_ids(), {1, 2, 3})
+        self.assertEqual(member.role_ids(), {3})
+
+    async def test_empty_change_is_not_queued(self):
+        self.queue.add_roles(self.member, [])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.requested_calls, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()